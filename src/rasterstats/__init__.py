@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
-from .main import zonal_stats_timeseries, gen_zonal_stats, raster_stats, zonal_stats, get_coverage
-from .point import gen_point_query, point_query
+from .main import (zonal_stats_timeseries, gen_zonal_stats, raster_stats,
+                   zonal_stats, get_coverage, grid_stats)
+from .point import gen_point_query, point_query, gen_line_query, line_profile
+from .partials import zonal_partials, merge_partials, finalize
 from rasterstats import cli
 from rasterstats._version import __version__
 
@@ -10,5 +12,11 @@ __all__ = ['zonal_stats_timeseries',
            'gen_point_query',
            'raster_stats',
            'zonal_stats',
+           'grid_stats',
            'point_query',
+           'gen_line_query',
+           'line_profile',
+           'zonal_partials',
+           'merge_partials',
+           'finalize',
            'cli']
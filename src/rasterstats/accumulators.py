@@ -0,0 +1,326 @@
+# -*- coding: utf-8 -*-
+"""Mergeable partial aggregates of zonal statistics
+
+Each accumulator summarizes the values of a part of a feature (a sub
+geometry, a raster tile) such that the statistics of the whole feature are
+obtained by merging the parts, in any order, with the same result as
+computing them over all the values at once.
+
+Accumulators are converted to and from dicts of plain (JSON serializable)
+python values with ``to_dict`` and ``from_dict``, to be exchanged between
+processes or hosts.
+"""
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+
+from .utils import (check_stats, get_quantiles, value_counts,
+                    category_counts)
+
+
+class Moments(object):
+    """Count, sum, extrema and sum of squared deviations from the mean
+
+    The mean and squared deviations of the parts are combined with the
+    pairwise update of Chan et al., numerically stable where the naive
+    sum of squares is not.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def update(self, values):
+        values = np.asarray(values, dtype='float64')
+        if not values.size:
+            return
+        part = Moments()
+        part.count = values.size
+        part.total = float(values.sum())
+        part.mean = part.total / part.count
+        part.m2 = float(((values - part.mean) ** 2).sum())
+        part.min = float(values.min())
+        part.max = float(values.max())
+        self.merge(part)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        if not self.count:
+            self.count, self.total, self.mean, self.m2 = \
+                other.count, other.total, other.mean, other.m2
+            self.min, self.max = other.min, other.max
+            return
+        n = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / n
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / n
+        self.count = n
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.m2 / self.count))
+
+    _fields = ('count', 'total', 'mean', 'm2', 'min', 'max')
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self._fields)
+
+    @classmethod
+    def from_dict(cls, state):
+        acc = cls()
+        for field in cls._fields:
+            setattr(acc, field, state[field])
+        return acc
+
+
+class WeightedSums(object):
+    """Sums of values weighted by pixel coverage and latitude
+
+    `weight` and `total` are the sums of the coverage weights and of the
+    coverage weighted values; the mean additionally weights each value
+    by the latitude scale of its row.
+    """
+
+    def __init__(self):
+        self.weight = 0.0
+        self.total = 0.0
+        self.mean_weight = 0.0
+        self.mean_total = 0.0
+
+    def update(self, values, weights=None, latitude_scale=None):
+        values = np.asarray(values, dtype='float64')
+        weights = np.ones(values.shape) if weights is None \
+            else np.asarray(weights, dtype='float64')
+        mean_weights = weights if latitude_scale is None \
+            else weights * latitude_scale
+        self.weight += float(weights.sum())
+        self.total += float((values * weights).sum())
+        self.mean_weight += float(mean_weights.sum())
+        self.mean_total += float((values * mean_weights).sum())
+
+    def merge(self, other):
+        self.weight += other.weight
+        self.total += other.total
+        self.mean_weight += other.mean_weight
+        self.mean_total += other.mean_total
+
+    @property
+    def mean(self):
+        return self.mean_total / self.mean_weight
+
+    _fields = ('weight', 'total', 'mean_weight', 'mean_total')
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in self._fields)
+
+    @classmethod
+    def from_dict(cls, state):
+        acc = cls()
+        for field in cls._fields:
+            setattr(acc, field, state[field])
+        return acc
+
+
+class ValueCounter(object):
+    """Exact count of each distinct value
+
+    Gives the categorical counts, majority, minority and unique stats, and
+    exact quantiles from the cumulative counts of the sorted values. Its
+    size is the number of distinct values, small for categorical rasters.
+    """
+
+    def __init__(self):
+        self.keys = np.empty(0)
+        self.counts = np.empty(0, dtype='int64')
+
+    def update(self, values):
+        keys, counts = value_counts(np.asarray(values))
+        self._add(keys, counts)
+
+    def merge(self, other):
+        self._add(other.keys, other.counts)
+
+    def _add(self, keys, counts):
+        if not counts.size:
+            return
+        if not self.counts.size:
+            self.keys, self.counts = keys, counts.astype('int64')
+            return
+        keys, inverse = np.unique(np.concatenate([self.keys, keys]),
+                                  return_inverse=True)
+        self.counts = np.bincount(
+            inverse, weights=np.concatenate([self.counts, counts]),
+            minlength=keys.size).astype('int64')
+        self.keys = keys
+
+    @property
+    def majority(self):
+        return float(self.keys[np.argmax(self.counts)])
+
+    @property
+    def minority(self):
+        return float(self.keys[np.argmin(self.counts)])
+
+    @property
+    def unique(self):
+        return int(self.keys.size)
+
+    def quantiles(self, qs):
+        """Percentiles qs of the counted values, see ``utils.get_quantiles``"""
+        return get_quantiles(qs, keys=self.keys, counts=self.counts)
+
+    def to_dict(self):
+        return {'keys': self.keys.tolist(), 'counts': self.counts.tolist()}
+
+    @classmethod
+    def from_dict(cls, state):
+        acc = cls()
+        if state['counts']:
+            acc.keys = np.asarray(state['keys'])
+            acc.counts = np.asarray(state['counts'], dtype='int64')
+        return acc
+
+
+class StatsAccumulator(object):
+    """Partial zonal statistics of a feature
+
+    Parameters
+    ----------
+    stats: list of stats, as returned by ``utils.check_stats``
+    categorical: also count the pixels of each distinct value
+    category_map: dict used to rename the categories
+    """
+
+    def __init__(self, stats, categorical=False, category_map=None):
+        self.stats = stats
+        self.categorical = categorical
+        self.category_map = category_map
+        self.moments = Moments()
+        self.sums = None
+        # coverage weighted count and sum
+        self.weighted = False
+        self.counter = None
+        _, self.plan = check_stats(stats, categorical)
+        if self.plan.value_counts or self.plan.quantiles:
+            self.counter = ValueCounter()
+        self.nodata = 0
+        self.nan = 0
+
+    def update(self, values, weights=None, latitude_scale=None,
+               nodata=0, nan=0):
+        """Add the valid values of a part of the feature
+
+        Parameters
+        ----------
+        values: 1d array of the valid pixel values
+        weights: coverage weight of each value, for `percent_cover_weighting`
+        latitude_scale: latitude scale of each value, for `latitude_correction`
+        nodata, nan: number of nodata and nan pixels
+        """
+        self.moments.update(values)
+        if weights is not None or latitude_scale is not None:
+            if self.sums is None:
+                self.sums = WeightedSums()
+            self.sums.update(values, weights, latitude_scale)
+            self.weighted |= weights is not None
+        if self.counter is not None:
+            self.counter.update(values)
+        self.nodata += nodata
+        self.nan += nan
+
+    def merge(self, other):
+        self.moments.merge(other.moments)
+        if other.sums is not None:
+            if self.sums is None:
+                self.sums = WeightedSums()
+            self.sums.merge(other.sums)
+            self.weighted |= other.weighted
+        if self.counter is not None:
+            self.counter.merge(other.counter)
+        self.nodata += other.nodata
+        self.nan += other.nan
+
+    def result(self):
+        """Stats dict of the values accumulated so far"""
+        stats = self.stats
+        moments = self.moments
+        if not moments.count:
+            feature_stats = dict([(stat, None) for stat in stats])
+            if 'count' in stats:
+                feature_stats['count'] = 0
+        else:
+            if self.categorical:
+                feature_stats = category_counts(
+                    self.counter.keys, self.counter.counts, self.category_map)
+            else:
+                feature_stats = {}
+
+            sums = self.sums
+            if 'count' in stats:
+                feature_stats['count'] = sums.weight if self.weighted \
+                    else moments.count
+            if 'sum' in stats:
+                feature_stats['sum'] = sums.total if self.weighted \
+                    else moments.total
+            if 'mean' in stats:
+                feature_stats['mean'] = moments.mean if sums is None \
+                    else sums.mean
+            if 'min' in stats:
+                feature_stats['min'] = moments.min
+            if 'max' in stats:
+                feature_stats['max'] = moments.max
+            if 'range' in stats:
+                feature_stats['range'] = moments.max - moments.min
+            if 'std' in stats:
+                feature_stats['std'] = moments.std
+            if self.plan.quantiles:
+                names, qs = zip(*self.plan.quantiles)
+                feature_stats.update(zip(names, self.counter.quantiles(qs)))
+            if 'majority' in stats:
+                feature_stats['majority'] = self.counter.majority
+            if 'minority' in stats:
+                feature_stats['minority'] = self.counter.minority
+            if 'unique' in stats:
+                feature_stats['unique'] = self.counter.unique
+
+        if 'nodata' in stats:
+            feature_stats['nodata'] = float(self.nodata) if self.nodata else 0
+        if 'nan' in stats:
+            feature_stats['nan'] = float(self.nan) if self.nan else 0
+        return feature_stats
+
+    def to_dict(self):
+        """State of the accumulator as a dict of plain python values
+
+        The `category_map` is not part of it, as its keys are raster values.
+        """
+        return {
+            'stats': list(self.stats),
+            'categorical': self.categorical,
+            'moments': self.moments.to_dict(),
+            'sums': None if self.sums is None else self.sums.to_dict(),
+            'weighted': self.weighted,
+            'counter': None if self.counter is None else self.counter.to_dict(),
+            'nodata': self.nodata,
+            'nan': self.nan}
+
+    @classmethod
+    def from_dict(cls, state, category_map=None):
+        acc = cls(state['stats'], state['categorical'], category_map)
+        acc.moments = Moments.from_dict(state['moments'])
+        if state['sums'] is not None:
+            acc.sums = WeightedSums.from_dict(state['sums'])
+        acc.weighted = state['weighted']
+        if state['counter'] is not None:
+            acc.counter = ValueCounter.from_dict(state['counter'])
+        acc.nodata = state['nodata']
+        acc.nan = state['nan']
+        return acc
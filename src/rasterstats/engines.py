@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+from collections import defaultdict
+import numpy as np
+from rasterio import features
+from shapely.geometry import shape
+from affine import Affine
+from .accumulators import StatsAccumulator
+from .io import bounds_window
+from .utils import boxify_points, rasterize_geom
+
+DEFAULT_TILE_SIZE = 1024
+# stats supported by the label engine
+LABEL_STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'range',
+               'nodata', 'nan']
+# stats supported by the grid engine
+GRID_STATS = LABEL_STATS
+
+
+def tile_index(bounds, affine, raster_shape, tile_size):
+    """Spatial index of features over the tiles of a raster
+
+    Parameters
+    ----------
+    bounds: list of (w, s, e, n) feature bounds
+    affine: Affine transform of the raster
+    raster_shape: (rows, cols) of the raster
+    tile_size: size of the (square) tiles in pixels
+
+    Returns
+    -------
+    dict mapping (tile_row, tile_col) to the list of indices of
+    the features whose bounds intersect that tile
+    """
+    height, width = raster_shape
+    index = defaultdict(list)
+    for i, feature_bounds in enumerate(bounds):
+        (row_start, row_stop), (col_start, col_stop) = \
+            bounds_window(feature_bounds, affine)
+        row_start, row_stop = max(row_start, 0), min(row_stop, height)
+        col_start, col_stop = max(col_start, 0), min(col_stop, width)
+        if row_start >= row_stop or col_start >= col_stop:
+            # outside of the raster
+            continue
+        for tile_row in range(row_start // tile_size,
+                              (row_stop - 1) // tile_size + 1):
+            for tile_col in range(col_start // tile_size,
+                                  (col_stop - 1) // tile_size + 1):
+                index[(tile_row, tile_col)].append(i)
+    return index
+
+
+def tile_window(tile, tile_size, raster_shape):
+    tile_row, tile_col = tile
+    row, col = tile_row * tile_size, tile_col * tile_size
+    return ((row, min(row + tile_size, raster_shape[0])),
+            (col, min(col + tile_size, raster_shape[1])))
+
+
+def _read_geoms(features_list, rast):
+    geoms = []
+    for feat in features_list:
+        geom = shape(feat['geometry'])
+        if 'Point' in geom.geom_type:
+            geom = boxify_points(geom, rast)
+        geoms.append(geom)
+    return geoms
+
+
+def _outside_count(geom, affine, raster_shape, all_touched):
+    """Number of pixels of geom that fall outside of the raster extent
+
+    Those pixels are read as nodata by the feature engine.
+    """
+    (row_start, row_stop), (col_start, col_stop) = \
+        bounds_window(geom.bounds, affine)
+    height, width = raster_shape
+    if row_start >= 0 and col_start >= 0 and \
+            row_stop <= height and col_stop <= width:
+        return 0
+    rv_array = rasterize_geom(
+        geom, shape=(row_stop - row_start, col_stop - col_start),
+        affine=affine * Affine.translation(col_start, row_start),
+        all_touched=all_touched)
+    rv_array[max(-row_start, 0):max(height - row_start, 0),
+             max(-col_start, 0):max(width - col_start, 0)] = False
+    return int(rv_array.sum())
+
+
+def _moment_stats(stats, count, total, m2, vmin, vmax, nodata_count, nan_count):
+    """Stats dict of a feature from its accumulated moments"""
+    if count == 0:
+        feature_stats = dict([(stat, None) for stat in stats])
+        if 'count' in stats:
+            feature_stats['count'] = 0
+    else:
+        feature_stats = {}
+        if 'count' in stats:
+            feature_stats['count'] = int(count)
+        if 'sum' in stats:
+            feature_stats['sum'] = float(total)
+        if 'mean' in stats:
+            feature_stats['mean'] = float(total / count)
+        if 'min' in stats:
+            feature_stats['min'] = float(vmin)
+        if 'max' in stats:
+            feature_stats['max'] = float(vmax)
+        if 'range' in stats:
+            feature_stats['range'] = float(vmax - vmin)
+        if 'std' in stats:
+            feature_stats['std'] = float(np.sqrt(m2 / count))
+
+    if 'nodata' in stats:
+        feature_stats['nodata'] = float(nodata_count) if nodata_count else 0
+    if 'nan' in stats:
+        feature_stats['nan'] = float(nan_count) if nan_count else 0
+    return feature_stats
+
+
+def _group_reduce(ufunc, labels, values):
+    """Reduce values sharing a label with ufunc (e.g. np.minimum)
+
+    Returns the unique labels and the reduced value for each of them.
+    """
+    order = np.argsort(labels, kind='mergesort')
+    labels = labels[order]
+    starts = np.flatnonzero(np.r_[True, labels[1:] != labels[:-1]])
+    return labels[starts], ufunc.reduceat(values[order], starts)
+
+
+def gen_label_zonal_stats(features_list, rast, stats, all_touched=False,
+                          tile_size=DEFAULT_TILE_SIZE):
+    """Zonal statistics for a set of non-overlapping features
+
+    All features intersecting a tile are burned into a single integer
+    label raster and the statistics of every feature are accumulated
+    with grouped reductions over the labels, so each pixel is read and
+    visited once regardless of the number of features. Where features
+    overlap, the pixels go to the feature that comes last.
+
+    Parameters
+    ----------
+    features_list: list of GeoJSON-like features
+    rast: open ``io.Raster``
+    stats: list of stats, all in ``LABEL_STATS``
+    all_touched: rasterization strategy
+    tile_size: size of the tiles the raster is processed in, in pixels
+
+    Returns
+    -------
+    generator of stats dicts, in the order of `features_list`
+    """
+    geoms = _read_geoms(features_list, rast)
+
+    # index 0 is the background label
+    size = len(geoms) + 1
+    count = np.zeros(size, dtype='int64')
+    total = np.zeros(size)
+    mean = np.zeros(size)
+    m2 = np.zeros(size)
+    vmin = np.full(size, np.inf)
+    vmax = np.full(size, -np.inf)
+    nodata_count = np.zeros(size, dtype='int64')
+    nan_count = np.zeros(size, dtype='int64')
+
+    index = tile_index([g.bounds for g in geoms], rast.affine, rast.shape,
+                       tile_size)
+    for tile in sorted(index):
+        fsrc = rast.read(window=tile_window(tile, tile_size, rast.shape))
+        labels = features.rasterize(
+            [(geoms[i], i + 1) for i in index[tile]],
+            out_shape=fsrc.shape,
+            transform=fsrc.affine,
+            fill=0,
+            dtype='uint32',
+            all_touched=all_touched)
+
+        inside = labels > 0
+        isnodata = (fsrc.array == fsrc.nodata)
+        if 'nodata' in stats:
+            nodata_count += np.bincount(labels[inside & isnodata],
+                                        minlength=size)
+        if np.issubdtype(fsrc.array.dtype, np.floating):
+            isnan = np.isnan(fsrc.array)
+            if 'nan' in stats:
+                nan_count += np.bincount(labels[inside & isnan], minlength=size)
+            isnodata |= isnan
+
+        valid = inside & ~isnodata
+        tile_labels = labels[valid]
+        if not tile_labels.size:
+            continue
+        values = fsrc.array[valid].astype('float64')
+
+        # per tile mean and sum of squared deviations,
+        # merged into the running ones (Chan et al.)
+        tile_count = np.bincount(tile_labels, minlength=size)
+        tile_total = np.bincount(tile_labels, weights=values, minlength=size)
+        present = np.flatnonzero(tile_count)
+        tile_mean = np.zeros(size)
+        tile_mean[present] = tile_total[present] / tile_count[present]
+        tile_m2 = np.bincount(tile_labels,
+                              weights=(values - tile_mean[tile_labels]) ** 2,
+                              minlength=size)
+
+        n_a, n_b = count[present], tile_count[present]
+        n = n_a + n_b
+        delta = tile_mean[present] - mean[present]
+        mean[present] += delta * n_b / n
+        m2[present] += tile_m2[present] + delta ** 2 * n_a * n_b / n
+        count[present] = n
+        total += tile_total
+
+        keys, mins = _group_reduce(np.minimum, tile_labels, values)
+        vmin[keys] = np.minimum(vmin[keys], mins)
+        keys, maxs = _group_reduce(np.maximum, tile_labels, values)
+        vmax[keys] = np.maximum(vmax[keys], maxs)
+
+    if 'nodata' in stats:
+        for i, geom in enumerate(geoms):
+            nodata_count[i + 1] += _outside_count(
+                geom, rast.affine, rast.shape, all_touched)
+
+    for label in range(1, size):
+        yield _moment_stats(stats, count[label], total[label], m2[label],
+                            vmin[label], vmax[label],
+                            nodata_count[label], nan_count[label])
+
+
+def gen_tile_partials(geoms, rast, index, accumulator, all_touched=False,
+                      tile_size=DEFAULT_TILE_SIZE, tiles=None):
+    """Partial statistics of each feature within each raster tile
+
+    Parameters
+    ----------
+    geoms: list of shapely geometries
+    rast: open ``io.Raster``
+    index: tile index of the geometries, see ``tile_index``
+    accumulator: callable returning an empty ``accumulators.StatsAccumulator``
+    all_touched: rasterization strategy
+    tile_size: size of the tiles the raster is processed in, in pixels
+    tiles: only process these (tile_row, tile_col), defaults to all of them
+
+    Returns
+    -------
+    generator of (tile, geometry index, accumulator), tile by tile
+    in row major order
+    """
+    windows = {}
+    for tile in sorted(index):
+        if tiles is not None and tile not in tiles:
+            continue
+        window = tile_window(tile, tile_size, rast.shape)
+        (tr_start, tr_stop), (tc_start, tc_stop) = window
+        fsrc = rast.read(window=window)
+        isnodata = (fsrc.array == fsrc.nodata)
+        isnan = None
+        if np.issubdtype(fsrc.array.dtype, np.floating):
+            isnan = np.isnan(fsrc.array)
+            isnodata_or_nan = isnodata | isnan
+        else:
+            isnodata_or_nan = isnodata
+
+        for i in index[tile]:
+            if i not in windows:
+                windows[i] = bounds_window(geoms[i].bounds, rast.affine)
+            # the part of the feature's window within this tile
+            (wr_start, wr_stop), (wc_start, wc_stop) = windows[i]
+            r_start = max(wr_start, tr_start) - tr_start
+            r_stop = min(wr_stop, tr_stop) - tr_start
+            c_start = max(wc_start, tc_start) - tc_start
+            c_stop = min(wc_stop, tc_stop) - tc_start
+            sub = (slice(r_start, r_stop), slice(c_start, c_stop))
+            sub_affine = fsrc.affine * Affine.translation(c_start, r_start)
+
+            rv_array = rasterize_geom(
+                geoms[i], shape=(r_stop - r_start, c_stop - c_start),
+                affine=sub_affine, all_touched=all_touched)
+
+            partial = accumulator()
+            partial.update(
+                fsrc.array[sub][rv_array & ~isnodata_or_nan[sub]],
+                nodata=int((rv_array & isnodata[sub]).sum()),
+                nan=0 if isnan is None else int((rv_array & isnan[sub]).sum()))
+            yield tile, i, partial
+
+
+def gen_sweep_zonal_stats(features_list, rast, stats, all_touched=False,
+                          categorical=False, category_map=None,
+                          tile_size=DEFAULT_TILE_SIZE):
+    """Zonal statistics computed in a single pass over the raster
+
+    The raster is walked once, tile by tile. A spatial index over the
+    feature bounds gives the features intersecting each tile; each of them
+    is rasterized within its part of the tile and its partial statistics
+    (see ``accumulators``) are merged. A feature is finalized as soon as
+    all of its tiles are done, so the raster is read once regardless of the
+    number of features. Features may overlap.
+
+    Parameters
+    ----------
+    features_list: list of GeoJSON-like features
+    rast: open ``io.Raster``
+    stats: list of stats
+    all_touched: rasterization strategy
+    categorical, category_map: as for ``main.gen_zonal_stats``
+    tile_size: size of the tiles the raster is processed in, in pixels
+
+    Returns
+    -------
+    generator of stats dicts, in the order of `features_list`
+    """
+    geoms = _read_geoms(features_list, rast)
+
+    index = tile_index([g.bounds for g in geoms], rast.affine, rast.shape,
+                       tile_size)
+    remaining = np.zeros(len(geoms), dtype='int64')
+    for members in index.values():
+        remaining[members] += 1
+
+    def accumulator():
+        return StatsAccumulator(stats, categorical, category_map)
+
+    def finalize(i, partial):
+        if 'nodata' in stats:
+            partial.nodata += _outside_count(
+                geoms[i], rast.affine, rast.shape, all_touched)
+        return partial.result()
+
+    partials = {}
+    finished = {}
+    next_feature = 0
+    for _, i, part in gen_tile_partials(geoms, rast, index, accumulator,
+                                        all_touched, tile_size):
+        if i in partials:
+            partials[i].merge(part)
+        else:
+            partials[i] = part
+
+        remaining[i] -= 1
+        if remaining[i] == 0:
+            finished[i] = finalize(i, partials.pop(i))
+
+        # emit the features that are done, in input order
+        while next_feature < len(geoms) and remaining[next_feature] == 0:
+            feature_stats = finished.pop(next_feature, None)
+            if feature_stats is None:
+                # outside of the raster
+                feature_stats = finalize(next_feature, accumulator())
+            yield feature_stats
+            next_feature += 1
+
+    for i in range(next_feature, len(geoms)):
+        feature_stats = finished.pop(i, None)
+        yield finalize(i, accumulator()) if feature_stats is None \
+            else feature_stats
+
+
+def grid_window(geom, affine, tolerance=1e-6):
+    """Pixel window of a rectangle whose edges lie on pixel edges
+
+    Such a rectangle covers exactly the pixels of its window.
+
+    Parameters
+    ----------
+    geom: shapely geometry
+    affine: Affine transform of the raster, not rotated
+    tolerance: in pixels
+
+    Returns
+    -------
+    rasterio-style window, or None if geom is no such rectangle
+    """
+    if geom.geom_type != 'Polygon' or affine.b or affine.d:
+        return None
+    coords = np.asarray(geom.exterior.coords)
+    if coords.shape != (5, 2) or geom.interiors:
+        return None
+    # vertices in pixel space, on pixel corners
+    cols = (coords[:, 0] - affine.c) / affine.a
+    rows = (coords[:, 1] - affine.f) / affine.e
+    corners = np.round(np.stack([cols, rows], axis=1))
+    if np.abs(corners - np.stack([cols, rows], axis=1)).max() > tolerance:
+        return None
+    # edges alternately along rows and columns, none of them empty
+    steps = np.diff(corners, axis=0)
+    along = steps != 0
+    if not ((along[:, 0] != along[:, 1]).all() and
+            (along[::2, 0] == along[0, 0]).all() and
+            (along[1::2, 0] != along[0, 0]).all()):
+        return None
+    col_start, col_stop = int(corners[:, 0].min()), int(corners[:, 0].max())
+    row_start, row_stop = int(corners[:, 1].min()), int(corners[:, 1].max())
+    return (row_start, row_stop), (col_start, col_stop)
+
+
+def _summed_area(a):
+    """Summed-area table of a, with a leading row and column of zeros"""
+    table = np.zeros((a.shape[0] + 1, a.shape[1] + 1), dtype=a.dtype)
+    np.cumsum(a, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table
+
+
+def _window_sums(table, r0, r1, c0, c1):
+    return table[r1, c1] - table[r0, c1] - table[r1, c0] + table[r0, c0]
+
+
+def _square_tables(a, ufunc, levels):
+    """Sparse table of a: level k holds ufunc over the 2**k by 2**k squares
+    starting at each pixel"""
+    tables = [a]
+    for k in range(1, levels):
+        prev, s = tables[-1], 2 ** (k - 1)
+        if prev.shape[0] <= s or prev.shape[1] <= s:
+            break
+        tables.append(ufunc(ufunc(prev[:-s, :-s], prev[s:, :-s]),
+                            ufunc(prev[:-s, s:], prev[s:, s:])))
+    return tables
+
+
+def _window_extrema(tables, ufunc, r0, r1, c0, c1):
+    """ufunc over windows of the same height and width, answered from the
+    squares of side 2**k covering them (k the largest fitting)"""
+    height, width = int(r1[0] - r0[0]), int(c1[0] - c0[0])
+    k = min(min(height, width).bit_length() - 1, len(tables) - 1)
+    s = 2 ** k
+    row_offsets = np.unique(np.r_[np.arange(0, height - s, s), height - s])
+    col_offsets = np.unique(np.r_[np.arange(0, width - s, s), width - s])
+    rows = r0[:, None, None] + row_offsets[None, :, None]
+    cols = c0[:, None, None] + col_offsets[None, None, :]
+    return ufunc.reduce(tables[k][rows, cols].reshape(len(r0), -1), axis=1)
+
+
+def gen_grid_zonal_stats(features_list, rast, stats, all_touched=False,
+                         tile_size=DEFAULT_TILE_SIZE):
+    """Zonal statistics of rectangles aligned with the raster grid
+
+    Features that are rectangles with their edges on pixel edges (e.g.
+    fishnet grids, see ``grid_window``) cover exactly the pixels of their
+    window. Their count, sum and squared deviations are taken from
+    summed-area tables and their min and max from sparse tables, computed
+    once per raster tile, without rasterizing or masking. Other features
+    (and all of them with `all_touched`, which also takes the pixels along
+    the edges) are computed by the sweep engine.
+
+    Parameters
+    ----------
+    features_list: list of GeoJSON-like features
+    rast: open ``io.Raster``
+    stats: list of stats, all in ``GRID_STATS``
+    all_touched: rasterization strategy
+    tile_size: size of the tiles the raster is processed in, in pixels
+
+    Returns
+    -------
+    generator of stats dicts, in the order of `features_list`
+    """
+    geoms = _read_geoms(features_list, rast)
+    height, width = rast.shape[-2:]
+    windows = [None if all_touched else grid_window(geom, rast.affine)
+               for geom in geoms]
+    rects = [i for i, window in enumerate(windows) if window is not None]
+    others = [i for i, window in enumerate(windows) if window is None]
+
+    size = len(rects)
+    count = np.zeros(size, dtype='int64')
+    total = np.zeros(size)
+    mean = np.zeros(size)
+    m2 = np.zeros(size)
+    vmin = np.full(size, np.inf)
+    vmax = np.full(size, -np.inf)
+    nodata_count = np.zeros(size, dtype='int64')
+    nan_count = np.zeros(size, dtype='int64')
+
+    bounds = np.array([windows[i][0] + windows[i][1] for i in rects],
+                      dtype='int64').reshape(-1, 4)
+    # pixels outside of the raster are nodata
+    clipped = bounds.copy()
+    clipped[:, :2] = clipped[:, :2].clip(0, height)
+    clipped[:, 2:] = clipped[:, 2:].clip(0, width)
+    nodata_count += (bounds[:, 1] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 2]) \
+        - (clipped[:, 1] - clipped[:, 0]) * (clipped[:, 3] - clipped[:, 2])
+
+    index = defaultdict(list)
+    for j, (r0, r1, c0, c1) in enumerate(clipped):
+        if r0 >= r1 or c0 >= c1:
+            continue
+        for tile_row in range(r0 // tile_size, (r1 - 1) // tile_size + 1):
+            for tile_col in range(c0 // tile_size, (c1 - 1) // tile_size + 1):
+                index[(tile_row, tile_col)].append(j)
+
+    extrema = [(ufunc, fill, result) for stat, ufunc, fill, result in [
+        ('min', np.minimum, np.inf, vmin), ('max', np.maximum, -np.inf, vmax)]
+        if stat in stats or 'range' in stats]
+
+    for tile in sorted(index):
+        window = tile_window(tile, tile_size, rast.shape)
+        (tr_start, tr_stop), (tc_start, tc_stop) = window
+        fsrc = rast.read(window=window)
+        isnodata = (fsrc.array == fsrc.nodata)
+        isnan = np.zeros_like(isnodata)
+        if np.issubdtype(fsrc.array.dtype, np.floating):
+            isnan = np.isnan(fsrc.array)
+        valid = ~isnodata & ~isnan
+        values = np.where(valid, fsrc.array, 0).astype('float64')
+        # squared deviations from the tile mean, to limit cancellation
+        shift = values.sum() / max(int(valid.sum()), 1)
+        deviations = np.where(valid, values - shift, 0)
+
+        members = np.array(index[tile])
+        r0 = clipped[members, 0].clip(tr_start, tr_stop) - tr_start
+        r1 = clipped[members, 1].clip(tr_start, tr_stop) - tr_start
+        c0 = clipped[members, 2].clip(tc_start, tc_stop) - tc_start
+        c1 = clipped[members, 3].clip(tc_start, tc_stop) - tc_start
+
+        part_count = _window_sums(
+            _summed_area(valid.astype('int64')), r0, r1, c0, c1)
+        part_total = _window_sums(_summed_area(values), r0, r1, c0, c1)
+        part_dev = _window_sums(_summed_area(deviations), r0, r1, c0, c1)
+        part_sq = _window_sums(_summed_area(deviations ** 2), r0, r1, c0, c1)
+        if 'nodata' in stats:
+            nodata_count[members] += _window_sums(
+                _summed_area(isnodata.astype('int64')), r0, r1, c0, c1)
+        if 'nan' in stats:
+            nan_count[members] += _window_sums(
+                _summed_area(isnan.astype('int64')), r0, r1, c0, c1)
+
+        present = part_count > 0
+        members, n_b = members[present], part_count[present]
+        part_mean = part_total[present] / n_b
+        part_m2 = np.maximum(
+            part_sq[present] - part_dev[present] ** 2 / n_b, 0)
+
+        # merged into the running moments (Chan et al.)
+        n_a = count[members]
+        n = n_a + n_b
+        delta = part_mean - mean[members]
+        mean[members] += delta * n_b / n
+        m2[members] += part_m2 + delta ** 2 * n_a * n_b / n
+        count[members] = n
+        total[members] += part_total[present]
+
+        if not extrema or not members.size:
+            continue
+        r0, r1, c0, c1 = r0[present], r1[present], c0[present], c1[present]
+        shapes = np.stack([r1 - r0, c1 - c0], axis=1)
+        levels = int(shapes.min(axis=1).max()).bit_length()
+        for ufunc, fill, result in extrema:
+            tables = _square_tables(np.where(valid, values, fill), ufunc, levels)
+            # windows of the same shape are answered together
+            for window_shape in np.unique(shapes, axis=0):
+                same = (shapes == window_shape).all(axis=1)
+                found = _window_extrema(tables, ufunc, r0[same], r1[same],
+                                        c0[same], c1[same])
+                result[members[same]] = ufunc(result[members[same]], found)
+
+    rect_stats = [
+        _moment_stats(stats, count[j], total[j], m2[j], vmin[j], vmax[j],
+                      nodata_count[j], nan_count[j]) for j in range(size)]
+    other_stats = gen_sweep_zonal_stats(
+        [features_list[i] for i in others], rast, stats,
+        all_touched=all_touched, tile_size=tile_size)
+    rect_stats = iter(rect_stats)
+    for window in windows:
+        yield next(rect_stats) if window is not None else next(other_stats)
@@ -15,6 +15,7 @@ try:
 except:
     from shapely.geos import ReadingError
 from shapely import wkt, wkb
+from collections import OrderedDict
 from collections.abc import Iterable, Mapping
 
 
@@ -145,6 +146,19 @@ def bounds_window(bounds, affine):
     return (row_start, row_stop), (col_start, col_stop)
 
 
+def clamp_window(window, shape):
+    """Part of a rasterio-style window within an array of the given shape,
+    or None if they do not overlap
+    """
+    (row_start, row_stop), (col_start, col_stop) = window
+    height, width = shape[-2:]
+    row_start, row_stop = max(row_start, 0), min(row_stop, height)
+    col_start, col_stop = max(col_start, 0), min(col_stop, width)
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    return (row_start, row_stop), (col_start, col_stop)
+
+
 def window_bounds(window, affine):
     (row_start, row_stop), (col_start, col_stop) = window
     w, s = (col_start, row_stop) * affine
@@ -152,7 +166,23 @@ def window_bounds(window, affine):
     return w, s, e, n
 
 
+def tile_windows(shape, tile_size):
+    """Generate rasterio-style windows tiling an array of the given shape
+    """
+    height, width = shape[-2:]
+    for row in range(0, height, tile_size):
+        for col in range(0, width, tile_size):
+            yield ((row, min(row + tile_size, height)),
+                   (col, min(col + tile_size, width)))
+
+
 def boundless_array(arr, window, nodata, masked=False):
+    """Window of an array, padded with nodata where it extends beyond it
+
+    Windows within the array are returned as views of it, windows padded
+    with nodata are of the array's dtype unless it can't hold `nodata`
+    (see ``fill_dtype``).
+    """
     dim3 = False
     if len(arr.shape) == 3:
         dim3 = True
@@ -175,8 +205,15 @@ def boundless_array(arr, window, nodata, masked=False):
     else:
         window_shape = (wr_stop - wr_start, wc_stop - wc_start)
 
-    # create an array of nodata values
-    out = np.ones(shape=window_shape) * nodata
+    if overlap_shape == window_shape[-2:]:
+        # within the array, no need for a copy
+        out = arr[..., wr_start:wr_stop, wc_start:wc_stop]
+        if masked:
+            out = np.ma.MaskedArray(out, mask=(out == nodata))
+        return out
+
+    # create an array of nodata values, in a dtype holding both
+    out = np.full(window_shape, nodata, dtype=fill_dtype(arr.dtype, nodata))
 
     # Fill with data where overlapping
     nr_start = olr_start - wr_start
@@ -196,6 +233,88 @@ def boundless_array(arr, window, nodata, masked=False):
     return out
 
 
+def _window_nbytes(rows, cols, dtype):
+    """Size in bytes of the window bounding the pixels (rows, cols)"""
+    return (int(rows.max() - rows.min()) + 1) * \
+        (int(cols.max() - cols.min()) + 1) * np.dtype(dtype).itemsize
+
+
+def fill_dtype(dtype, nodata):
+    """ The dtype needed to hold values of `dtype` alongside `nodata` fill values
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind in 'fc':
+        if np.isnan(nodata):
+            return dtype
+        return np.promote_types(dtype, np.min_scalar_type(nodata))
+    if float(nodata).is_integer() and abs(nodata) < 2 ** 63:
+        return np.promote_types(dtype, np.min_scalar_type(int(nodata)))
+    # avoid float16, which can't sum much of anything
+    return np.promote_types(dtype, np.float32)
+
+
+class BlockCache(object):
+    """ Least recently used cache of decoded raster blocks
+
+    Parameters
+    ----------
+    max_bytes: int
+        Memory budget; least recently used blocks are evicted to stay below it
+
+    Attributes
+    ----------
+    hits, misses: int
+        Number of block lookups served from / missing in the cache
+    nbytes: int
+        Memory currently held by cached blocks
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._blocks = OrderedDict()
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def get(self, key, read):
+        """ Return the block for `key`, calling `read()` to decode it on a miss
+        """
+        block = self._blocks.get(key)
+        if block is not None:
+            self.hits += 1
+            # most recently used last (OrderedDict.move_to_end is python 3)
+            self._blocks[key] = self._blocks.pop(key)
+            return block
+
+        self.misses += 1
+        block = read()
+        if block.nbytes <= self.max_bytes:
+            self._blocks[key] = block
+            self.nbytes += block.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._blocks.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+        return block
+
+    def clear(self):
+        self._blocks.clear()
+        self.nbytes = 0
+
+
+def band_indexes(band, count):
+    """ List of the band numbers (counting from 1) selected by `band`, an
+    int, a list of ints or a slice over the `count` bands
+    """
+    if isinstance(band, slice):
+        return list(range(1, count + 1))[band]
+    if isinstance(band, (list, tuple, np.ndarray)):
+        return [int(b) for b in band]
+    return [band]
+
+
 class Raster(object):
     """ Raster abstraction for data access to 2/3D array-like things
 
@@ -220,15 +339,27 @@ class Raster(object):
     band: integer
         raster band number, optional (default: 1)
 
+    cache_size: integer
+        Memory budget in bytes for caching decoded blocks of a rasterio
+        source, optional. Windows are then assembled from cached blocks so
+        neighbouring reads don't decode the same blocks again; see the
+        ``cache`` attribute (a ``BlockCache``) for hit and miss counts.
+        Ignored for ndarrays.
+
     Methods
     -------
     index
     read
+    sample
+    close
     """
 
-    def __init__(self, raster, affine=None, nodata=None, band=1):
+    def __init__(self, raster, affine=None, nodata=None, band=1, cache_size=None):
         self.array = None
         self.src = None
+        self.cache = None
+        self._buffer = None
+        self.band = band
 
         if isinstance(raster, np.ndarray):
             if affine is None:
@@ -241,7 +372,6 @@ class Raster(object):
             self.src = rasterio.open(raster, 'r')
             self.affine = guard_transform(self.src.transform)
             self.shape = (self.src.height, self.src.width)
-            self.band = band
 
             if nodata is not None:
                 # override with specified nodata
@@ -249,13 +379,17 @@ class Raster(object):
             else:
                 self.nodata = self.src.nodata
 
+            if cache_size:
+                self.cache = BlockCache(cache_size)
+                self.block_shape = self.src.block_shapes[band - 1]
+
     def index(self, x, y):
         """ Given (x, y) in crs, return the (row, column) on the raster
         """
         col, row = [math.floor(a) for a in (~self.affine * (x, y))]
         return row, col
 
-    def read(self, bounds=None, window=None, masked=False):
+    def read(self, bounds=None, window=None, masked=False, reuse_buffer=False):
         """ Performs a boundless read against the underlying array source
 
         Parameters
@@ -268,6 +402,11 @@ class Raster(object):
         masked: boolean
             return a masked numpy array, default: False
             bounds OR window are required, specifying both or neither will raise exception
+        reuse_buffer: boolean
+            read windows within a rasterio dataset (without a cache) into a
+            buffer kept by this Raster, rather than a new array. The array
+            is then only valid until the next read reusing the buffer.
+            default: False
 
         Returns
         -------
@@ -297,17 +436,211 @@ class Raster(object):
             # It's an ndarray already
             new_array = boundless_array(
                 self.array, window=win, nodata=nodata, masked=masked)
+        elif self.cache is not None:
+            # It's an open rasterio dataset, read through the block cache
+            new_array = self._read_cached(win, nodata, masked=masked)
         elif self.src:
             # It's an open rasterio dataset
-            new_array = self.src.read(
-                self.band, window=win, boundless=True, masked=masked)
+            new_array = self._read_window(
+                win, nodata, masked=masked, reuse_buffer=reuse_buffer)
 
         return Raster(new_array, new_affine, nodata)
 
+    def sample(self, rows, cols, max_bytes=None, bands=None):
+        """ Values of the pixels at (rows, cols), as a masked array
+
+        Pixels beyond the raster or equal to nodata are masked. The pixels
+        of a rasterio dataset are read with a single read of their bounding
+        window if it fits in `max_bytes`, otherwise block by block, each
+        block touched by the pixels being read once (or through the block
+        cache).
+
+        Parameters
+        ----------
+        rows, cols: 1d integer arrays of pixel indices
+        max_bytes: int, optional
+            Memory budget of the bounding window read, ignored with a block
+            cache. defaults to `None`, always read by blocks
+        bands: list of int, optional
+            Read these bands (counting from 1, along the first axis of 3D
+            arrays) at once, rather than the band of the Raster.
+
+        Returns
+        -------
+        1d masked array of the pixel values, or 2d (pixels, bands) if
+        `bands` is given
+        """
+        rows = np.asarray(rows, dtype='int64')
+        cols = np.asarray(cols, dtype='int64')
+        inside = (rows >= 0) & (rows < self.shape[-2]) & \
+            (cols >= 0) & (cols < self.shape[-1])
+
+        indexes = [self.band] if bands is None else list(bands)
+        if bands is not None:
+            count = self.src.count if self.array is None else \
+                self.array.shape[0] if self.array.ndim == 3 else 1
+            if min(indexes) < 1 or max(indexes) > count:
+                raise ValueError("band numbers must be between 1 and "
+                                 "{0}".format(count))
+
+        if self.array is not None:
+            arr = self.array
+            if arr.ndim == 2 and bands is None:
+                values = np.zeros(rows.shape, dtype=arr.dtype)
+                values[inside] = arr[rows[inside], cols[inside]]
+                return self._mask_values(values, inside)
+            if arr.ndim == 2:
+                arr = arr[np.newaxis]
+            values = np.zeros(rows.shape + (len(indexes),), dtype=arr.dtype)
+            values[inside] = arr[np.asarray(indexes)[:, np.newaxis] - 1,
+                                 rows[inside], cols[inside]].T
+            if bands is None:
+                values = values[:, 0]
+            return self._mask_values(values, inside)
+
+        dtype = np.result_type(*[self.src.dtypes[i - 1] for i in indexes])
+        values = np.zeros(rows.shape + (len(indexes),), dtype=dtype)
+        use_cache = self.cache is not None and bands is None
+        if inside.any() and not use_cache and max_bytes is not None and \
+                _window_nbytes(rows[inside], cols[inside], dtype) * \
+                len(indexes) <= max_bytes:
+            row_start, col_start = rows[inside].min(), cols[inside].min()
+            window = ((row_start, rows[inside].max() + 1),
+                      (col_start, cols[inside].max() + 1))
+            region = self.src.read(indexes, window=window)
+            values[inside] = region[:, rows[inside] - row_start,
+                                    cols[inside] - col_start].T
+        else:
+            block_height, block_width = self.block_shape if use_cache \
+                else self.src.block_shapes[indexes[0] - 1]
+            blocks_per_row = -(-self.shape[1] // block_width)
+            index = np.flatnonzero(inside)
+            keys = (rows[index] // block_height) * blocks_per_row + \
+                cols[index] // block_width
+            order = np.argsort(keys, kind='mergesort')
+            index, keys = index[order], keys[order]
+            starts = np.flatnonzero(np.diff(keys, prepend=-1))
+            for start, stop in zip(starts, np.append(starts[1:], keys.size)):
+                block_row, block_col = divmod(int(keys[start]), blocks_per_row)
+                if use_cache:
+                    block = self.cache.get(
+                        (block_row, block_col),
+                        lambda: self._read_block(block_row, block_col))[np.newaxis]
+                else:
+                    window = ((block_row * block_height,
+                               min((block_row + 1) * block_height, self.shape[0])),
+                              (block_col * block_width,
+                               min((block_col + 1) * block_width, self.shape[1])))
+                    block = self.src.read(indexes, window=window)
+                pixels = index[start:stop]
+                values[pixels] = block[:, rows[pixels] - block_row * block_height,
+                                       cols[pixels] - block_col * block_width].T
+
+        if bands is None:
+            values = values[:, 0]
+        return self._mask_values(values, inside)
+
+    def _mask_values(self, values, inside):
+        mask = ~inside if values.ndim == 1 else \
+            np.repeat(~inside[:, np.newaxis], values.shape[1], axis=1)
+        if self.nodata is not None:
+            mask |= values == self.nodata
+        return np.ma.MaskedArray(values, mask=mask)
+
+    def _read_window(self, window, nodata, masked=False, reuse_buffer=False):
+        """ Plain windowed read, padded with nodata where the window extends
+        beyond the dataset instead of a (much slower) boundless read
+        """
+        (wr_start, wr_stop), (wc_start, wc_stop) = window
+        shape = (wr_stop - wr_start, wc_stop - wc_start)
+        overlap = clamp_window(window, self.shape)
+
+        if overlap == window:
+            out = None
+            if reuse_buffer and not masked:
+                dtype = self.src.dtypes[self.band - 1]
+                size = shape[0] * shape[1]
+                if self._buffer is None or self._buffer.size < size or \
+                        self._buffer.dtype != dtype:
+                    self._buffer = np.empty(size, dtype=dtype)
+                out = self._buffer[:size].reshape(shape)
+            return self.src.read(self.band, window=window, masked=masked,
+                                 out=out)
+
+        dtype = fill_dtype(self.src.dtypes[self.band - 1], nodata)
+        out = np.full(shape, nodata, dtype=dtype)
+        mask = np.ones(shape, dtype=bool)
+        if overlap is not None:
+            (r_start, r_stop), (c_start, c_stop) = overlap
+            inner = (slice(r_start - wr_start, r_stop - wr_start),
+                     slice(c_start - wc_start, c_stop - wc_start))
+            data = self.src.read(self.band, window=overlap, masked=masked)
+            out[inner] = np.ma.getdata(data)
+            mask[inner] = np.ma.getmaskarray(data)
+
+        if masked:
+            out = np.ma.MaskedArray(out, mask=mask)
+
+        return out
+
+    def _read_block(self, block_row, block_col):
+        block_height, block_width = self.block_shape
+        row_start = block_row * block_height
+        col_start = block_col * block_width
+        window = ((row_start, min(row_start + block_height, self.shape[0])),
+                  (col_start, min(col_start + block_width, self.shape[1])))
+        return self.src.read(self.band, window=window)
+
+    def _read_cached(self, window, nodata, masked=False):
+        """ Assemble a boundless window from cached blocks
+        """
+        (wr_start, wr_stop), (wc_start, wc_stop) = window
+        dtype = fill_dtype(self.src.dtypes[self.band - 1], nodata)
+        out = np.full((wr_stop - wr_start, wc_stop - wc_start), nodata, dtype=dtype)
+
+        # overlap of the window with the dataset
+        olr_start, olr_stop = max(wr_start, 0), min(wr_stop, self.shape[0])
+        olc_start, olc_stop = max(wc_start, 0), min(wc_stop, self.shape[1])
+
+        if olr_start >= olr_stop or olc_start >= olc_stop:
+            # entirely outside of the dataset
+            block_rows = block_cols = []
+        else:
+            block_height, block_width = self.block_shape
+            block_rows = range(olr_start // block_height,
+                               (olr_stop - 1) // block_height + 1)
+            block_cols = range(olc_start // block_width,
+                               (olc_stop - 1) // block_width + 1)
+
+        for block_row in block_rows:
+            br_start = block_row * block_height
+            r_start = max(olr_start, br_start)
+            r_stop = min(olr_stop, br_start + block_height)
+            for block_col in block_cols:
+                bc_start = block_col * block_width
+                c_start = max(olc_start, bc_start)
+                c_stop = min(olc_stop, bc_start + block_width)
+
+                block = self.cache.get(
+                    (block_row, block_col),
+                    lambda: self._read_block(block_row, block_col))
+                out[r_start - wr_start:r_stop - wr_start,
+                    c_start - wc_start:c_stop - wc_start] = \
+                    block[r_start - br_start:r_stop - br_start,
+                          c_start - bc_start:c_stop - bc_start]
+
+        if masked:
+            out = np.ma.MaskedArray(out, mask=(out == nodata))
+
+        return out
+
     def __enter__(self):
         return self
 
-    def __exit__(self, *args):
+    def close(self):
         if self.src is not None:
             # close the rasterio reader
             self.src.close()
+
+    def __exit__(self, *args):
+        self.close()
@@ -3,15 +3,24 @@ from __future__ import absolute_import
 from __future__ import division
 import numpy as np
 import warnings
-from copy import copy
+from contextlib import contextmanager
+from itertools import chain
 from affine import Affine
 from . import io
 from shapely.geometry import shape
-from .io import read_features, Raster
-from .utils import (rasterize_geom, get_percentile, check_stats,
-                    remap_categories, key_assoc_val, boxify_points,
-                    rasterize_pctcover_geom, get_latitude_scale,
-                    split_geom, VALID_STATS)
+from .io import read_features, Raster, bounds_window, clamp_window
+from .accumulators import StatsAccumulator
+from .engines import (gen_label_zonal_stats, gen_sweep_zonal_stats,
+                      gen_grid_zonal_stats, _moment_stats, LABEL_STATS,
+                      GRID_STATS, DEFAULT_TILE_SIZE)
+from .pyramid import AggregatePyramid, gen_pyramid_zonal_stats, PYRAMID_STATS
+from .utils import (rasterize_geom, get_quantiles, check_stats,
+                    value_counts, category_lookup, category_counts,
+                    boxify_points, group_parts, PART_GROUP_MIN_PIXELS,
+                    block_aggregates,
+                    rasterize_cover_geom, get_latitude_scale,
+                    PERCENT_COVER_METHODS,
+                    split_geom, gen_spatially_ordered, SPATIAL_ORDERS)
 
 
 def get_coverage(vector, da, dim='time', method='sum', **kwargs):
@@ -56,6 +65,9 @@ def zonal_stats_timeseries(da, method='sum', return_coverage=False, coverage=Non
 
 
 
+ENGINES = ['feature', 'label', 'sweep', 'grid']
+
+
 def raster_stats(*args, **kwargs):
     """Deprecated. Use zonal_stats instead."""
     warnings.warn("'raster_stats' is an alias to 'zonal_stats'"
@@ -86,6 +98,7 @@ def gen_zonal_stats(
         percent_cover_selection=None,
         percent_cover_weighting=False,
         percent_cover_scale=None,
+        percent_cover_method='supersample',
         limit=None,
         categorical=False,
         category_map=None,
@@ -93,15 +106,22 @@ def gen_zonal_stats(
         zone_func=None,
         raster_out=False,
         prefix=None,
-        geojson_out=False, **kwargs):
+        geojson_out=False,
+        n_jobs=1,
+        executor=None,
+        cache_size=None,
+        order=None,
+        engine='feature',
+        pyramid=None, **kwargs):
     """Zonal statistics of raster values aggregated to vector geometries.
 
     Parameters
     ----------
     vectors: path to an vector source or geo-like python objects
 
-    raster: ndarray or path to a GDAL raster source
+    raster: ndarray, path to a GDAL raster source or open ``io.Raster``
         If ndarray is passed, the ``affine`` kwarg is required.
+        An open ``Raster`` is used as is and left open.
 
     layer: int or string, optional
         If `vectors` is a path to an fiona source,
@@ -164,12 +184,26 @@ def gen_zonal_stats(
         Values (e.g., percent_cover_scale=10) are often sufficient
         (<10% edge cell error) and require far less memory and time to run.
 
+    percent_cover_method: str, optional
+        How percent coverage is computed, one of
+        ``utils.PERCENT_COVER_METHODS``. 'supersample' rasterizes the
+        feature at `percent_cover_scale` times the raster resolution.
+        'edge' gives the same coverage but only supersamples the cells
+        crossed by the boundary of polygons, using much less memory for
+        large features or scales.
+        'exact' computes the exact area of each cell covered by polygons
+        from their edges, at a cost that does not depend on any scale;
+        `percent_cover_scale` then only applies to lines, a value given
+        for polygons is ignored with a warning.
+        defaults to 'supersample'
+
     limit: int
         maximum number of pixels allowed to be read from raster based on
         feature bounds. Geometries which will result in reading a larger
         number of pixels will be split into smaller geometries and then
-        aggregated (note: some stats and options cannot be used along with
-        `limit`. Useful when dealing with vector data containing
+        aggregated (note: `add_stats` and `raster_out` cannot be used along
+        with `limit`, all other stats are merged exactly over the split
+        geometries). Useful when dealing with vector data containing
         large features and raster with a fine resolution to prevent
         memory errors. If the limit value is None (default) or 0
         geometries will never be split. Using the `limit` option without
@@ -177,7 +211,16 @@ def gen_zonal_stats(
         accurate statistics due to generating additional polygon edges when
         splitting geometries. When using percent_cover_scale of 10, a limit
         of 5 million pixels is generally reasonably quick and should run
-        with <4GB of RAM.
+        with <4GB of RAM. The limit bounds the pixels read at once, not the
+        memory of the stats: `median`, `percentile_*`, `majority`,
+        `minority`, `unique` and `categorical` keep a count of each distinct
+        value of the feature, which on float rasters can approach one entry
+        per pixel.
+        Independently of `limit`, multipart geometries whose parts are
+        far apart (e.g. scattered islands) are read by groups of nearby
+        parts rather than over their whole bounding box, unless
+        `zone_func`, `add_stats` or `raster_out` is used (see
+        ``utils.group_parts``).
 
     categorical: bool, optional
 
@@ -208,6 +251,69 @@ def gen_zonal_stats(
         with zonal stats appended as additional properties.
         Use with `prefix` to ensure unique and meaningful property names.
 
+    n_jobs: int, optional
+        Number of worker processes used to compute the statistics.
+        Each worker opens the raster once and is sent the features in
+        small batches; results are still generated in input order.
+        Values below 1 use all available cores. `add_stats` and
+        `zone_func` must then be picklable (i.e. not lambdas).
+        defaults to 1, i.e. no parallelism
+
+    executor: concurrent.futures.Executor, optional
+        Run the batches on this executor (e.g. a ``ThreadPoolExecutor``
+        or a distributed executor) instead of a new process pool.
+        `n_jobs` then only bounds the number of batches in flight.
+
+    cache_size: int, optional
+        Memory budget in bytes for caching decoded raster blocks so that
+        neighbouring features don't decode the same blocks over and over.
+        Only applies to rasterio sources; with `n_jobs`, each worker
+        gets a cache of this size.
+        defaults to `None`, no caching
+
+    order: string, optional
+        Process the features along a space filling curve ('hilbert' or
+        'zorder') through their bounding box centers rather than in input
+        order, so that neighbouring features reuse the same raster blocks
+        (see `cache_size`). Features are sorted in buffers of
+        ``utils.ORDER_BUFFER_SIZE`` and results are still generated in
+        input order.
+        defaults to `None`, input order
+
+    engine: string, optional
+        'feature' reads and rasterizes a window per feature.
+        'label' is meant for sets of non-overlapping features (e.g.
+        administrative boundaries): all features are burned into one
+        integer label raster, tile by tile, and the statistics of every
+        feature are computed with grouped reductions in a single pass over
+        the raster. It supports the stats in ``engines.LABEL_STATS`` and
+        neither `limit`, percent cover, `latitude_correction`,
+        `categorical`, `add_stats`, `zone_func`, `raster_out` nor `n_jobs`.
+        Where features overlap, pixels count towards the last one.
+        'sweep' walks the raster once, tile by tile, and updates the
+        statistics of the features intersecting each tile, emitting a
+        feature once all of its tiles are done. Features may overlap.
+        It bounds reads to a single pass over huge rasters covered by many
+        small features, supports all stats and `categorical` and has
+        otherwise the same restrictions as 'label'.
+        'grid' is meant for fishnet grids and bounding boxes: features
+        that are rectangles with their edges on pixel edges are answered
+        from summed-area and sparse tables computed once per raster tile,
+        without rasterizing them. Other features go through the 'sweep'
+        engine. It supports the stats in ``engines.GRID_STATS`` and has
+        the same restrictions as 'label'.
+        defaults to 'feature'
+
+    pyramid: ``pyramid.AggregatePyramid`` or str, optional
+        Aggregate pyramid of the raster, or the path of the .npz file it was
+        saved to (see ``pyramid.build_pyramid``). Blocks of pixels lying
+        entirely within a feature are then taken from the pyramid and only
+        the pixels along the boundary of the feature are read, which makes
+        very large features much cheaper. Supports the stats in
+        ``pyramid.PYRAMID_STATS`` and has the same restrictions as the
+        'label' engine.
+        defaults to `None`
+
     Returns
     -------
     generator of dicts (if geojson_out is False)
@@ -217,7 +323,11 @@ def gen_zonal_stats(
     generator of geojson features (if geojson_out is True)
         GeoJSON-like Feature as python dict
     """
-    stats, run_count = check_stats(stats, categorical)
+    stats, plan = check_stats(stats, categorical)
+    requested_stats = stats
+
+    if engine not in ENGINES:
+        raise ValueError("engine must be one of {0}".format(ENGINES))
 
     # Handle 1.0 deprecations
     transform = kwargs.get('transform')
@@ -252,34 +362,31 @@ def gen_zonal_stats(
         except ValueError:
             raise ValueError('`limit` must be a number (Input: {0}, {1})'.format(type(limit), limit))
 
-        invalid_limit_stats = [
-            'minority', 'majority', 'median', 'std', 'unique'
-        ] + [s for s in stats if s.startswith('percentile_')]
-
-        invalid_limit_conditions = (
-            any([i in invalid_limit_stats for i in stats])
-            or add_stats is not None
-            or raster_out
-        )
-        if invalid_limit_conditions:
+        # the stats of the sub geometries are merged with accumulators,
+        # arbitrary functions and arrays can't be
+        if add_stats is not None or raster_out:
             raise Exception("Cannot use `limit` to split geometries when using "
                             "`add_stats` or `raster_out` options")
 
-        # need count for sub geoms to calculate weighted mean
-        use_temp_count = False
-        if 'mean' in stats and not 'count' in stats:
-            use_temp_count = True
-            stats.append('count')
-
 
     # -------------------------------------------------------------------------
     # check inputs related to percent coverage
     percent_cover = False
     if percent_cover_weighting or percent_cover_selection is not None:
         percent_cover = True
+        if percent_cover_method not in PERCENT_COVER_METHODS:
+            raise ValueError('`percent_cover_method` must be one of {0}'.format(
+                PERCENT_COVER_METHODS))
+
+        if percent_cover_method == 'exact' and percent_cover_scale is not None:
+            # exact coverage of polygons needs no scale, lines still do
+            warnings.warn('`percent_cover_scale` is ignored for polygons with '
+                          'percent_cover_method=\'exact\', it only applies '
+                          'to lines.')
         if percent_cover_scale is None:
-            warnings.warn('No value for `percent_cover_scale` was given. '
-                          'Using default value of 10.')
+            if percent_cover_method != 'exact':
+                warnings.warn('No value for `percent_cover_scale` was given. '
+                              'Using default value of 10.')
             percent_cover_scale = 10
 
         if percent_cover_scale > 1000:
@@ -315,7 +422,7 @@ def gen_zonal_stats(
                                  'provided ({0}). Must be able to be converted '
                                  'to a float.'.format(percent_cover_selection))
 
-        if not all_touched:
+        if not all_touched and percent_cover_method != 'exact':
             warnings.warn('The `all_touched` was not enabled, but an option '
                           'requiring percent_cover calculations was selected. '
                           'We suggest enabling `all_touched` when using '
@@ -323,7 +430,119 @@ def gen_zonal_stats(
                           '`percent_cover_selection`.')
 
 
-    with Raster(raster, affine, nodata, band) as rast:
+    options = dict(
+        stats=requested_stats,
+        all_touched=all_touched,
+        latitude_correction=latitude_correction,
+        percent_cover_selection=percent_cover_selection,
+        percent_cover_weighting=percent_cover_weighting,
+        percent_cover_scale=percent_cover_scale,
+        percent_cover_method=percent_cover_method,
+        limit=limit,
+        categorical=categorical,
+        category_map=category_map,
+        add_stats=add_stats,
+        zone_func=zone_func,
+        raster_out=raster_out,
+        prefix=prefix,
+        geojson_out=geojson_out)
+
+    if pyramid is not None and engine != 'feature':
+        raise ValueError("A pyramid can only be used by the feature engine")
+
+    if engine in ('label', 'sweep', 'grid') or pyramid is not None:
+        unsupported = [name for name, value in [
+            ('limit', limit is not None),
+            ('percent_cover_weighting', percent_cover_weighting),
+            ('percent_cover_selection', percent_cover_selection is not None),
+            ('latitude_correction', latitude_correction),
+            ('categorical', categorical and engine != 'sweep'),
+            ('add_stats', add_stats is not None),
+            ('zone_func', zone_func is not None),
+            ('raster_out', raster_out),
+            ('n_jobs', n_jobs != 1 or executor is not None)] if value]
+        if engine == 'label':
+            unsupported += [s for s in stats if s not in LABEL_STATS]
+        elif engine == 'grid':
+            unsupported += [s for s in stats if s not in GRID_STATS]
+        elif pyramid is not None:
+            unsupported += [s for s in stats if s not in PYRAMID_STATS]
+        if unsupported:
+            raise ValueError("{0} does not support: {1}".format(
+                'The pyramid' if pyramid is not None
+                else 'The {0} engine'.format(engine), ', '.join(unsupported)))
+
+        features_list = list(read_features(vectors, layer))
+        with _open_raster(raster, affine, nodata, band, cache_size) as rast:
+            if pyramid is not None:
+                if not isinstance(pyramid, AggregatePyramid):
+                    pyramid = AggregatePyramid.load(pyramid)
+                engine_stats = gen_pyramid_zonal_stats(
+                    features_list, rast, pyramid, stats,
+                    all_touched=all_touched)
+            elif engine == 'label':
+                engine_stats = gen_label_zonal_stats(
+                    features_list, rast, stats, all_touched=all_touched)
+            elif engine == 'grid':
+                engine_stats = gen_grid_zonal_stats(
+                    features_list, rast, stats, all_touched=all_touched)
+            else:
+                engine_stats = gen_sweep_zonal_stats(
+                    features_list, rast, stats, all_touched=all_touched,
+                    categorical=categorical, category_map=category_map)
+            for feat, feature_stats in zip(features_list, engine_stats):
+                yield _format_output(feat, feature_stats, prefix, geojson_out)
+        return
+
+    if order is not None:
+        if order not in SPATIAL_ORDERS:
+            raise ValueError("order must be one of {0}".format(SPATIAL_ORDERS))
+
+        def process(features):
+            return gen_zonal_stats(
+                features, raster, band=band, nodata=nodata, affine=affine,
+                n_jobs=n_jobs, executor=executor, cache_size=cache_size,
+                **options)
+
+        for res in gen_spatially_ordered(
+                process, read_features(vectors, layer), order):
+            yield res
+        return
+
+    if n_jobs != 1 or executor is not None:
+        if isinstance(raster, Raster):
+            raise ValueError("An open Raster can not be shared with workers; "
+                             "pass the path or ndarray instead")
+        # imported here, concurrent.futures is only needed to run in parallel
+        from .parallel import gen_parallel_zonal_stats
+        for res in gen_parallel_zonal_stats(
+                read_features(vectors, layer),
+                (raster, affine, nodata, band, cache_size),
+                options, n_jobs=n_jobs, executor=executor):
+            yield res
+        return
+
+    # names of integer categories, looked up by array indexing
+    categories = category_lookup(category_map) if categorical else None
+
+    # the whole zone is needed by these, otherwise sparse multipart geometries
+    # are read by groups of parts and windows are clamped to the raster
+    whole_zone = zone_func is not None or add_stats is not None or raster_out
+
+    def rasterize_zone(geom, shape, affine):
+        """Coverage weights (or None) and boolean zone of geom"""
+        if percent_cover:
+            cover_weights = rasterize_cover_geom(
+                geom, shape=shape, affine=affine,
+                method=percent_cover_method,
+                scale=percent_cover_scale,
+                all_touched=all_touched)
+            return cover_weights, cover_weights > (percent_cover_selection or 0)
+        return None, rasterize_geom(geom, shape=shape, affine=affine,
+                                    all_touched=all_touched)
+
+    with _open_raster(raster, affine, nodata, band, cache_size) as rast:
+        pixel_width, pixel_height = abs(rast.affine[0]), abs(rast.affine[4])
         features_iter = read_features(vectors, layer)
         for _, feat in enumerate(features_iter):
             geom = shape(feat['geometry'])
@@ -336,58 +555,97 @@ def gen_zonal_stats(
             # -----------------------------------------------------------------
             # build geom_list (split geoms if needed)
 
-            if limit is None:
-                geom_list = [geom]
+            # sparse multipart geometries are read and rasterized by groups
+            # of nearby parts rather than over their whole bounding box
+            if not whole_zone:
+                parts = group_parts(
+                    geom, min_gap=2 * max(pixel_width, pixel_height),
+                    min_area=PART_GROUP_MIN_PIXELS * pixel_width * pixel_height)
+            else:
+                parts = [geom]
+
+            accumulator = None
+            if limit is None and len(parts) == 1:
+                geom_list = parts
 
             else:
-                pixel_size = rast.affine[0]
-                origin = (rast.affine[2], rast.affine[5])
-                geom_list = split_geom(geom, limit, pixel_size, origin=origin)
+                if limit is None:
+                    geom_list = parts
+                else:
+                    pixel_size = rast.affine[0]
+                    origin = (rast.affine[2], rast.affine[5])
+                    geom_list = chain.from_iterable(
+                        split_geom(part, limit, pixel_size, origin=origin)
+                        for part in parts)
+                accumulator = StatsAccumulator(stats, categorical, category_map)
 
 
             # -----------------------------------------------------------------
             # run sub geom extracts
 
-            for ix, sub_geom_box in enumerate(geom_list):
-
-                sub_geom_bounds = tuple(sub_geom_box.bounds)
-
-                fsrc = rast.read(bounds=sub_geom_bounds)
+            for ix, sub_geom in enumerate(geom_list):
+
+                sub_geom_bounds = tuple(sub_geom.bounds)
+
+                # pixels outside of the raster are nodata, only the part of
+                # the window within the raster is read
+                window = bounds_window(sub_geom_bounds, rast.affine)
+                read_window = window if whole_zone \
+                    else clamp_window(window, rast.shape)
+
+                outside_count = 0
+                if read_window != window and 'nodata' in stats:
+                    (row_start, row_stop), (col_start, col_stop) = window
+                    _, outside = rasterize_zone(
+                        sub_geom, (row_stop - row_start, col_stop - col_start),
+                        rast.affine * Affine.translation(col_start, row_start))
+                    if read_window is not None:
+                        (r_start, r_stop), (c_start, c_stop) = read_window
+                        outside[r_start - row_start:r_stop - row_start,
+                                c_start - col_start:c_stop - col_start] = False
+                    outside_count = int(outside.sum())
+
+                if read_window is None:
+                    # entirely outside of the raster, nothing to read
+                    if accumulator is None:
+                        accumulator = StatsAccumulator(
+                            stats, categorical, category_map)
+                    accumulator.update(np.empty(0), nodata=outside_count)
+                    continue
+
+                # raster_out hands the array out, otherwise it is only
+                # used until the next read
+                fsrc = rast.read(window=read_window, reuse_buffer=not raster_out)
                 
 
-                # rasterized geometry
-                if percent_cover:
-                    cover_weights = rasterize_pctcover_geom(
-                        geom, shape=fsrc.shape, affine=fsrc.affine,
-                        scale=percent_cover_scale,
-                        all_touched=all_touched)
-                    rv_array = cover_weights > (percent_cover_selection or 0)
-                else:
-                    rv_array = rasterize_geom(
-                        geom, shape=fsrc.shape, affine=fsrc.affine,
-                        all_touched=all_touched)
+                # rasterized geometry, split geometries are clipped to
+                # their window so rasterizing them is cheap
+                cover_weights, rv_array = rasterize_zone(
+                    sub_geom, fsrc.shape, fsrc.affine)
 
 
-                # nodata mask
+                # nodata mask, and nan mask for float rasters
                 isnodata = (fsrc.array == fsrc.nodata)
+                isnan = None
+                if np.issubdtype(fsrc.array.dtype, np.floating):
+                    isnan = np.isnan(fsrc.array)
+
+                # everything that is a valid value within our geom
+                valid = rv_array & ~isnodata
+                if isnan is not None:
+                    valid &= ~isnan
+
+                # zone_func, add_stats and raster_out take the zone as a
+                # masked array, other stats don't need one
+                masked = None
+                if zone_func is not None or add_stats is not None or raster_out:
+                    if rast.array is not None and \
+                            np.may_share_memory(fsrc.array, rast.array):
+                        # a view of an ndarray raster, which zone_func may
+                        # modify and raster_out hands out
+                        fsrc.array = fsrc.array.copy()
+                    masked = np.ma.MaskedArray(fsrc.array, mask=~valid)
 
-                # add nan mask (if necessary)
-                has_nan = (np.issubdtype(fsrc.array.dtype, float)
-                    and np.isnan(fsrc.array.min()))
-                if has_nan:
-                    isnodata = (isnodata | np.isnan(fsrc.array))
-
-                # Mask the source data array
-                # mask everything that is not a valid value or not within our geom
-
-                masked = np.ma.MaskedArray(
-                    fsrc.array,
-                    mask=(isnodata | ~rv_array))
-                
-                if fsrc.array.shape[0]>200000:
-                    print(fsrc.array)
-                    
-                    assert False
                 # execute zone_func on masked zone ndarray
                 if zone_func is not None:
                     if not callable(zone_func):
@@ -395,104 +653,126 @@ def gen_zonal_stats(
                                          'which accepts function a '
                                          'single `zone_array` arg.'))
                     zone_func(masked)
+                    # values and mask may have been changed in place
+                    valid = ~np.ma.getmaskarray(masked)
+
+                # the valid values, extracted once for all stats
+                values = fsrc.array[valid]
+
+                if percent_cover_weighting:
+                    weights = cover_weights[valid].astype('float64')
 
                 if latitude_correction and 'mean' in stats:
-                    latitude_scale = [
+                    latitude_scale = np.array([
                         get_latitude_scale(fsrc.affine[5] - abs(fsrc.affine[4]) * (0.5 + i))
                         for i in range(fsrc.shape[0])
-                    ]
-
-                if masked.compressed().size == 0:
+                    ])
+                    row_scale = latitude_scale[np.nonzero(valid)[0]]
+
+                nodata_count = int((rv_array & isnodata).sum()) + outside_count \
+                    if 'nodata' in stats else 0
+                nan_count = int((rv_array & isnan).sum()) \
+                    if 'nan' in stats and isnan is not None else 0
+
+                if accumulator is not None:
+                    # accumulate the sub geom, stats are computed once
+                    # all of them are merged
+                    accumulator.update(
+                        values,
+                        weights=weights if percent_cover_weighting else None,
+                        latitude_scale=row_scale if latitude_correction and 'mean' in stats else None,
+                        nodata=nodata_count, nan=nan_count)
+                    continue
+
+                if values.size == 0:
                     # nothing here, fill with None and move on
                     sub_feature_stats = dict([(stat, None) for stat in stats])
                     if 'count' in stats:  # special case, zero makes sense here
                         sub_feature_stats['count'] = 0
                 else:
-                    if run_count:
-                        keys, counts = np.unique(masked.compressed(), return_counts=True)
-                        pixel_count = dict(zip([np.asscalar(k) for k in keys],
-                                               [np.asscalar(c) for c in counts]))
+                    # each intermediate is computed once, see utils.plan_stats
+                    if plan.value_counts:
+                        # sorted distinct values and their counts
+                        keys, counts = value_counts(values)
+                    if plan.quantiles:
+                        names, qs = zip(*plan.quantiles)
+                        if plan.value_counts:
+                            quantiles = get_quantiles(qs, keys=keys, counts=counts)
+                        else:
+                            quantiles = get_quantiles(qs, values)
 
                     if categorical:
-                        sub_feature_stats = dict(pixel_count)
-                        if category_map:
-                            sub_feature_stats = remap_categories(category_map, sub_feature_stats)
+                        sub_feature_stats = category_counts(
+                            keys, counts, category_map, categories)
                     else:
                         sub_feature_stats = {}
 
+                    if 'sum' in stats or 'mean' in stats:
+                        total = values.sum()
+
                     if 'count' in stats:
                         if percent_cover_weighting:
-                            sub_feature_stats['count'] = float(np.sum(~masked.mask * cover_weights))
+                            sub_feature_stats['count'] = float(np.sum(weights))
                         else:
-                            sub_feature_stats['count'] = int(masked.count())
+                            sub_feature_stats['count'] = int(values.size)
 
                     if 'sum' in stats:
                         if percent_cover_weighting:
-                            sub_feature_stats['sum'] = float(np.sum(masked * cover_weights))
+                            sub_feature_stats['sum'] = float(np.sum(values * weights))
                         else:
-                            sub_feature_stats['sum'] = float(masked.sum())
+                            sub_feature_stats['sum'] = float(total)
 
                     if 'mean' in stats:
                         if percent_cover_weighting and latitude_correction:
 
-                            tmp_numerator = np.sum((masked.T * latitude_scale).T * cover_weights)
-                            tmp_denominator = np.sum((~masked.mask.T * latitude_scale).T * cover_weights)
+                            tmp_numerator = np.sum(values * row_scale * weights)
+                            tmp_denominator = np.sum(row_scale * weights)
                             sub_feature_stats['mean'] = float(tmp_numerator / tmp_denominator)
-                            sub_feature_stats['latitude_correction'] = tmp_denominator / np.sum(~masked.mask * cover_weights)
 
                         elif percent_cover_weighting:
 
-                            tmp_numerator = np.sum(masked * cover_weights)
-                            tmp_denominator = np.sum(~masked.mask * cover_weights)
+                            tmp_numerator = np.sum(values * weights)
+                            tmp_denominator = np.sum(weights)
                             sub_feature_stats['mean'] = float(tmp_numerator / tmp_denominator)
 
                         elif latitude_correction:
 
-                            tmp_numerator =  np.sum((masked.T * latitude_scale).T)
-                            tmp_denominator = np.sum(np.sum(~masked.mask, axis=1) * latitude_scale)
+                            tmp_numerator = np.sum(values * row_scale)
+                            tmp_denominator = np.sum(row_scale)
                             sub_feature_stats['mean'] = float(tmp_numerator / tmp_denominator)
-                            sub_feature_stats['latitude_correction'] = tmp_denominator / np.sum(~masked.mask)
 
                         else:
-                            sub_feature_stats['mean'] = float(masked.mean())
+                            sub_feature_stats['mean'] = float(total) / values.size
 
+                    if 'min' in stats or 'range' in stats:
+                        vmin = float(values.min())
+                    if 'max' in stats or 'range' in stats:
+                        vmax = float(values.max())
                     if 'min' in stats:
-                        sub_feature_stats['min'] = float(masked.min())
+                        sub_feature_stats['min'] = vmin
                     if 'max' in stats:
-                        sub_feature_stats['max'] = float(masked.max())
+                        sub_feature_stats['max'] = vmax
                     if 'range' in stats:
-                        rmin = float(masked.min())
-                        rmax = float(masked.max())
-                        sub_feature_stats['min'] = rmin
-                        sub_feature_stats['max'] = rmax
-                        sub_feature_stats['range'] = rmax - rmin
+                        sub_feature_stats['range'] = vmax - vmin
 
                     if 'std' in stats:
-                        sub_feature_stats['std'] = float(masked.std())
-                    if 'median' in stats:
-                        sub_feature_stats['median'] = float(np.median(masked.compressed()))
+                        sub_feature_stats['std'] = float(values.std(dtype='float64'))
+                    if plan.quantiles:
+                        # median and percentile_{q}
+                        sub_feature_stats.update(zip(names, quantiles))
                     if 'majority' in stats:
-                        sub_feature_stats['majority'] = float(key_assoc_val(pixel_count, max))
+                        sub_feature_stats['majority'] = float(keys[np.argmax(counts)])
                     if 'minority' in stats:
-                        sub_feature_stats['minority'] = float(key_assoc_val(pixel_count, min))
+                        sub_feature_stats['minority'] = float(keys[np.argmin(counts)])
                     if 'unique' in stats:
-                        sub_feature_stats['unique'] = len(list(pixel_count.keys()))
-
-                    for pctile in [s for s in stats if s.startswith('percentile_')]:
-                        q = get_percentile(pctile)
-                        pctarr = masked.compressed()
-                        sub_feature_stats[pctile] = np.percentile(pctarr, q)
-
-                if 'nodata' in stats or 'nan' in stats:
-                    featmasked = np.ma.MaskedArray(fsrc.array, mask=(~rv_array))
-                    if 'nodata' in stats:
-                        nodata_match = (featmasked == fsrc.nodata)
-                        if nodata_match.count() == 0:
-                            sub_feature_stats['nodata'] = 0
-                        else:
-                            sub_feature_stats['nodata'] = float(nodata_match.sum())
-                    if 'nan' in stats:
-                        sub_feature_stats['nan'] = float(np.isnan(featmasked).sum()) if has_nan else 0
+                        sub_feature_stats['unique'] = int(keys.size)
+
+                if 'nodata' in stats:
+                    # no pixels within the geom at all: 0
+                    sub_feature_stats['nodata'] = float(nodata_count) \
+                        if nodata_count else 0
+                if 'nan' in stats:
+                    sub_feature_stats['nan'] = float(nan_count) if nan_count else 0
 
                 if add_stats is not None:
                     for stat_name, stat_func in add_stats.items():
@@ -503,92 +783,195 @@ def gen_zonal_stats(
                     sub_feature_stats['mini_raster_affine'] = fsrc.affine
                     sub_feature_stats['mini_raster_nodata'] = fsrc.nodata
                     sub_feature_stats['cover_weights'] = cover_weights
-                    sub_feature_stats['sub_geom_box'] = sub_geom_box
+                    sub_feature_stats['sub_geom_box'] = sub_geom
                     sub_feature_stats['sub_geom_bounds'] = sub_geom_bounds
                     sub_feature_stats['nodata'] = nodata
                     sub_feature_stats['band'] = band
 
 
-                # -----------------------------------------------------------------
-                # aggregate sub geom extracts
+                feature_stats = sub_feature_stats
 
-                if ix == 0:
-                    feature_stats = copy(sub_feature_stats)
-                else:
+            if accumulator is not None:
+                feature_stats = accumulator.result()
 
-                    tmp_feature_stats = copy(feature_stats)
-                    feature_stats = {}
-                    sub_feature_stats_list = [tmp_feature_stats, sub_feature_stats]
+            yield _format_output(feat, feature_stats, prefix, geojson_out)
 
-                    if 'count' in stats:
-                        feature_stats['count'] = sum([i['count'] for i in sub_feature_stats_list])
 
-                    if 'sum' in stats:
-                        vals = [i['sum'] for i in sub_feature_stats_list if 'sum' in i]
-                        feature_stats['sum'] = sum(vals) if vals else None
+def grid_stats(raster, factor=None, cell_size=None, band=1, nodata=None,
+               affine=None, stats=None, geojson_out=False,
+               tile_size=DEFAULT_TILE_SIZE):
+    """Statistics of the cells of a regular grid coarser than the raster
 
-                    if 'mean' in stats:
-                        valid_means = [i['mean'] for i in sub_feature_stats_list if i['mean'] is not None]
-                        if not valid_means:
-                            feature_stats['mean'] = None
-                        elif latitude_correction:
-                            feature_stats['latitude_correction'] = sum([i['count'] * i['latitude_correction'] for i in sub_feature_stats_list if i['count']]) / sum([i['count'] for i in sub_feature_stats_list if i['count']])
-                            feature_stats['mean'] = sum([i['mean'] * i['count'] * i['latitude_correction'] for i in sub_feature_stats_list if i['count']]) / sum([i['count'] * i['latitude_correction'] for i in sub_feature_stats_list if i['count']])
-                        else:
-                            feature_stats['mean'] = sum([i['mean'] * i['count'] for i in sub_feature_stats_list if i['count']]) / sum([i['count'] for i in sub_feature_stats_list if i['count']])
+    The same as ``zonal_stats`` of the box polygons of the cells, but
+    computed by reshaping tiles of the raster into blocks, without any
+    vector input or rasterization. The grid starts at the upper left
+    corner of the raster; cells extending beyond it count the missing
+    pixels as nodata.
 
-                    if 'min' in stats:
-                        vals = [i['min'] for i in sub_feature_stats_list if i['min'] is not None]
-                        feature_stats['min'] = min(vals) if vals else None
-                    if 'max' in stats:
-                        vals = [i['max'] for i in sub_feature_stats_list if i['max'] is not None]
-                        feature_stats['max'] = max(vals) if vals else None
-                    if 'range' in stats:
-                        min_vals = [i['min'] for i in sub_feature_stats_list if i['min'] is not None]
-                        max_vals = [i['max'] for i in sub_feature_stats_list if i['max'] is not None]
-                        rmin = min(vals) if vals else None
-                        rmax = max(vals) if vals else None
-                        feature_stats['range'] = rmax - rmin if rmin is not None else None
+    Parameters
+    ----------
+    raster, band, nodata, affine: as for ``gen_zonal_stats``
 
-                    if 'nodata' in stats:
-                        feature_stats['nodata'] = sum([i['nodata'] for i in sub_feature_stats_list])
-                    if 'nan' in stats:
-                        feature_stats['nan'] = sum([i['nan'] for i in sub_feature_stats_list])
+    factor: int or (int, int), optional
+        Size of the cells in pixels, the same or (rows, cols).
 
-                    if categorical:
-                        for sub_stats in sub_feature_stats_list:
-                            for field in sub_stats:
-                                if field not in VALID_STATS:
-                                    if field not in feature_stats:
-                                        feature_stats[field] = sub_stats[field]
-                                    else:
-                                        feature_stats[field] += sub_stats[field]
-
-
-            if ix == 0:
-                if 'range' in stats and not 'min' in stats and 'min' in feature_stats:
-                    del feature_stats['min']
-                if 'range' in stats and not 'max' in stats and 'max' in feature_stats:
-                    del feature_stats['max']
-
-            if latitude_correction and 'mean' in stats and 'latitude_correction' in feature_stats:
-                del feature_stats['latitude_correction']
-
-            if limit is not None and use_temp_count:
-                del feature_stats['count']
-
-            if prefix is not None:
-                prefixed_feature_stats = {}
-                for key, val in feature_stats.items():
-                    newkey = "{}{}".format(prefix, key)
-                    prefixed_feature_stats[newkey] = val
-                feature_stats = prefixed_feature_stats
-
-            if geojson_out:
-                for key, val in feature_stats.items():
-                    if 'properties' not in feat:
-                        feat['properties'] = {}
-                    feat['properties'][key] = val
-                yield feat
-            else:
-                yield feature_stats
+    cell_size: float or (float, float), optional
+        Size of the cells in the units of the raster, the same or
+        (width, height). Must be a multiple of the pixel size.
+        Exactly one of `factor` and `cell_size` is required.
+
+    stats: list of str, or space-delimited str, optional
+        As for ``gen_zonal_stats``, among ``engines.GRID_STATS``.
+
+    geojson_out: boolean, optional
+        Return the cells as GeoJSON-like polygon features, row by row,
+        with the stats as properties (None for cells without values).
+        defaults to `False`
+
+    tile_size: int, optional
+        Approximate size of the tiles the raster is read in, in pixels.
+
+    Returns
+    -------
+    (dict of stat name to 2d ndarray over the cells, Affine transform of
+    the grid); float stats are nan for cells without values.
+
+    generator of GeoJSON features (if geojson_out is True)
+    """
+    stats, _ = check_stats(stats, False)
+    unsupported = [stat for stat in stats if stat not in GRID_STATS]
+    if unsupported:
+        raise ValueError("grid_stats does not support: {0}".format(
+            ', '.join(unsupported)))
+    if (factor is None) == (cell_size is None):
+        raise ValueError("Specify either factor or cell_size")
+
+    with _open_raster(raster, affine, nodata, band, None) as rast:
+        if factor is None:
+            sizes = cell_size if isinstance(cell_size, (tuple, list)) \
+                else (cell_size, cell_size)
+            factors = [sizes[0] / abs(rast.affine.a),
+                       sizes[1] / abs(rast.affine.e)]
+            if any(abs(f - round(f)) > 1e-6 or round(f) < 1 for f in factors):
+                raise ValueError("cell_size must be a multiple of the pixel "
+                                 "size ({0}, {1})".format(
+                                     abs(rast.affine.a), abs(rast.affine.e)))
+            col_factor, row_factor = [int(round(f)) for f in factors]
+        else:
+            row_factor, col_factor = factor \
+                if isinstance(factor, (tuple, list)) else (factor, factor)
+            if int(row_factor) != row_factor or int(col_factor) != col_factor \
+                    or row_factor < 1 or col_factor < 1:
+                raise ValueError("factor must be a positive int")
+            row_factor, col_factor = int(row_factor), int(col_factor)
+
+        height, width = rast.shape[-2:]
+        rows = -(-height // row_factor)
+        cols = -(-width // col_factor)
+        grid_affine = rast.affine * Affine.scale(col_factor, row_factor)
+
+        aggregates = {
+            'count': np.zeros((rows, cols), dtype='int64'),
+            'total': np.zeros((rows, cols)),
+            'm2': np.zeros((rows, cols)),
+            'min': np.zeros((rows, cols)),
+            'max': np.zeros((rows, cols)),
+            'nodata': np.zeros((rows, cols), dtype='int64'),
+            'nan': np.zeros((rows, cols), dtype='int64')}
+
+        # tiles of whole cells
+        tile_rows = row_factor * max(1, tile_size // row_factor)
+        tile_cols = col_factor * max(1, tile_size // col_factor)
+        for row in range(0, height, tile_rows):
+            for col in range(0, width, tile_cols):
+                window = ((row, min(row + tile_rows, height)),
+                          (col, min(col + tile_cols, width)))
+                fsrc = rast.read(window=window, reuse_buffer=True)
+                pad = ((0, -fsrc.shape[0] % row_factor),
+                       (0, -fsrc.shape[1] % col_factor))
+                inside = np.pad(np.ones(fsrc.shape, dtype=bool), pad,
+                                'constant')
+                tile = block_aggregates(np.pad(fsrc.array, pad, 'edge'),
+                                        inside, fsrc.nodata,
+                                        (row_factor, col_factor))
+                # pixels beyond the raster are nodata
+                tile['nodata'] += row_factor * col_factor - \
+                    inside.reshape(tile['count'].shape[0], row_factor,
+                                   tile['count'].shape[1], col_factor
+                                   ).sum(axis=(1, 3))
+                cells = (slice(row // row_factor,
+                               row // row_factor + tile['count'].shape[0]),
+                         slice(col // col_factor,
+                               col // col_factor + tile['count'].shape[1]))
+                for key, value in tile.items():
+                    aggregates[key][cells] = value
+
+    count = aggregates['count']
+    if geojson_out:
+        return _gen_grid_features(stats, aggregates, grid_affine)
+
+    empty = count == 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        arrays = {
+            'count': count,
+            'sum': np.where(empty, np.nan, aggregates['total']),
+            'mean': aggregates['total'] / np.where(empty, np.nan, count),
+            'min': np.where(empty, np.nan, aggregates['min']),
+            'max': np.where(empty, np.nan, aggregates['max']),
+            'range': np.where(empty, np.nan,
+                              aggregates['max'] - aggregates['min']),
+            'std': np.sqrt(aggregates['m2'] / np.where(empty, np.nan, count)),
+            'nodata': aggregates['nodata'],
+            'nan': aggregates['nan']}
+    return dict((stat, arrays[stat]) for stat in stats), grid_affine
+
+
+def _gen_grid_features(stats, aggregates, grid_affine):
+    rows, cols = aggregates['count'].shape
+    for row in range(rows):
+        for col in range(cols):
+            corners = [grid_affine * xy for xy in [
+                (col, row), (col + 1, row), (col + 1, row + 1),
+                (col, row + 1), (col, row)]]
+            feat = {'type': 'Feature', 'properties': {'row': row, 'col': col},
+                    'geometry': {'type': 'Polygon', 'coordinates': [corners]}}
+            cell = [aggregates[key][row, col] for key in
+                    ('count', 'total', 'm2', 'min', 'max', 'nodata', 'nan')]
+            yield _format_output(feat, _moment_stats(stats, *cell),
+                                 geojson_out=True)
+
+
+@contextmanager
+def _opened(raster):
+    yield raster
+
+
+def _open_raster(raster, affine, nodata, band, cache_size):
+    if isinstance(raster, Raster):
+        # opened by the caller (e.g. a parallel worker), leave it open
+        return _opened(raster)
+    return Raster(raster, affine, nodata, band, cache_size)
+
+
+def _format_output(feat, feature_stats, prefix=None, geojson_out=False):
+    """Apply the key `prefix` to the stats of a feature and return
+    either the stats or, if `geojson_out`, the feature as a GeoJSON-like
+    dict with the stats added to its properties"""
+    if prefix is not None:
+        prefixed_feature_stats = {}
+        for key, val in feature_stats.items():
+            newkey = "{}{}".format(prefix, key)
+            prefixed_feature_stats[newkey] = val
+        feature_stats = prefixed_feature_stats
+
+    if geojson_out:
+        if not isinstance(feat, dict):
+            # e.g. fiona Feature objects, which workers receive as dicts
+            feat = feat.__geo_interface__
+        for key, val in feature_stats.items():
+            if 'properties' not in feat:
+                feat['properties'] = {}
+            feat['properties'][key] = val
+        return feat
+    else:
+        return feature_stats
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from __future__ import division
+import multiprocessing
+import threading
+import uuid
+import warnings
+from collections import deque
+from itertools import islice
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    # python 2 without the futures backport
+    ProcessPoolExecutor = None
+
+from .io import Raster
+
+DEFAULT_BATCH_SIZE = 64
+
+# each worker (process or thread) keeps a single open Raster
+# and reuses it for every batch it is handed
+_worker = threading.local()
+
+
+def _init_worker(token, raster, affine, nodata, band, cache_size):
+    _worker.raster = (token, Raster(raster, affine, nodata, band, cache_size))
+
+
+def _worker_raster(token, raster_args):
+    """Return the Raster opened by this worker for the run identified by token
+
+    A worker reused across runs (e.g. a user supplied executor) closes the
+    raster of the previous run and opens the new one on first use.
+    """
+    cached = getattr(_worker, 'raster', None)
+    if cached is None or cached[0] != token:
+        if cached is not None:
+            cached[1].close()
+        cached = (token, Raster(*raster_args))
+        _worker.raster = cached
+    return cached[1]
+
+
+def _zonal_stats_batch(token, raster_args, features, options):
+    from .main import gen_zonal_stats
+    rast = _worker_raster(token, raster_args)
+    with warnings.catch_warnings():
+        # options were validated (and warned about) by the parent
+        warnings.simplefilter('ignore')
+        return list(gen_zonal_stats(features, rast, **options))
+
+
+def batches(iterable, size):
+    """Yield successive lists of at most `size` items from an iterable"""
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def gen_parallel_zonal_stats(features, raster_args, options,
+                             n_jobs=-1, executor=None,
+                             batch_size=DEFAULT_BATCH_SIZE):
+    """Run zonal statistics for batches of features on a pool of workers
+
+    Parameters
+    ----------
+    features: iterable of GeoJSON-like features
+
+    raster_args: tuple
+        (raster, affine, nodata, band, cache_size) used by each worker
+        to open its own ``Raster`` once.
+
+    options: dict
+        keyword arguments passed to ``gen_zonal_stats`` for each batch
+
+    n_jobs: int, optional
+        Number of worker processes. Values below 1 use all cores.
+        With a user supplied `executor`, only bounds the number of
+        batches in flight.
+
+    executor: concurrent.futures.Executor, optional
+        Use this executor instead of creating a process pool.
+        The raster arguments are then sent along with every batch
+        and each worker opens the raster on first use.
+
+    batch_size: int, optional
+        Number of features sent to a worker at once.
+
+    Returns
+    -------
+    generator of results, in the order of the input features
+    """
+    if n_jobs is None or n_jobs < 1:
+        n_jobs = multiprocessing.cpu_count()
+
+    token = uuid.uuid4().hex
+    own_executor = executor is None
+    batch_raster_args = raster_args
+    if own_executor:
+        if ProcessPoolExecutor is None:
+            raise ImportError("n_jobs requires concurrent.futures; on python 2 "
+                              "install the futures backport or pass an executor")
+        try:
+            executor = ProcessPoolExecutor(
+                max_workers=n_jobs, initializer=_init_worker,
+                initargs=(token, ) + tuple(raster_args))
+            # opened by the initializer, no need to ship it with every batch
+            batch_raster_args = None
+        except TypeError:
+            # no initializer before python 3.7, workers open the raster
+            # on first use
+            executor = ProcessPoolExecutor(max_workers=n_jobs)
+
+    # futures are kept in submission order; a batch that finishes early
+    # waits here until all batches before it have been yielded
+    pending = deque()
+    max_pending = 2 * n_jobs
+    try:
+        for batch in batches(features, batch_size):
+            pending.append(executor.submit(
+                _zonal_stats_batch, token, batch_raster_args, batch, options))
+            if len(pending) >= max_pending:
+                for res in pending.popleft().result():
+                    yield res
+        while pending:
+            for res in pending.popleft().result():
+                yield res
+    finally:
+        for future in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown(wait=True)
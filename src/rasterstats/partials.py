@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""Zonal statistics as map-reduce
+
+``zonal_partials`` computes the partial statistics of each feature within
+each tile of the raster (map), ``merge_partials`` combines the partials of
+each feature (reduce) and ``finalize`` turns them into the stats dicts
+returned by ``zonal_stats``. Partial states are dicts of plain python
+values, so that they can be written to JSON files by one process or host
+and merged by another.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from collections import OrderedDict
+
+from .accumulators import StatsAccumulator
+from .engines import (tile_index, gen_tile_partials, _read_geoms,
+                      _outside_count, DEFAULT_TILE_SIZE)
+from .io import read_features, Raster
+from .utils import check_stats
+
+
+def zonal_partials(vectors, raster, layer=0, band=1, nodata=None,
+                   affine=None, stats=None, all_touched=False,
+                   categorical=False, tiles=None,
+                   tile_size=DEFAULT_TILE_SIZE, id_field=None):
+    """Partial zonal statistics of each (feature, raster tile) pair
+
+    The raster is divided into square tiles of `tile_size` pixels, indexed
+    by (tile_row, tile_col) from the upper left corner. Running this for
+    disjoint subsets of the tiles (e.g. one per host) and merging all of
+    the partials gives the same statistics as running it for all tiles.
+
+    Parameters
+    ----------
+    vectors, raster, layer, band, nodata, affine, stats, all_touched,
+    categorical: as for ``zonal_stats``
+
+    tiles: iterable of (tile_row, tile_col) tuples, optional
+        Only process these tiles. Pixels of features outside of the raster
+        extent (counted by the `nodata` stat) go with tile (0, 0).
+        defaults to `None`, all tiles
+
+    tile_size: int, optional
+        size of the tiles, in pixels. Must be the same for all the
+        partials of a feature.
+
+    id_field: str, optional
+        Property identifying the features.
+        defaults to `None`, the position of the feature in `vectors`
+
+    Returns
+    -------
+    generator of (feature id, partial state) tuples, tile by tile.
+    Features outside of the raster have a single, empty, partial state.
+    """
+    stats, _ = check_stats(stats, categorical)
+    if tiles is not None:
+        tiles = set(tuple(tile) for tile in tiles)
+
+    features_list = list(read_features(vectors, layer))
+    if id_field is None:
+        ids = list(range(len(features_list)))
+    else:
+        ids = [feat['properties'][id_field] for feat in features_list]
+
+    def accumulator():
+        return StatsAccumulator(stats, categorical)
+
+    with Raster(raster, affine, nodata, band) as rast:
+        geoms = _read_geoms(features_list, rast)
+        index = tile_index([g.bounds for g in geoms], rast.affine, rast.shape,
+                           tile_size)
+
+        # features are credited with their pixels outside of the raster
+        # in their first tile, or tile (0, 0) if they have none
+        first_tile = {}
+        for tile in sorted(index, reverse=True):
+            for i in index[tile]:
+                first_tile[i] = tile
+        for i in range(len(geoms)):
+            if i not in first_tile and (tiles is None or (0, 0) in tiles):
+                partial = accumulator()
+                if 'nodata' in stats:
+                    partial.nodata += _outside_count(
+                        geoms[i], rast.affine, rast.shape, all_touched)
+                yield ids[i], partial.to_dict()
+
+        for tile, i, partial in gen_tile_partials(
+                geoms, rast, index, accumulator, all_touched, tile_size,
+                tiles):
+            if 'nodata' in stats and first_tile[i] == tile:
+                partial.nodata += _outside_count(
+                    geoms[i], rast.affine, rast.shape, all_touched)
+            yield ids[i], partial.to_dict()
+
+
+def merge_partials(partials):
+    """Merge the partial states of each feature
+
+    Parameters
+    ----------
+    partials: iterable of (feature id, partial state) tuples, in any order,
+        e.g. the output of several ``zonal_partials`` runs
+
+    Returns
+    -------
+    OrderedDict of feature id to merged partial state, in the order in
+    which the features first appear in `partials`
+    """
+    merged = OrderedDict()
+    for feature_id, state in partials:
+        partial = StatsAccumulator.from_dict(state)
+        if feature_id not in merged:
+            merged[feature_id] = partial
+            continue
+        acc = merged[feature_id]
+        if acc.stats != partial.stats or acc.categorical != partial.categorical:
+            raise ValueError("Partials of feature {0} were computed with "
+                             "different stats".format(feature_id))
+        acc.merge(partial)
+    return OrderedDict((feature_id, acc.to_dict())
+                       for feature_id, acc in merged.items())
+
+
+def finalize(state, category_map=None):
+    """Stats dict of a feature from its merged partial state
+
+    Parameters
+    ----------
+    state: partial state, as returned by ``merge_partials``
+    category_map: as for ``zonal_stats``
+
+    Returns
+    -------
+    dict of stats, as returned by ``zonal_stats``
+    """
+    return StatsAccumulator.from_dict(state, category_map).result()
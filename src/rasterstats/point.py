@@ -1,10 +1,18 @@
 from __future__ import absolute_import
 from __future__ import division
+from itertools import islice
+import numpy as np
 from shapely.geometry import shape
 from shapely import wkt
 from numpy.ma import masked
-from numpy import ndarray
-from .io import read_features, Raster
+from .io import read_features, Raster, band_indexes
+from .utils import gen_spatially_ordered, SPATIAL_ORDERS
+
+POINT_ENGINES = ['feature', 'batch']
+# features queried together by the batch engine
+POINT_BATCH_SIZE = 2 ** 14
+# memory budget of the single window read of the pixels of a batch
+POINT_REGION_BYTES = 2 ** 26
 
 
 def point_window_unitxy(x, y, affine):
@@ -57,7 +65,7 @@ def bilinear(arr, x, y):
         if val is masked:
             return None
         else:
-            return ndarray.item(val)
+            return val.item()
 
     # bilinear interp on unit square
     return ((llv * (1 - x) * (1 - y)) +
@@ -86,6 +94,133 @@ def geom_xys(geom):
             yield pair
 
 
+def geom_coords(geom):
+    """Given a shapely geometry,
+    return the same points as ``geom_xys``, as an (n, 2) array
+    """
+    if hasattr(geom, "geoms"):
+        parts = [geom_coords(g) for g in geom.geoms]
+        return np.concatenate(parts) if parts else np.empty((0, 2))
+    if geom.is_empty:
+        return np.empty((0, 2))
+    coords = geom.exterior.coords if hasattr(geom, "exterior") else geom.coords
+    return np.asarray(coords, dtype='float64')[:, :2]
+
+
+def _sample_bands(rast, rows, cols, region_bytes, point_bands):
+    """Values of the pixels at (rows, cols) of the band of each pixel,
+    reading the pixels of each band at once"""
+    parts = []
+    for band in np.unique(point_bands):
+        index = np.flatnonzero(point_bands == band)
+        parts.append((index, rast.sample(rows[index], cols[index],
+                                         region_bytes, [int(band)])[:, 0]))
+    dtype = np.result_type(*[part.dtype for _, part in parts]) \
+        if parts else 'float64'
+    values = np.zeros(rows.shape, dtype=dtype)
+    mask = np.ones(rows.shape, dtype=bool)
+    for index, part in parts:
+        values[index] = part.data
+        mask[index] = part.mask
+    return np.ma.MaskedArray(values, mask=mask)
+
+
+def batch_point_values(rast, xs, ys, interpolate='bilinear',
+                       region_bytes=POINT_REGION_BYTES, bands=None,
+                       point_bands=None):
+    """Values of the raster at the points (xs, ys)
+
+    The vectorized equivalent of querying each point with
+    ``point_window_unitxy`` and ``bilinear``: pixels are fetched all at
+    once with ``Raster.sample`` (reading the window bounding them if it
+    fits in `region_bytes`, else the blocks they fall in) and bilinear
+    interpolation falls back to the nearest pixel where any of the four
+    pixels is nodata. With a list of `bands`, the pixels of all bands are
+    read at once. With `point_bands`, the band of each point, the points
+    are grouped by band and the pixels of each band are read at once.
+
+    Returns
+    -------
+    list of values, None for nodata, or of lists of the values of each
+    band if `bands` is given
+    """
+    fcol, frow = ~rast.affine * (np.asarray(xs, dtype='float64'),
+                                 np.asarray(ys, dtype='float64'))
+    def sample(rows, cols, neighbours=1):
+        if point_bands is None:
+            return rast.sample(rows, cols, region_bytes, bands)
+        return _sample_bands(rast, rows, cols, region_bytes,
+                             np.tile(point_bands, neighbours))
+
+    if interpolate == 'nearest':
+        return sample(np.floor(frow), np.floor(fcol)).tolist()
+
+    r, c = np.round(frow), np.round(fcol)
+    # coords on the unit square of the 2x2 window ((r - 1, r + 1), (c - 1, c + 1))
+    x = 0.5 - (c - fcol)
+    y = 0.5 + (r - frow)
+    # the four pixels of all points in one read
+    window = sample(np.concatenate([r - 1, r - 1, r, r]),
+                    np.concatenate([c - 1, c, c - 1, c]), 4)
+    ulv, urv, llv, lrv = [window[i * r.size:(i + 1) * r.size]
+                          for i in range(4)]
+    if bands is not None:
+        # (points, bands) values
+        x, y = x[:, np.newaxis], y[:, np.newaxis]
+    interpolated = ((llv.data * (1 - x) * (1 - y)) +
+                    (lrv.data * x * (1 - y)) +
+                    (ulv.data * (1 - x) * y) +
+                    (urv.data * x * y))
+
+    partial = ulv.mask | urv.mask | llv.mask | lrv.mask
+    if not partial.any():
+        return interpolated.tolist()
+    # nearest of the 2x2 window
+    top = np.round(1 - y) == 0
+    left = np.round(x) == 0
+    nearest = np.ma.where(top, np.ma.where(left, ulv, urv),
+                          np.ma.where(left, llv, lrv))
+    values = [near if part else value for value, near, part
+              in zip(interpolated.ravel().tolist(), nearest.ravel().tolist(),
+                     partial.ravel())]
+    if bands is None:
+        return values
+    return [values[i:i + len(bands)]
+            for i in range(0, len(values), len(bands))]
+
+
+def gen_batch_point_query(features, rast, interpolate='bilinear',
+                          batch_size=POINT_BATCH_SIZE,
+                          region_bytes=POINT_REGION_BYTES, bands=None,
+                          band_func=None):
+    """Values of the raster at the vertices of the features, queried
+    `batch_size` features at a time with ``batch_point_values``
+
+    `band_func` gives the band number of each feature, to query the
+    vertices of each feature in their own band.
+
+    Yields (feature, values) tuples in input order.
+    """
+    it = iter(features)
+    while True:
+        batch = list(islice(it, batch_size))
+        if not batch:
+            return
+        coords = [geom_coords(shape(feat['geometry'])) for feat in batch]
+        xys = np.concatenate(coords) if coords else np.empty((0, 2))
+        point_bands = None
+        if band_func is not None:
+            point_bands = np.repeat(
+                np.asarray([band_func(feat) for feat in batch], dtype='int64'),
+                [len(feat_coords) for feat_coords in coords])
+        values = batch_point_values(rast, xys[:, 0], xys[:, 1], interpolate,
+                                    region_bytes, bands, point_bands)
+        start = 0
+        for feat, feat_coords in zip(batch, coords):
+            yield feat, values[start:start + len(feat_coords)]
+            start += len(feat_coords)
+
+
 def point_query(*args, **kwargs):
     """The primary point query entry point.
 
@@ -106,7 +241,10 @@ def gen_point_query(
     affine=None,
     interpolate='bilinear',
     property_name='value',
-    geojson_out=False):
+    geojson_out=False,
+    order=None,
+    engine='feature',
+    band_field=None):
     """
     Given a set of vector features and a raster,
     generate raster values at each vertex of the geometry
@@ -122,16 +260,22 @@ def gen_point_query(
     ----------
     vectors: path to an vector source or geo-like python objects
 
-    raster: ndarray or path to a GDAL raster source
+    raster: ndarray, xarray DataArray or path to a GDAL raster source
         If ndarray is passed, the `transform` kwarg is required.
+        The time steps of a DataArray with a `time` dimension are its
+        bands, its transform and nodata are read with ``rio``.
 
     layer: int or string, optional
         If `vectors` is a path to an fiona source,
         specify the vector layer to use either by name or number.
         defaults to 0
 
-    band: int, optional
-        If `raster` is a GDAL source, the band number to use (counting from 1).
+    band: int, list of ints or slice, optional
+        If `raster` is a GDAL source or a 3D array, the band number to use
+        (counting from 1). With a list or slice of bands, the values of all
+        of the bands are read at once and each vertex gets the list of its
+        values, one per band; the vertices are then queried with the
+        'batch' engine.
         defaults to 1.
 
     nodata: float, optional
@@ -154,6 +298,28 @@ def gen_point_query(
         original feature geometry and properties will be retained
         point query values appended as additional properties.
 
+    order: string, optional
+        Query the features along a space filling curve ('hilbert' or
+        'zorder') rather than in input order, for better locality of
+        raster reads. Results are still generated in input order.
+        defaults to `None`, input order
+
+    engine: string, optional
+        'feature' queries the vertices one by one. 'batch' gathers the
+        vertices of batches of features and queries them with vectorized
+        numpy operations, reading the window bounding the vertices of a
+        batch at once if it fits in ``POINT_REGION_BYTES``, otherwise each
+        raster block they fall in once; much faster for many points.
+        defaults to 'feature'
+
+    band_field: string or callable, optional
+        Query each feature in its own band (e.g. the day of its timestamp
+        in a raster with a band per day): the name of the property holding
+        its band number (counting from 1), or a function of the feature
+        returning it. The vertices of each batch are grouped by band, each
+        band is read once per batch; queried with the 'batch' engine.
+        defaults to `None`, all features in `band`
+
     Returns
     -------
     generator of arrays (if ``geojson_out`` is False)
@@ -161,10 +327,59 @@ def gen_point_query(
     """
     if interpolate not in ['nearest', 'bilinear']:
         raise ValueError("interpolate must be nearest or bilinear")
+    if engine not in POINT_ENGINES:
+        raise ValueError("engine must be one of {0}".format(POINT_ENGINES))
+
+    if hasattr(raster, 'dims'):
+        raster, affine, nodata = _dataarray_bands(raster, affine, nodata)
 
     features_iter = read_features(vectors, layer)
 
-    with Raster(raster, nodata=nodata, affine=affine, band=band) as rast:
+    if order is not None:
+        if order not in SPATIAL_ORDERS:
+            raise ValueError("order must be one of {0}".format(SPATIAL_ORDERS))
+
+        def process(features):
+            return gen_point_query(
+                features, raster, band=band, nodata=nodata, affine=affine,
+                interpolate=interpolate, property_name=property_name,
+                geojson_out=geojson_out, engine=engine, band_field=band_field)
+
+        for res in gen_spatially_ordered(process, features_iter, order):
+            yield res
+        return
+
+    multiband = isinstance(band, (list, tuple, slice))
+    if multiband and band_field is not None:
+        raise ValueError("Specify either a list of bands or band_field")
+    if band_field is None:
+        band_func = None
+    elif callable(band_field):
+        band_func = band_field
+    else:
+        def band_func(feat):
+            return feat['properties'][band_field]
+
+    with Raster(raster, nodata=nodata, affine=affine,
+                band=1 if multiband else band) as rast:
+        bands = None
+        if multiband:
+            count = rast.src.count if rast.array is None else \
+                rast.array.shape[0] if rast.array.ndim == 3 else 1
+            bands = band_indexes(band, count)
+        elif rast.array is not None and rast.array.ndim == 3 and \
+                band_func is None:
+            # a band of a 3D array
+            bands = [band]
+
+        if engine == 'batch' or bands is not None or band_func is not None:
+            for feat, vals in gen_batch_point_query(features_iter, rast,
+                                                    interpolate, bands=bands,
+                                                    band_func=band_func):
+                if bands is not None and not multiband:
+                    vals = [v[0] for v in vals]
+                yield _format_values(feat, vals, property_name, geojson_out)
+            return
 
         for feat in features_iter:
             geom = shape(feat['geometry'])
@@ -178,20 +393,184 @@ def gen_point_query(
                     if val is masked:
                         vals.append(None)
                     else:
-                        vals.append(ndarray.item(val))
+                        vals.append(val.item())
 
                 elif interpolate == 'bilinear':
                     window, unitxy = point_window_unitxy(x, y, rast.affine)
                     src_array = rast.read(window=window, masked=True).array
                     vals.append(bilinear(src_array, *unitxy))
 
-            if len(vals) == 1:
-                vals = vals[0]  # flatten single-element lists
+            yield _format_values(feat, vals, property_name, geojson_out)
+
+
+def line_samples(geom, step):
+    """Points every `step` along the lines of a shapely geometry
+
+    Each line is walked from its start, its last point is always sampled.
+    The parts of multi-part geometries follow one another, the distance
+    along the geometry running on from one part to the next.
+
+    Returns
+    -------
+    (n, 2) array of the points, (n,) array of their distance along the lines
+    """
+    if geom.geom_type not in ('LineString', 'LinearRing', 'MultiLineString'):
+        raise ValueError("Line profiles require LineString or "
+                         "MultiLineString geometries, got {0}".format(
+                             geom.geom_type))
+    parts = geom.geoms if hasattr(geom, 'geoms') else [geom]
+    xys, distances = [np.empty((0, 2))], [np.empty(0)]
+    offset = 0.0
+    for part in parts:
+        coords = geom_coords(part)
+        if not len(coords):
+            continue
+        lengths = np.hypot(*np.diff(coords, axis=0).T)
+        cumulative = np.concatenate([[0], np.cumsum(lengths)])
+        length = cumulative[-1]
+        along = np.arange(0, length, step)
+        if not along.size or length - along[-1] > 1e-9 * max(length, 1):
+            along = np.append(along, length)
+        segment = np.clip(np.searchsorted(cumulative, along, 'right') - 1,
+                          0, len(lengths) - 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.where(lengths[segment] > 0,
+                         (along - cumulative[segment]) / lengths[segment], 0)
+        xys.append(coords[segment] + t[:, np.newaxis] *
+                   (coords[segment + 1] - coords[segment]))
+        distances.append(offset + along)
+        offset += length
+    return np.concatenate(xys), np.concatenate(distances)
+
+
+def line_profile(*args, **kwargs):
+    """Profiles of the raster along lines.
+
+    All arguments are passed directly to ``gen_line_query``.
+    See its docstring for details.
+
+    The only difference is that ``line_profile`` will
+    return a list rather than a generator."""
+    return list(gen_line_query(*args, **kwargs))
+
+
+def gen_line_query(
+    vectors,
+    raster,
+    step=None,
+    band=1,
+    layer=0,
+    nodata=None,
+    affine=None,
+    interpolate='bilinear',
+    property_name='profile',
+    geojson_out=False,
+    batch_size=POINT_BATCH_SIZE):
+    """
+    Given a set of line features and a raster,
+    generate the profile of the raster values along each line
+
+    The lines are sampled every `step`, with vectorized numpy operations
+    over batches of `batch_size` lines; the pixels of a batch are read at
+    once, as for the 'batch' engine of ``gen_point_query``.
+
+    Parameters
+    ----------
+    vectors: path to an vector source or geo-like python objects
+        LineString or MultiLineString features
+
+    raster, band, layer, nodata, affine, interpolate:
+        as for ``gen_point_query``, with a single band
+
+    step: float, optional
+        Distance between the samples, in the units of the raster.
+        defaults to `None`, the pixel size
+
+    property_name: string
+        name of property key if geojson_out
+
+    geojson_out: boolean
+        generate GeoJSON-like features (default: False)
+        original feature geometry and properties will be retained
+        profiles appended as additional properties.
+
+    batch_size: int, optional
+        number of lines sampled together
 
-            if geojson_out:
-                if 'properties' not in feat:
-                    feat['properties'] = {}
-                feat['properties'][property_name] = vals
-                yield feat
-            else:
-                yield vals
+    Returns
+    -------
+    generator of profiles, dicts of the `distance` of each sample from the
+    start of the line and its `value` (None for nodata)
+    (if ``geojson_out`` is False)
+    generator of geojson features (if ``geojson_out`` is True)
+    """
+    if interpolate not in ['nearest', 'bilinear']:
+        raise ValueError("interpolate must be nearest or bilinear")
+    if step is not None and step <= 0:
+        raise ValueError("step must be positive")
+
+    if hasattr(raster, 'dims'):
+        raster, affine, nodata = _dataarray_bands(raster, affine, nodata)
+
+    features_iter = iter(read_features(vectors, layer))
+
+    with Raster(raster, nodata=nodata, affine=affine, band=band) as rast:
+        if step is None:
+            step = min(abs(rast.affine.a), abs(rast.affine.e))
+        bands = None
+        if rast.array is not None and rast.array.ndim == 3:
+            # a band of a 3D array
+            bands = [band]
+
+        while True:
+            batch = list(islice(features_iter, batch_size))
+            if not batch:
+                return
+            samples = [line_samples(shape(feat['geometry']), step)
+                       for feat in batch]
+            xys = np.concatenate([xy for xy, _ in samples])
+            values = batch_point_values(rast, xys[:, 0], xys[:, 1],
+                                        interpolate, bands=bands)
+            if bands is not None:
+                values = [v[0] for v in values]
+            start = 0
+            for feat, (xy, distances) in zip(batch, samples):
+                profile = {'distance': distances.tolist(),
+                           'value': values[start:start + len(xy)]}
+                start += len(xy)
+                if geojson_out:
+                    yield _add_property(feat, property_name, profile)
+                else:
+                    yield profile
+
+
+def _dataarray_bands(da, affine, nodata):
+    """3D array of the time steps of an xarray DataArray, its transform and
+    nodata"""
+    if affine is None:
+        affine = da.rio.transform()
+    if nodata is None:
+        nodata = da.rio.nodata
+    if 'time' in da.dims:
+        da = da.transpose('time', *[dim for dim in da.dims if dim != 'time'])
+    return da.values, affine, nodata
+
+
+def _format_values(feat, vals, property_name, geojson_out):
+    if len(vals) == 1:
+        vals = vals[0]  # flatten single-element lists
+
+    if geojson_out:
+        return _add_property(feat, property_name, vals)
+    return vals
+
+
+def _add_property(feat, property_name, value):
+    """The feature as a GeoJSON-like dict, with the property added"""
+    if not isinstance(feat, dict):
+        # e.g. fiona Feature objects, which ordered queries receive as dicts
+        feat = feat.__geo_interface__
+    if 'properties' not in feat:
+        feat['properties'] = {}
+    feat['properties'][property_name] = value
+    return feat
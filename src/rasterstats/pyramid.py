@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""Aggregate pyramid of a raster, for zonal statistics of large zones
+
+The pyramid holds the count, sum, sum of squared deviations from the mean,
+minimum, maximum and number of nodata and nan pixels of square blocks of
+the raster, at successive levels of blocks twice as large. Built once per
+raster (``build_pyramid``) and saved as a sidecar file, it lets zonal
+statistics take the blocks lying entirely within a zone from the pyramid
+and only read the pixels of the blocks along its boundary.
+"""
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+from shapely.geometry import box
+from shapely.prepared import prep
+
+from .accumulators import StatsAccumulator, Moments
+from .engines import _read_geoms, _outside_count
+from .io import Raster, bounds_window, clamp_window, window_bounds, tile_windows
+from .utils import rasterize_geom, block_aggregates
+
+DEFAULT_BLOCK_SIZE = 64
+# stats that can be answered from the pyramid
+PYRAMID_STATS = ['count', 'min', 'max', 'mean', 'sum', 'std', 'range',
+                 'nodata', 'nan']
+FIELDS = ('count', 'total', 'm2', 'min', 'max', 'nodata', 'nan')
+
+
+class AggregatePyramid(object):
+    """Block aggregates of a raster at several levels
+
+    Parameters
+    ----------
+    levels: list of dicts of 2d arrays, one per field of FIELDS
+        level k aggregates blocks of block_size * 2 ** k pixels. Empty
+        blocks have a count of zero, an infinite min and max and nan mean.
+    block_size: size of the (square) blocks of the first level, in pixels
+    shape: (rows, cols) of the raster
+    affine: Affine transform of the raster
+    nodata: nodata value of the raster
+    """
+
+    def __init__(self, levels, block_size, shape, affine, nodata):
+        self.levels = levels
+        self.block_size = block_size
+        self.shape = tuple(shape)
+        self.affine = affine
+        self.nodata = nodata
+
+    def block_size_at(self, level):
+        return self.block_size * 2 ** level
+
+    def save(self, path):
+        """Save the pyramid as a numpy .npz file"""
+        arrays = dict(
+            ('{0}_{1}'.format(field, k), level[field])
+            for k, level in enumerate(self.levels) for field in FIELDS)
+        np.savez(path, block_size=self.block_size, shape=self.shape,
+                 affine=tuple(self.affine)[:6],
+                 nodata=np.nan if self.nodata is None else self.nodata,
+                 has_nodata=self.nodata is not None, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Load a pyramid saved with ``save``"""
+        from affine import Affine
+        with np.load(path) as data:
+            n_levels = len([key for key in data.files
+                            if key.startswith('count_')])
+            levels = [dict((field, data['{0}_{1}'.format(field, k)])
+                           for field in FIELDS) for k in range(n_levels)]
+            nodata = float(data['nodata']) if data['has_nodata'] else None
+            return cls(levels, int(data['block_size']),
+                       tuple(data['shape']), Affine(*data['affine']), nodata)
+
+    def check(self, rast):
+        """Raise ValueError unless the pyramid was built for rast"""
+        same_nodata = self.nodata == rast.nodata or (
+            self.nodata is not None and rast.nodata is not None and
+            np.isnan(self.nodata) and np.isnan(rast.nodata))
+        if self.shape != tuple(rast.shape[-2:]) or \
+                not self.affine.almost_equals(rast.affine) or not same_nodata:
+            raise ValueError("The pyramid was not built for this raster "
+                             "(shape, transform or nodata differ)")
+
+
+def _merge_blocks(level):
+    """Next level of the pyramid, merging blocks 2 by 2"""
+    rows, cols = level['count'].shape
+    pad = ((0, rows % 2), (0, cols % 2))
+    fill = {'min': np.inf, 'max': -np.inf}
+
+    def quads(field):
+        a = np.pad(level[field], pad, 'constant',
+                   constant_values=fill.get(field, 0))
+        return a.reshape((rows + 1) // 2, 2, (cols + 1) // 2, 2)
+
+    count = quads('count')
+    total = quads('total')
+    merged_count = count.sum(axis=(1, 3))
+    merged_total = total.sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        merged_mean = merged_total / merged_count
+    # parallel combination of the squared deviations of the parts
+    shift = np.where(count > 0, mean - merged_mean[:, None, :, None], 0)
+    return {
+        'count': merged_count,
+        'total': merged_total,
+        'm2': (quads('m2') + count * shift ** 2).sum(axis=(1, 3)),
+        'min': quads('min').min(axis=(1, 3)),
+        'max': quads('max').max(axis=(1, 3)),
+        'nodata': quads('nodata').sum(axis=(1, 3)),
+        'nan': quads('nan').sum(axis=(1, 3))}
+
+
+def build_pyramid(raster, path=None, band=1, nodata=None, affine=None,
+                  block_size=DEFAULT_BLOCK_SIZE, tile_size=None):
+    """Build the aggregate pyramid of a raster
+
+    The raster is read tile by tile, only the block aggregates are kept in
+    memory.
+
+    Parameters
+    ----------
+    raster, band, nodata, affine: as for ``zonal_stats``
+    path: str, optional
+        save the pyramid to this .npz file, see ``AggregatePyramid.save``
+    block_size: int, optional
+        size of the blocks of the first level, in pixels. Blocks along the
+        boundary of zones are read pixel by pixel.
+    tile_size: int, optional
+        size of the tiles read at once, a multiple of `block_size`.
+        defaults to 16 blocks
+
+    Returns
+    -------
+    AggregatePyramid
+    """
+    if tile_size is None:
+        tile_size = 16 * block_size
+    if block_size < 1 or tile_size % block_size:
+        raise ValueError("tile_size must be a multiple of block_size")
+
+    with Raster(raster, affine, nodata, band) as rast:
+        height, width = rast.shape[-2:]
+        rows = -(-height // block_size)
+        cols = -(-width // block_size)
+        level = {
+            'count': np.zeros((rows, cols), dtype='int64'),
+            'total': np.zeros((rows, cols)),
+            'm2': np.zeros((rows, cols)),
+            'min': np.full((rows, cols), np.inf),
+            'max': np.full((rows, cols), -np.inf),
+            'nodata': np.zeros((rows, cols), dtype='int64'),
+            'nan': np.zeros((rows, cols), dtype='int64')}
+        for window in tile_windows((height, width), tile_size):
+            (row_start, row_stop), (col_start, col_stop) = window
+            tile_src = rast.read(window=window, reuse_buffer=True)
+            arr = tile_src.array
+            # pad partial blocks along the raster edges
+            pad = ((0, -arr.shape[0] % block_size),
+                   (0, -arr.shape[1] % block_size))
+            inside = np.pad(np.ones(arr.shape, dtype=bool), pad, 'constant')
+            arr = np.pad(arr, pad, 'edge')
+            tile = block_aggregates(arr, inside, tile_src.nodata,
+                                    (block_size, block_size))
+            block_rows = slice(row_start // block_size,
+                               row_start // block_size + arr.shape[0] // block_size)
+            block_cols = slice(col_start // block_size,
+                               col_start // block_size + arr.shape[1] // block_size)
+            for field in FIELDS:
+                level[field][block_rows, block_cols] = tile[field]
+
+        levels = [level]
+        while level['count'].shape != (1, 1):
+            level = _merge_blocks(level)
+            levels.append(level)
+
+        pyramid = AggregatePyramid(levels, block_size, (height, width),
+                                   rast.affine, rast.nodata)
+
+    if path is not None:
+        pyramid.save(path)
+    return pyramid
+
+
+def _blocks_moments(level, index):
+    """Moments of the blocks of a level at index (rows, cols)"""
+    count = level['count'][index]
+    moments = Moments()
+    if not count.sum():
+        return moments
+    total = level['total'][index]
+    n = int(count.sum())
+    mean = total.sum() / n
+    nonempty = count > 0
+    deviations = total[nonempty] / count[nonempty] - mean
+    return Moments.from_dict({
+        'count': n,
+        'total': float(total.sum()),
+        'mean': float(mean),
+        'm2': float((level['m2'][index][nonempty] +
+                     count[nonempty] * deviations ** 2).sum()),
+        'min': float(level['min'][index].min()),
+        'max': float(level['max'][index].max())})
+
+
+def gen_pyramid_zonal_stats(features_list, rast, pyramid, stats,
+                            all_touched=False):
+    """Zonal statistics answered from an aggregate pyramid
+
+    Blocks entirely within a feature are taken from the largest level of
+    the pyramid they fit in, only the pixels of the first level blocks
+    crossed by the boundary of the feature are read and rasterized.
+
+    Yields one stats dict per feature, in order.
+    """
+    pyramid.check(rast)
+    height, width = pyramid.shape
+    affine = rast.affine
+    top = len(pyramid.levels) - 1
+
+    for geom in _read_geoms(features_list, rast):
+        acc = StatsAccumulator(stats)
+        if 'nodata' in stats:
+            acc.nodata += _outside_count(geom, affine, (height, width),
+                                         all_touched)
+        window = clamp_window(bounds_window(geom.bounds, affine),
+                              (height, width))
+        if window is None:
+            yield acc.result()
+            continue
+
+        prepared = prep(geom)
+        (row_start, row_stop), (col_start, col_stop) = window
+        size = pyramid.block_size_at(top)
+        pending = [(top, block_row, block_col)
+                   for block_row in range(row_start // size,
+                                          (row_stop - 1) // size + 1)
+                   for block_col in range(col_start // size,
+                                          (col_stop - 1) // size + 1)]
+        inside = dict((k, ([], [])) for k in range(top + 1))
+        boundary = set()
+        while pending:
+            k, block_row, block_col = pending.pop()
+            size = pyramid.block_size_at(k)
+            block_window = ((block_row * size, min((block_row + 1) * size, height)),
+                            (block_col * size, min((block_col + 1) * size, width)))
+            block = box(*window_bounds(block_window, affine))
+            if prepared.contains(block):
+                inside[k][0].append(block_row)
+                inside[k][1].append(block_col)
+            elif not prepared.intersects(block):
+                continue
+            elif k == 0:
+                boundary.add((block_row, block_col))
+            else:
+                rows, cols = pyramid.levels[k - 1]['count'].shape
+                pending.extend(
+                    (k - 1, r, c)
+                    for r in (2 * block_row, 2 * block_row + 1) if r < rows
+                    for c in (2 * block_col, 2 * block_col + 1) if c < cols)
+
+        for k, index in inside.items():
+            if not index[0]:
+                continue
+            level = pyramid.levels[k]
+            acc.moments.merge(_blocks_moments(level, index))
+            acc.nodata += int(level['nodata'][index].sum())
+            acc.nan += int(level['nan'][index].sum())
+
+        # boundary blocks are read by runs of consecutive blocks of a row
+        size = pyramid.block_size
+        for block_row, block_col in sorted(boundary):
+            if (block_row, block_col - 1) in boundary:
+                continue
+            last = block_col
+            while (block_row, last + 1) in boundary:
+                last += 1
+            block_window = ((block_row * size, min((block_row + 1) * size, height)),
+                            (block_col * size, min((last + 1) * size, width)))
+            fsrc = rast.read(window=block_window, reuse_buffer=True)
+            # rasterize only the part of the geometry about the run, a pixel
+            # beyond it so that no edge of the clip falls on the run's pixels
+            (run_row0, run_row1), (run_col0, run_col1) = block_window
+            clip = box(*window_bounds(((run_row0 - 1, run_row1 + 1),
+                                       (run_col0 - 1, run_col1 + 1)), affine))
+            if prepared.contains(clip):
+                part = clip
+            else:
+                part = geom.intersection(clip)
+                if part.is_empty:
+                    continue
+            rv_array = rasterize_geom(part, shape=fsrc.shape,
+                                      affine=fsrc.affine,
+                                      all_touched=all_touched)
+            isnodata = rv_array & (fsrc.array == fsrc.nodata)
+            isnan = np.zeros_like(rv_array)
+            if np.issubdtype(fsrc.array.dtype, np.floating):
+                isnan = rv_array & np.isnan(fsrc.array)
+            valid = rv_array & ~isnodata & ~isnan
+            acc.update(fsrc.array[valid], nodata=int(isnodata.sum()),
+                       nan=int(isnan.sum()))
+
+        yield acc.result()
@@ -3,11 +3,15 @@ from __future__ import absolute_import
 from __future__ import division
 import sys
 import math
-from copy import copy
+from collections import deque, namedtuple
+from itertools import islice
+import numpy as np
 from rasterio import features
 from affine import Affine
 from numpy import min_scalar_type
-from shapely.geometry import box, MultiPolygon
+from shapely.geometry import box, shape, MultiPolygon
+from shapely.geometry.polygon import orient
+from shapely.prepared import prep
 from .io import window_bounds
 
 DEFAULT_STATS = ['count', 'min', 'max', 'mean']
@@ -15,6 +19,25 @@ VALID_STATS = DEFAULT_STATS + \
     ['sum', 'std', 'median', 'majority', 'minority', 'unique', 'range', 'nodata', 'nan']
 #  also percentile_{q} but that is handled as special case
 
+# integer values are counted with np.bincount when their range is at most
+# this or the number of values, otherwise with np.unique
+BINCOUNT_MAX_RANGE = 65536
+
+# multipart geometries are read in groups of parts while the bounding boxes
+# of the parts fill less than this fraction of the bounding box of the group,
+# unless it is smaller than PART_GROUP_MIN_PIXELS
+PART_GROUP_MIN_FILL = 0.1
+PART_GROUP_MIN_PIXELS = 2 ** 20
+
+PERCENT_COVER_METHODS = ['supersample', 'edge', 'exact']
+# maximum number of supersampled pixels rasterized at once by the 'edge'
+# percent cover method
+EDGE_BLOCK_PIXELS = 2 ** 22
+
+SPATIAL_ORDERS = ['hilbert', 'zorder']
+# number of features sorted together when processing in spatial order
+ORDER_BUFFER_SIZE = 10000
+
 
 def get_percentile(stat):
     if not stat.startswith('percentile_'):
@@ -97,36 +120,102 @@ def split_geom(geom, limit, pixel_size, origin):
         base_maxy = base_maxy + pixel_size
         base_minx = base_minx - pixel_size
 
-        maxy = copy(base_maxy)
-        miny = maxy - step_size_deg
+        n_rows = int(math.ceil((base_maxy - true_miny) / step_size_deg))
+        n_cols = int(math.ceil((true_maxx - base_minx) / step_size_deg))
+
+        def cells_box(row0, row1, col0, col1):
+            return box(base_minx + col0 * step_size_deg + pa,
+                       base_maxy - row1 * step_size_deg + pa,
+                       base_minx + col1 * step_size_deg - pa,
+                       base_maxy - row0 * step_size_deg - pa)
+
+        # the grid of split boxes is bisected recursively and the geometry
+        # clipped to each half, so that each intersection only walks the
+        # vertices of the part of the geometry within it. Boxes within the
+        # geometry need no intersection at all.
+        def bisect(part, row0, row1, col0, col1):
+            cells = cells_box(row0, row1, col0, col1)
+            prepared = prep(part)
+            if not prepared.intersects(cells):
+                return
+            if prepared.contains(cells):
+                part = cells
+            else:
+                part = part.intersection(cells)
+                if part.area <= 0:
+                    return
+            if row1 - row0 == 1 and col1 - col0 == 1:
+                # the split geometry is used to read the raster window and
+                # rasterized instead of the whole geometry
+                yield part
+                return
+            if row1 - row0 >= col1 - col0:
+                mid = (row0 + row1) // 2
+                halves = [(row0, mid, col0, col1), (mid, row1, col0, col1)]
+            else:
+                mid = (col0 + col1) // 2
+                halves = [(row0, row1, col0, mid), (row0, row1, mid, col1)]
+            for half in halves:
+                for sub_geom in bisect(part, *half):
+                    yield sub_geom
 
-        # end after final row
-        while maxy > true_miny:
+        for sub_geom in bisect(geom, 0, n_rows, 0, n_cols):
+            yield sub_geom
 
-            # reset minx each loop
-            # init value one col to left of true bounding box
-            # so col loop can iterate without additional checks
-            minx = copy(base_minx) #- step_size_deg
-            maxx = minx + step_size_deg
 
-            # reset after final col for each row
-            while minx < true_maxx:
+def group_parts(geom, min_gap, min_area=0, min_fill=PART_GROUP_MIN_FILL):
+    """Split a sparse multipart geometry into groups of nearby parts
 
-                tmp_box = box(minx+pa, miny+pa, maxx-pa, maxy-pa)
-                tmp_geom = geom.intersection(tmp_box)
+    While the bounding boxes of the parts of a group cover less than
+    `min_fill` of the bounding box of the group, and it is at least
+    `min_area` large, the group is split in two at the widest gap between
+    its parts along x or y, provided that it is at least `min_gap` wide.
 
-                # check geom intersection to validate but only return
-                # box since we are just using it to read raster window.
-                # the shape/affine from raster instance  will then be
-                # used to read in proper extents of split geom
-                if tmp_geom.area > 0:
-                    yield tmp_geom
+    Parameters
+    ----------
+    geom: geometry
+    min_gap: minimum gap between groups, e.g. two pixels so that the
+        raster windows of the groups never share a pixel
+    min_area: bounding box area below which a group is not split
+    min_fill: see above
 
-                minx = minx + step_size_deg
-                maxx = maxx + step_size_deg
+    Returns
+    -------
+    list of geometries, [geom] if it is not split
+    """
+    if not hasattr(geom, 'geoms') or len(geom.geoms) < 2:
+        return [geom]
+
+    parts = list(geom.geoms)
+    bounds = np.array([part.bounds for part in parts])
+    groups = []
+    pending = [np.arange(len(parts))]
+    while pending:
+        idx = pending.pop()
+        b = bounds[idx]
+        area = (b[:, 2].max() - b[:, 0].min()) * (b[:, 3].max() - b[:, 1].min())
+        fill = ((b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])).sum()
+        best = None
+        if len(idx) > 1 and area >= min_area and fill < min_fill * area:
+            for lo, hi in ((0, 2), (1, 3)):
+                # gaps between the parts sorted by their lower bound and
+                # the furthest upper bound of the parts before them
+                order = np.argsort(b[:, lo], kind='mergesort')
+                reach = np.maximum.accumulate(b[order, hi])
+                gaps = b[order[1:], lo] - reach[:-1]
+                k = int(np.argmax(gaps))
+                if gaps[k] >= min_gap and (best is None or gaps[k] > best[0]):
+                    best = (gaps[k], order[:k + 1], order[k + 1:])
+        if best is None:
+            groups.append(idx)
+        else:
+            pending.append(idx[np.sort(best[2])])
+            pending.append(idx[np.sort(best[1])])
 
-            maxy = maxy - step_size_deg
-            miny = miny - step_size_deg
+    if len(groups) == 1:
+        return [geom]
+    return [parts[g[0]] if len(g) == 1 else type(geom)([parts[i] for i in g])
+            for g in groups]
 
 
 def rasterize_geom(geom, shape, affine, all_touched=False):
@@ -160,6 +249,52 @@ def rebin_sum(a, shape, dtype):
     return a.reshape(sh).sum(-1, dtype=dtype).sum(1, dtype=dtype)
 
 
+def block_aggregates(arr, inside, nodata, block_shape):
+    """Count, sum, sum of squared deviations from the mean, min, max and
+    number of nodata and nan pixels of the blocks of arr
+
+    Parameters
+    ----------
+    arr: 2d array, a multiple of block_shape in shape
+    inside: boolean array of the same shape, False for the pixels to
+        ignore (e.g. padding beyond the raster)
+    nodata: nodata value
+    block_shape: (rows, cols) of the blocks
+
+    Returns
+    -------
+    dict of 2d arrays, one element per block. Blocks without values have
+    a count of zero, an infinite min and max.
+    """
+    block_rows, block_cols = block_shape
+    rows, cols = arr.shape[0] // block_rows, arr.shape[1] // block_cols
+
+    def blocks(a):
+        return a.reshape(rows, block_rows, cols, block_cols)
+
+    arr = blocks(arr)
+    isnodata = blocks(inside) & (arr == nodata)
+    isnan = np.zeros_like(isnodata)
+    if np.issubdtype(arr.dtype, np.floating):
+        isnan = blocks(inside) & np.isnan(arr)
+    valid = blocks(inside) & ~isnodata & ~isnan
+
+    count = valid.sum(axis=(1, 3))
+    values = np.where(valid, arr, 0).astype('float64')
+    total = values.sum(axis=(1, 3))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+    deviations = np.where(valid, values - mean[:, None, :, None], 0)
+    return {
+        'count': count.astype('int64'),
+        'total': total,
+        'm2': (deviations ** 2).sum(axis=(1, 3)),
+        'min': np.where(valid, values, np.inf).min(axis=(1, 3)),
+        'max': np.where(valid, values, -np.inf).max(axis=(1, 3)),
+        'nodata': isnodata.sum(axis=(1, 3)).astype('int64'),
+        'nan': isnan.sum(axis=(1, 3)).astype('int64')}
+
+
 def rasterize_pctcover_geom(geom, shape, affine, scale=None, all_touched=False):
     """
     Parameters
@@ -193,6 +328,191 @@ def rasterize_pctcover_geom(geom, shape, affine, scale=None, all_touched=False):
     return rv_array.astype('float32') / (scale**2)
 
 
+def rasterize_edge_pctcover_geom(geom, shape, affine, scale=None,
+                                 all_touched=False):
+    """Percent cover of a polygon, supersampling only its boundary cells
+
+    Cells not crossed by the boundary of the polygon are either fully
+    covered or not at all, which rasterizing at the native resolution
+    tells. The boundary cells are supersampled as in
+    ``rasterize_pctcover_geom``, one block of at most EDGE_BLOCK_PIXELS
+    supersampled pixels at a time, so that memory does not grow with the
+    size of the window.
+
+    Returns
+    -------
+    ndarray: float32
+    """
+    cover = rasterize_geom(geom, shape, affine).astype('float32')
+    edges = rasterize_geom(geom.boundary, shape, affine, all_touched=True)
+    side = max(1, int(math.sqrt(EDGE_BLOCK_PIXELS)) // scale)
+    rows, cols = np.nonzero(edges)
+    blocks = np.unique(np.stack([rows // side, cols // side], axis=1), axis=0) \
+        if rows.size else []
+    for block_row, block_col in blocks:
+        row, col = block_row * side, block_col * side
+        block_shape = (min(side, shape[0] - row), min(side, shape[1] - col))
+        block_affine = affine * Affine.translation(col, row)
+        block_edges = edges[row:row + block_shape[0], col:col + block_shape[1]]
+        block_cover = rasterize_pctcover_geom(
+            geom, block_shape, block_affine, scale=scale,
+            all_touched=all_touched)
+        cover[row:row + block_shape[0], col:col + block_shape[1]][block_edges] = \
+            block_cover[block_edges]
+    return cover
+
+
+def _polygon_edges(geom):
+    """(x0, y0, x1, y1) arrays of the edges of the polygons of geom,
+    exteriors counterclockwise and interiors clockwise"""
+    parts = getattr(geom, 'geoms', [geom])
+    edges = []
+    for part in parts:
+        if part.is_empty:
+            continue
+        if part.geom_type == 'Polygon':
+            part = orient(part, sign=1.0)
+            for ring in [part.exterior] + list(part.interiors):
+                xy = np.asarray(ring.coords)[:, :2]
+                edges.append(np.hstack([xy[:-1], xy[1:]]))
+        elif hasattr(part, 'geoms'):
+            edges.append(np.column_stack(_polygon_edges(part)))
+    if not edges:
+        return [np.empty(0)] * 4
+    edges = np.concatenate(edges)
+    return edges[:, 0], edges[:, 1], edges[:, 2], edges[:, 3]
+
+
+def _split_segments(x0, y0, x1, y1, t):
+    """Split segments at parameters t (one column per split, nan for none)"""
+    n = x0.size
+    t = np.sort(np.column_stack([np.zeros(n), t, np.ones(n)]), axis=1)
+    ta, tb = t[:, :-1], t[:, 1:]
+    keep = ~np.isnan(tb) & (tb > ta)
+    ids = np.nonzero(keep)[0]
+    ta, tb = ta[keep], tb[keep]
+    dx, dy = (x1 - x0)[ids], (y1 - y0)[ids]
+    return (x0[ids] + ta * dx, y0[ids] + ta * dy,
+            x0[ids] + tb * dx, y0[ids] + tb * dy)
+
+
+def _crossings(a0, a1, lines):
+    """Parameter of the crossing of each segment with each of lines,
+    nan where it does not cross"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = (np.asarray(lines)[None, :] - a0[:, None]) / (a1 - a0)[:, None]
+    t[~((t > 0) & (t < 1))] = np.nan
+    return t
+
+
+def _grid_split(x0, y0, x1, y1):
+    """Split segments at all the integer x and y lines they cross"""
+    n = x0.size
+    ts, ids = [np.zeros(n), np.ones(n)], [np.arange(n), np.arange(n)]
+    for a0, a1 in ((x0, x1), (y0, y1)):
+        first = np.floor(np.minimum(a0, a1)) + 1
+        last = np.ceil(np.maximum(a0, a1)) - 1
+        count = np.maximum(last - first + 1, 0).astype('int64')
+        seg = np.repeat(np.arange(n), count)
+        starts = np.repeat(np.cumsum(count) - count, count)
+        lines = first[seg] + (np.arange(seg.size) - starts)
+        ts.append((lines - a0[seg]) / (a1 - a0)[seg])
+        ids.append(seg)
+    t, ids = np.concatenate(ts), np.concatenate(ids)
+    order = np.lexsort((t, ids))
+    t, ids = t[order], ids[order]
+    same = ids[1:] == ids[:-1]
+    ta, tb, ids = t[:-1][same], t[1:][same], ids[:-1][same]
+    dx, dy = (x1 - x0)[ids], (y1 - y0)[ids]
+    return (x0[ids] + ta * dx, y0[ids] + ta * dy,
+            x0[ids] + tb * dx, y0[ids] + tb * dy)
+
+
+def rasterize_exact_cover_geom(geom, shape, affine):
+    """Exact fraction of the area of each cell covered by a polygon
+
+    The cell coverage follows from Green's theorem: every edge of the
+    polygon, split where it crosses cell boundaries, contributes the signed
+    area between itself and the right side of its cell to that cell, and
+    its full height to the cells on its right in the same row, which a
+    cumulative sum along the rows adds up. Edges outside of the window are
+    clamped to its sides, so the cost only depends on the number of edges
+    and of the cells they cross.
+
+    Parameters
+    ----------
+    geom: shapely Polygon or MultiPolygon
+    shape: desired shape
+    affine: desired transform
+
+    Returns
+    -------
+    ndarray: float64, coverage fraction of each cell between 0 and 1
+    """
+    height, width = shape
+    x0, y0, x1, y1 = _polygon_edges(geom)
+    if not x0.size:
+        return np.zeros(shape)
+
+    # to pixel space, where cells are unit squares
+    inverse = ~affine
+    x0, y0 = inverse * (x0, y0)
+    x1, y1 = inverse * (x1, y1)
+
+    # clip to the window: split where edges cross its sides, then move the
+    # pieces outside of it onto the sides. Left of the window, an edge
+    # covers the whole row; right, above or below it, nothing.
+    t = np.column_stack([_crossings(x0, x1, [0, width]),
+                         _crossings(y0, y1, [0, height])])
+    x0, y0, x1, y1 = _split_segments(x0, y0, x1, y1, t)
+    x0, x1 = np.clip(x0, 0, width), np.clip(x1, 0, width)
+    y0, y1 = np.clip(y0, 0, height), np.clip(y1, 0, height)
+    keep = y0 != y1
+    x0, y0, x1, y1 = _grid_split(x0[keep], y0[keep], x1[keep], y1[keep])
+
+    dy = y1 - y0
+    mid_x, mid_y = (x0 + x1) / 2, (y0 + y1) / 2
+    col = np.floor(mid_x).astype('int64')
+    row = np.floor(mid_y).astype('int64')
+    frac = mid_x - col
+    keep = (dy != 0) & (row >= 0) & (row < height)
+    row, col, dy, frac = row[keep], col[keep], dy[keep], frac[keep]
+
+    # one extra column for edges on the right side, one for the carry
+    cells = row * (width + 2) + col
+    size = height * (width + 2)
+    acc = np.bincount(cells, weights=dy * (1 - frac), minlength=size) + \
+        np.bincount(cells + 1, weights=dy * frac, minlength=size)
+    cover = np.cumsum(acc.reshape(height, width + 2), axis=1)[:, :width]
+
+    # exteriors are counterclockwise in space, in pixel space only if the
+    # transform preserves orientation
+    if affine.determinant > 0:
+        cover = -cover
+    return np.clip(cover, 0, 1)
+
+
+def rasterize_cover_geom(geom, shape, affine, method='supersample',
+                         scale=None, all_touched=False):
+    """Fraction of each cell covered by geom, computed with `method`
+    (see PERCENT_COVER_METHODS). Other geometries than polygons are
+    always supersampled.
+
+    Returns
+    -------
+    ndarray: float
+    """
+    if geom.geom_type in ('Polygon', 'MultiPolygon'):
+        if method == 'exact':
+            return rasterize_exact_cover_geom(geom, shape, affine)
+        if method == 'edge':
+            return rasterize_edge_pctcover_geom(geom, shape, affine,
+                                                scale=scale,
+                                                all_touched=all_touched)
+    return rasterize_pctcover_geom(geom, shape, affine, scale=scale,
+                                   all_touched=all_touched)
+
+
 def stats_to_csv(stats):
     if sys.version_info[0] >= 3:
         from io import StringIO as IO  # pragma: no cover
@@ -239,12 +559,105 @@ def check_stats(stats, categorical):
                 "Stat `%s` not valid; "
                 "must be one of \n %r" % (x, VALID_STATS))
 
-    run_count = False
-    if categorical or 'majority' in stats or 'minority' in stats or 'unique' in stats:
-        # run the counter once, only if needed
-        run_count = True
+    return stats, plan_stats(stats, categorical)
+
+
+# intermediate results shared by the stats of a zone, each computed once:
+# value_counts, whether the sorted distinct values and their counts are needed
+# quantiles, list of (stat, q) for median and the percentile_{q} stats
+StatsPlan = namedtuple('StatsPlan', ['value_counts', 'quantiles'])
+
+
+def plan_stats(stats, categorical):
+    """Plan the intermediate results needed to compute stats
 
-    return stats, run_count
+    The value counts are needed by categorical, majority, minority and
+    unique; when they are computed, median and percentiles are read from
+    their cumulative counts rather than sorting the values again.
+    Otherwise all of them come from a single ``np.percentile`` call.
+    """
+    value_counts = (categorical or 'majority' in stats or
+                    'minority' in stats or 'unique' in stats)
+    quantiles = [(s, 50.0) for s in stats if s == 'median'] + \
+        [(s, get_percentile(s)) for s in stats if s.startswith('percentile_')]
+    return StatsPlan(value_counts, quantiles)
+
+
+def get_quantiles(qs, values=None, keys=None, counts=None):
+    """Percentiles qs of values, interpolated linearly like np.percentile
+
+    Computed from the sorted distinct `keys` and their `counts` if given,
+    otherwise with a single partition of `values`.
+    """
+    if keys is None:
+        return np.percentile(values, qs).tolist()
+    cumulative = np.cumsum(counts)
+    position = np.asarray(qs, dtype='float64') / 100.0 * (cumulative[-1] - 1)
+    lower = keys[np.searchsorted(cumulative, np.floor(position), side='right')]
+    upper = keys[np.searchsorted(cumulative, np.ceil(position), side='right')]
+    fraction = position - np.floor(position)
+    return (lower + (upper - lower) * fraction).tolist()
+
+
+def value_counts(values):
+    """Sorted distinct values and the number of times each occurs
+
+    Integer values within a bounded range (e.g. land cover classes) are
+    counted in linear time with np.bincount rather than sorted.
+    """
+    kind, itemsize = values.dtype.kind, values.dtype.itemsize
+    if values.size and (kind == 'i' or (kind == 'u' and itemsize < 8)):
+        vmin, vmax = int(values.min()), int(values.max())
+        if vmax - vmin < max(BINCOUNT_MAX_RANGE, values.size):
+            counts = np.bincount(values.astype('int64') - vmin)
+            keys = np.flatnonzero(counts)
+            return (keys + vmin).astype(values.dtype), counts[keys]
+    return np.unique(values, return_counts=True)
+
+
+def category_lookup(category_map):
+    """Array lookup of the names of integer categories
+
+    Returns (offset, names, named), such that integer value v is named
+    names[v - offset] where named[v - offset], or None if the categories
+    are not all integers within a bounded range.
+    """
+    if not category_map:
+        return None
+    try:
+        values = [int(k) for k in category_map]
+    except (TypeError, ValueError):
+        return None
+    if any(v != k for v, k in zip(values, category_map)):
+        return None
+    offset = min(values)
+    span = max(values) - offset + 1
+    if span > BINCOUNT_MAX_RANGE:
+        return None
+    names = np.empty(span, dtype=object)
+    named = np.zeros(span, dtype=bool)
+    for v, k in zip(values, category_map):
+        names[v - offset] = category_map[k]
+        named[v - offset] = True
+    return offset, names, named
+
+
+def category_counts(keys, counts, category_map=None, lookup=None):
+    """Categorical stats: dict of the count of each value, with the values
+    renamed by category_map (using its `category_lookup` for integer keys)"""
+    if not category_map:
+        return dict(zip(keys.tolist(), counts.tolist()))
+    if lookup is None or keys.dtype.kind not in 'iu':
+        return remap_categories(category_map,
+                                dict(zip(keys.tolist(), counts.tolist())))
+    offset, names, named = lookup
+    index = keys.astype('int64') - offset
+    inside = (index >= 0) & (index < names.size)
+    renamed = np.zeros(keys.size, dtype=bool)
+    renamed[inside] = named[index[inside]]
+    categories = np.array(keys.tolist(), dtype=object)
+    categories[renamed] = names[index[renamed]]
+    return dict(zip(categories.tolist(), counts.tolist()))
 
 
 def remap_categories(category_map, stats):
@@ -345,3 +758,112 @@ def calc_haversine_distance(p1, p2):
     d = radius * c
 
     return d
+
+
+def hilbert_distance(x, y, bits=16):
+    """Distance along a Hilbert curve filling a 2**bits square grid
+
+    Parameters
+    ----------
+    x, y: array-like of integer cell coordinates in [0, 2**bits)
+
+    Returns
+    -------
+    ndarray: uint64
+    """
+    x = np.array(x, dtype=np.uint64)
+    y = np.array(y, dtype=np.uint64)
+    n = np.uint64(1 << bits)
+    d = np.zeros(x.shape, dtype=np.uint64)
+    s = 1 << (bits - 1)
+    while s > 0:
+        rx = (x & np.uint64(s)) > 0
+        ry = (y & np.uint64(s)) > 0
+        d += np.uint64(s * s) * ((3 * rx.astype(np.uint64)) ^ ry.astype(np.uint64))
+        # rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, n - np.uint64(1) - x, x)
+        y = np.where(flip, n - np.uint64(1) - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+def zorder_distance(x, y, bits=16):
+    """Distance along a Z-order (Morton) curve filling a 2**bits square grid
+    """
+    x = np.array(x, dtype=np.uint64)
+    y = np.array(y, dtype=np.uint64)
+    d = np.zeros(x.shape, dtype=np.uint64)
+    for b in range(bits):
+        bit = np.uint64(1 << b)
+        d |= ((x & bit) << np.uint64(b)) | ((y & bit) << np.uint64(b + 1))
+    return d
+
+
+def spatial_sort(features, order='hilbert', bits=16):
+    """Return the permutation sorting features along a space filling curve
+    through the centers of their bounding boxes
+    """
+    if order not in SPATIAL_ORDERS:
+        raise ValueError("order must be one of {0}".format(SPATIAL_ORDERS))
+
+    bounds = np.array([shape(feat['geometry']).bounds for feat in features],
+                      dtype='float64').reshape(-1, 4)
+    cx = (bounds[:, 0] + bounds[:, 2]) / 2.0
+    cy = (bounds[:, 1] + bounds[:, 3]) / 2.0
+
+    # scale the centers onto the curve's grid
+    cells = (1 << bits) - 1
+    ix, iy = [np.zeros(len(c)) if not len(c) or c.max() == c.min() else
+              np.round((c - c.min()) / (c.max() - c.min()) * cells)
+              for c in (cx, cy)]
+
+    if order == 'hilbert':
+        dist = hilbert_distance(ix, iy, bits)
+    else:
+        dist = zorder_distance(ix, iy, bits)
+    return np.argsort(dist, kind='mergesort')
+
+
+def gen_spatially_ordered(process, features, order='hilbert',
+                          buffer_size=ORDER_BUFFER_SIZE):
+    """Run `process` over features in space filling curve order,
+    yielding its results in the original order of the features
+
+    Features are sorted in buffers of `buffer_size`, which bounds the
+    number of features and results held in memory.
+
+    Parameters
+    ----------
+    process: callable
+        Takes an iterable of features, returns an iterable with one
+        result per feature, in the same order.
+    features: iterable of GeoJSON-like features
+    order: 'hilbert' or 'zorder'
+    buffer_size: number of features sorted together
+    """
+    permutations = deque()
+
+    def sorted_features():
+        it = iter(features)
+        while True:
+            buffered = list(islice(it, buffer_size))
+            if not buffered:
+                return
+            permutation = spatial_sort(buffered, order)
+            permutations.append(permutation)
+            for i in permutation:
+                yield buffered[i]
+
+    done = []
+    for result in process(sorted_features()):
+        done.append(result)
+        # put a buffer back in input order once all its results are in
+        if len(done) == len(permutations[0]):
+            restored = [None] * len(done)
+            for i, res in zip(permutations.popleft(), done):
+                restored[i] = res
+            for res in restored:
+                yield res
+            done = []
@@ -221,6 +221,22 @@ def test_boundless_masked():
     assert c.mask.any() and not c.mask.all()
 
 
+def test_boundless_dtype():
+    land = np.arange(16, dtype='uint8').reshape(4, 4)
+    inside = boundless_array(land, window=((1, 3), (1, 4)), nodata=255)
+    assert inside.dtype == np.uint8
+    assert np.shares_memory(inside, land)
+    padded = boundless_array(land, window=((-1, 2), (0, 4)), nodata=255)
+    assert padded.dtype == np.uint8
+    assert padded[0].tolist() == [255] * 4
+    assert padded[1:].tolist() == land[:2].tolist()
+    # nodata values not fitting the dtype
+    assert boundless_array(land, window=((-1, 2), (0, 4)),
+                           nodata=-999).dtype == np.int16
+    assert boundless_array(land, window=((-1, 2), (0, 4)),
+                           nodata=0.5).dtype == np.float32
+
+
 def test_window_bounds():
     with rasterio.open(raster) as src:
         win = ((0, src.shape[0]), (0, src.shape[1]))
@@ -245,6 +261,7 @@ def test_rowcol():
         assert rowcol(x, y, src.affine, op=math.floor) == (0, 0)
         assert rowcol(x, y, src.affine, op=math.ceil) == (1, 1)
 
+
 def test_Raster_index():
     x, y = 245114, 1000968
     with rasterio.open(raster) as src:
@@ -276,6 +293,62 @@ def test_Raster():
     # If the abstraction is correct, the arrays are equal
     assert np.array_equal(r1.array, r2.array)
 
+
+def test_Raster_cache():
+    bounds = (244156, 1000258, 245114, 1000968)
+    with Raster(raster, band=1) as rast:
+        expected = rast.read(bounds).array
+        outside = rast.read(window=((-10, -5), (-10, -5))).array
+
+    with Raster(raster, band=1, cache_size=10 * 2 ** 20) as rast:
+        assert np.array_equal(rast.read(bounds).array, expected)
+        misses = rast.cache.misses
+        assert misses > 0 and rast.cache.hits == 0
+        # same window again is assembled from cached blocks only
+        assert np.array_equal(rast.read(bounds).array, expected)
+        assert rast.cache.misses == misses
+        assert rast.cache.hits == misses
+        assert np.array_equal(
+            rast.read(window=((-10, -5), (-10, -5))).array, outside)
+        assert rast.read(bounds, masked=True).array.mask.any()
+
+
+def test_Raster_read_windows():
+    windows = [((10, 30), (20, 50)), ((-5, 10), (70, 90)), ((-10, -5), (0, 5))]
+    with rasterio.open(raster) as src, Raster(raster, band=1) as rast:
+        for window in windows:
+            expected = src.read(1, window=window, boundless=True, masked=True)
+            masked = rast.read(window=window, masked=True).array
+            assert np.array_equal(masked.mask, expected.mask)
+            assert np.array_equal(masked.compressed(), expected.compressed())
+            array = rast.read(window=window).array
+            assert array.dtype == src.dtypes[0]
+            assert np.array_equal(array[~expected.mask], expected.compressed())
+            assert (array[expected.mask] == src.nodata).all()
+
+
+def test_Raster_reuse_buffer():
+    with Raster(raster, band=1) as rast:
+        a = rast.read(window=((10, 30), (20, 50)), reuse_buffer=True).array
+        expected = a.copy()
+        b = rast.read(window=((0, 5), (0, 5)), reuse_buffer=True).array
+        assert np.shares_memory(a, b)
+        assert np.array_equal(b, rast.read(window=((0, 5), (0, 5))).array)
+        c = rast.read(window=((10, 30), (20, 50))).array
+        assert not np.shares_memory(a, c)
+        assert np.array_equal(c, expected)
+
+
+def test_Raster_cache_budget():
+    with Raster(raster, band=1) as rast:
+        block_bytes = rast.read(window=((0, 24), (0, 84))).array.nbytes
+
+    with Raster(raster, band=1, cache_size=2 * block_bytes) as rast:
+        rast.read(window=((0, 78), (0, 84)))
+        assert len(rast.cache) == 2
+        assert rast.cache.nbytes <= rast.cache.max_bytes
+
+
 def test_Raster_context():
     # Assigned a regular name, stays open
     r1 = Raster(raster, band=1)
@@ -111,6 +111,17 @@ def test_point_query_nodata():
     assert round(val) == 43
 
 
+def test_point_query_order():
+    points = os.path.join(os.path.dirname(__file__), 'data/points.shp')
+    expected = point_query(points, raster)
+    assert point_query(points, raster, order='hilbert') == expected
+    assert point_query(points, raster, order='zorder') == expected
+    features = point_query(points, raster, geojson_out=True)
+    assert all(isinstance(feat, dict) for feat in features)
+    assert point_query(points, raster, order='hilbert',
+                       geojson_out=True) == features
+
+
 def test_geom_xys():
     from shapely.geometry import (Point, MultiPoint,
                                   LineString, MultiLineString,
@@ -132,3 +143,227 @@ def test_geom_xys():
                                      (2, 2), (3, 3), (3, 2), (2, 2)]
     mpt3d = MultiPoint([(0, 0, 1), (1, 1, 2)])
     assert list(geom_xys(mpt3d)) == [(0, 0), (1, 1)]
+
+
+def test_geom_coords():
+    from shapely.geometry import Point, MultiPolygon, Polygon, MultiPoint
+    from rasterstats.point import geom_coords
+    poly = Polygon([(0, 0), (1, 1), (1, 0)])
+    for geom in (Point(0, 0), MultiPoint([(0, 0, 1), (1, 1, 2)]), poly,
+                 MultiPolygon([poly, Polygon([(2, 2), (3, 3), (3, 2)])])):
+        assert geom_coords(geom).tolist() == \
+            [list(xy) for xy in geom_xys(geom)]
+
+
+def _assert_values_close(values, expected):
+    import pytest
+    assert len(values) == len(expected)
+    for value, other in zip(values, expected):
+        if isinstance(other, list):
+            _assert_values_close(value, other)
+        elif other is None:
+            assert value is None
+        else:
+            assert value == pytest.approx(other)
+
+
+def test_point_query_batch():
+    import pytest
+    from rasterstats.point import gen_batch_point_query
+    from rasterstats.io import read_features, Raster
+    data = os.path.join(os.path.dirname(__file__), 'data')
+    features = [feat for name in ('points.shp', 'lines.shp', 'polygons.shp')
+                for feat in read_features(os.path.join(data, name))]
+    # on and off the raster, partly nodata
+    features += [{'type': 'Feature', 'properties': {}, 'geometry': {
+        'type': 'MultiPoint', 'coordinates': [
+            (245309, 1000308), (244000, 1000308), (245905, 1000361),
+            (245309, 1000064)]}}]
+    with rasterio.open(raster_nodata) as src:
+        arr = src.read(1)
+        nodata = src.nodata
+
+    for source, kwargs in ((raster, {}), (raster_nodata, {}),
+                           (arr, {'affine': affine, 'nodata': nodata})):
+        for interpolate in ('nearest', 'bilinear'):
+            expected = point_query(features, source, interpolate=interpolate,
+                                   **kwargs)
+            values = point_query(features, source, interpolate=interpolate,
+                                 engine='batch', **kwargs)
+            _assert_values_close(values, expected)
+
+    # batches of features, block reads through the cache
+    expected = point_query(features, raster_nodata)
+    with Raster(raster_nodata, cache_size=2 ** 20) as rast:
+        results = list(gen_batch_point_query(features, rast, batch_size=3))
+        assert rast.cache.misses > 0
+    assert [feat for feat, _ in results] == features
+    _assert_values_close([vals[0] if len(vals) == 1 else vals
+                          for _, vals in results], expected)
+
+    with pytest.raises(ValueError):
+        point_query(features, raster, engine='foo')
+
+
+def test_point_query_batch_reads():
+    from rasterstats.point import gen_batch_point_query
+    from rasterstats.io import Raster
+    points = [{'type': 'Feature', 'properties': {}, 'geometry': {
+        'type': 'Point', 'coordinates': affine * (col + 0.3, row + 0.6)}}
+        for row in range(0, 72, 5) for col in range(0, 80, 7)]
+    expected = point_query(points, raster_nodata)
+
+    for region_bytes in (2 ** 20, 0):
+        with Raster(raster_nodata) as rast:
+            reads = []
+            read = rast.src.read
+
+            def counting_read(*args, **kwargs):
+                reads.append(kwargs['window'])
+                return read(*args, **kwargs)
+
+            rast.src.read = counting_read
+            results = list(gen_batch_point_query(
+                points, rast, region_bytes=region_bytes))
+            block_height, block_width = rast.src.block_shapes[0]
+            # the points and their neighbours are in rows 0 to 71
+            blocks = -(-72 // block_height)
+
+        assert [vals[0] for _, vals in results] == expected
+        if region_bytes:
+            # a single read of the window bounding all points
+            assert len(reads) == 1
+        else:
+            # one read per block
+            assert len(reads) == len(set(reads)) == blocks
+
+
+def _write_stack(path):
+    """Three band copy of raster_nodata, the second band with more nodata"""
+    import numpy as np
+    with rasterio.open(raster_nodata) as src:
+        arr = src.read(1)
+        profile = src.profile
+    stack = np.stack([arr, np.where(arr > 40, arr, profile['nodata']), arr * 2])
+    profile.update(count=3)
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(stack)
+    return stack, profile['nodata']
+
+
+def test_point_query_bands(tmpdir):
+    import pytest
+    points = os.path.join(os.path.dirname(__file__), 'data/points.shp')
+    lines = os.path.join(os.path.dirname(__file__), 'data/lines.shp')
+    path = str(tmpdir.join('stack.tif'))
+    stack, nodata = _write_stack(path)
+
+    for vectors in (points, lines):
+        for interpolate in ('nearest', 'bilinear'):
+            per_band = [point_query(vectors, path, band=b,
+                                    interpolate=interpolate)
+                        for b in (1, 2, 3)]
+            for band, bands in (([1, 2, 3], per_band),
+                                (slice(1, None), per_band[1:])):
+                # the values of the bands of each vertex of each feature
+                expected = []
+                for feat in zip(*bands):
+                    if isinstance(feat[0], list):
+                        expected.append([list(v) for v in zip(*feat)])
+                    else:
+                        expected.append(list(feat))
+                for raster_, kwargs in (
+                        (path, {}),
+                        (stack, {'affine': affine, 'nodata': nodata})):
+                    values = point_query(vectors, raster_, band=band,
+                                         interpolate=interpolate, **kwargs)
+                    _assert_values_close(values, expected)
+
+    # a single band of a 3D array
+    assert point_query(points, stack, band=3, affine=affine,
+                       nodata=nodata) == \
+        pytest.approx(point_query(points, path, band=3))
+
+
+def test_point_query_band_field(tmpdir):
+    import pytest
+    from rasterstats.io import read_features
+    path = str(tmpdir.join('stack.tif'))
+    stack, nodata = _write_stack(path)
+    data = os.path.join(os.path.dirname(__file__), 'data')
+    features = [feat for name in ('points.shp', 'lines.shp')
+                for feat in read_features(os.path.join(data, name))]
+    for i, feat in enumerate(features):
+        feat['properties'] = {'day': i % 3 + 1}
+
+    for interpolate in ('nearest', 'bilinear'):
+        per_band = [point_query(features, path, band=b,
+                                interpolate=interpolate) for b in (1, 2, 3)]
+        expected = [per_band[feat['properties']['day'] - 1][i]
+                    for i, feat in enumerate(features)]
+        for raster_, kwargs in ((path, {}),
+                                (stack, {'affine': affine, 'nodata': nodata})):
+            values = point_query(features, raster_, band_field='day',
+                                 interpolate=interpolate, **kwargs)
+            _assert_values_close(values, expected)
+        values = point_query(features, path, interpolate=interpolate,
+                             band_field=lambda f: f['properties']['day'])
+        _assert_values_close(values, expected)
+
+    with pytest.raises(ValueError):
+        point_query(features, path, band=[1, 2], band_field='day')
+    features[0]['properties']['day'] = 4
+    with pytest.raises(ValueError):
+        point_query(features, path, band_field='day')
+
+
+def test_line_samples():
+    import pytest
+    from shapely.geometry import LineString, MultiLineString, Point
+    from rasterstats.point import line_samples
+    xys, distances = line_samples(LineString([(0, 0), (3, 0), (3, 2.5)]), 1)
+    assert distances.tolist() == [0, 1, 2, 3, 4, 5, 5.5]
+    assert xys.tolist() == [[0, 0], [1, 0], [2, 0], [3, 0], [3, 1], [3, 2],
+                            [3, 2.5]]
+    # distances run on along the parts
+    xys, distances = line_samples(MultiLineString(
+        [[(0, 0), (0, 2)], [(5, 5), (5, 5), (6, 5)]]), 1)
+    assert distances.tolist() == [0, 1, 2, 2, 3]
+    assert xys.tolist() == [[0, 0], [0, 1], [0, 2], [5, 5], [6, 5]]
+    with pytest.raises(ValueError):
+        line_samples(Point(0, 0), 1)
+
+
+def test_line_profile():
+    import pytest
+    from rasterstats import line_profile
+    from rasterstats.io import read_features
+    # along the centers of a row of pixels, into the nodata
+    start, end = affine * (10.5, 20.5), affine * (60.5, 20.5)
+    line = {'type': 'Feature', 'properties': {}, 'geometry': {
+        'type': 'LineString', 'coordinates': [start, end]}}
+    for interpolate in ('nearest', 'bilinear'):
+        profile = line_profile([line], raster_nodata,
+                               interpolate=interpolate)[0]
+        assert profile['distance'] == pytest.approx(
+            [i * affine.a for i in range(51)])
+        points = [{'type': 'Point', 'coordinates': affine * (col + 0.5, 20.5)}
+                  for col in range(10, 61)]
+        _assert_values_close(
+            profile['value'],
+            point_query(points, raster_nodata, interpolate=interpolate))
+        assert None in profile['value']
+
+    lines = os.path.join(os.path.dirname(__file__), 'data/lines.shp')
+    profiles = line_profile(lines, raster, step=2.5, batch_size=1)
+    features = line_profile(lines, raster, step=2.5, geojson_out=True,
+                            property_name='elevation')
+    assert [f['properties']['elevation'] for f in features] == profiles
+    for feat, profile in zip(read_features(lines), profiles):
+        assert len(profile['distance']) == len(profile['value']) > 2
+        assert profile['value'][0] == pytest.approx(
+            point_query({'type': 'Point', 'coordinates':
+                         feat['geometry']['coordinates'][0]}, raster)[0])
+
+    with pytest.raises(ValueError):
+        line_profile(lines, raster, step=0)
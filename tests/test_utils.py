@@ -3,11 +3,16 @@ import os
 import pytest
 import numpy as np
 from affine import Affine
-from shapely.geometry import LineString, Polygon, Point, box
+from shapely.geometry import LineString, Polygon, Point, box, MultiPolygon
 from rasterstats.utils import \
     stats_to_csv, get_percentile, remap_categories, boxify_points, \
     get_latitude_scale, calc_haversine_distance, \
-    rebin_sum, rasterize_pctcover_geom, split_geom
+    rebin_sum, rasterize_pctcover_geom, rasterize_edge_pctcover_geom, \
+    rasterize_exact_cover_geom, \
+    rasterize_cover_geom, split_geom, \
+    hilbert_distance, zorder_distance, spatial_sort, gen_spatially_ordered, \
+    check_stats, get_quantiles, value_counts, category_lookup, category_counts, \
+    group_parts
 
 from rasterstats import zonal_stats
 from rasterstats.utils import VALID_STATS
@@ -55,6 +60,54 @@ def test_get_bad_percentile():
         get_percentile('percentile_foobar')
 
 
+def test_check_stats_plan():
+    stats, plan = check_stats('min median percentile_90', False)
+    assert stats == ['min', 'median', 'percentile_90']
+    assert not plan.value_counts
+    assert plan.quantiles == [('median', 50.0), ('percentile_90', 90.0)]
+    _, plan = check_stats('majority', False)
+    assert plan.value_counts and not plan.quantiles
+    _, plan = check_stats(None, True)
+    assert plan.value_counts
+
+
+def test_get_quantiles():
+    values = np.array([3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5], dtype='float32')
+    qs = [0, 12.5, 50, 62.5, 99, 100]
+    expected = np.percentile(values, qs)
+    assert np.allclose(get_quantiles(qs, values), expected)
+    keys, counts = np.unique(values, return_counts=True)
+    assert np.allclose(get_quantiles(qs, keys=keys, counts=counts), expected)
+
+
+def test_value_counts():
+    for dtype in ['uint8', 'int16', 'int64', 'float32']:
+        values = np.array([7, 3, 3, 250, 7, 7, 0], dtype=dtype)
+        keys, counts = value_counts(values)
+        assert keys.dtype == values.dtype
+        assert keys.tolist() == [0, 3, 7, 250]
+        assert counts.tolist() == [1, 2, 3, 1]
+    # unbounded range, sorted
+    keys, counts = value_counts(np.array([2 ** 40, -5, 2 ** 40]))
+    assert keys.tolist() == [-5, 2 ** 40]
+    assert counts.tolist() == [1, 2]
+    keys, counts = value_counts(np.array([], dtype='uint8'))
+    assert keys.size == counts.size == 0
+
+
+def test_category_counts():
+    keys = np.array([1, 2, 5, 9], dtype='uint8')
+    counts = np.array([10, 20, 30, 40])
+    category_map = {1: 'water', 5.0: 'forest', 12: 'ice'}
+    lookup = category_lookup(category_map)
+    expected = {'water': 10, 2: 20, 'forest': 30, 9: 40}
+    assert category_counts(keys, counts, category_map, lookup) == expected
+    assert category_counts(keys, counts, category_map) == expected
+    assert category_counts(keys, counts) == {1: 10, 2: 20, 5: 30, 9: 40}
+    assert category_lookup({1.5: 'a'}) is None
+    assert category_lookup({'a': 'b'}) is None
+
+
 def test_remap_categories():
     feature_stats = {1: 22.343, 2: 54.34, 3: 987.5}
     category_map = {1: 'grassland', 2: 'forest'}
@@ -120,6 +173,61 @@ def test_rasterize_pctcover_geom():
     assert np.array_equal(pct_cover_c, correct_output_c)
 
 
+def test_rasterize_edge_pctcover_geom(monkeypatch):
+    affine = Affine(0.5, 0, 10,
+                    0, -0.5, 50)
+    polygon = Point(40, 20).buffer(20).difference(box(30, 15, 35, 25))
+    expected = rasterize_pctcover_geom(polygon, (120, 130), affine, scale=10)
+    cover = rasterize_edge_pctcover_geom(polygon, (120, 130), affine, scale=10)
+    assert cover.dtype == expected.dtype
+    assert np.array_equal(cover, expected)
+    # boundary cells are supersampled in several blocks
+    monkeypatch.setattr('rasterstats.utils.EDGE_BLOCK_PIXELS', 1000)
+    cover = rasterize_edge_pctcover_geom(polygon, (120, 130), affine, scale=10)
+    assert np.array_equal(cover, expected)
+
+
+def test_rasterize_exact_cover_geom():
+    affine = Affine(1, 0, 0,
+                    0, -1, 3)
+    polygon = Point(1.3, 1.4).buffer(1.1).difference(box(1, 1, 1.5, 1.5))
+    cover = rasterize_exact_cover_geom(polygon, (3, 3), affine)
+    expected = np.array([
+        [polygon.intersection(box(col, 2 - row, col + 1, 3 - row)).area
+         for col in range(3)] for row in range(3)])
+    assert np.allclose(cover, expected)
+    assert np.isclose(cover.sum(), polygon.area)
+
+    # parts outside of the window are ignored
+    cover = rasterize_exact_cover_geom(box(-1, 0.5, 0.5, 1), (3, 3), affine)
+    assert np.isclose(cover[2, 0], 0.25)
+    assert np.isclose(cover.sum(), 0.25)
+
+    # the same cells with the rows or columns flipped by the transform
+    polygon = box(0.2, 0.3, 1.9, 2.6)
+    cover = rasterize_exact_cover_geom(polygon, (3, 3), affine)
+    for flipped in (Affine(1, 0, 0, 0, 1, 0), Affine(-1, 0, 3, 0, -1, 3)):
+        flipped_cover = rasterize_exact_cover_geom(polygon, (3, 3), flipped)
+        assert np.isclose(flipped_cover.sum(), polygon.area)
+        assert flipped_cover.min() >= 0
+    # zero area polygons cover nothing, whatever the rounding
+    sliver = Polygon([(0.1, 0.1), (1.7, 1.3), (2.9, 2.2)])
+    assert not rasterize_exact_cover_geom(sliver, (3, 3), affine).any()
+
+
+def test_rasterize_cover_geom():
+    affine = Affine(1, 0, 0,
+                    0, -1, 2)
+    polygon = Polygon([[0.5, 0.5], [1.5, 0.5], [1.5, 1.5], [0.5, 1.5]])
+    exact = rasterize_cover_geom(polygon, (2, 2), affine, method='exact')
+    assert np.allclose(exact, 0.25)
+    # lines are supersampled regardless of the method
+    line = LineString([(0.5, 0.5), (1.5, 0.5)])
+    assert np.array_equal(
+        rasterize_cover_geom(line, (2, 2), affine, method='exact', scale=10),
+        rasterize_pctcover_geom(line, (2, 2), affine, scale=10))
+
+
 def test_split_geom():
     polygon_a = box(0, 0, 10, 10)
     geom_list_a = list(split_geom(polygon_a, limit=40, pixel_size=1, origin=(0, 10)))
@@ -133,9 +241,74 @@ def test_split_geom():
     assert len(geom_list_b) == 9
 
 
+def test_split_geom_pieces():
+    polygon = Point(0, 0).buffer(10).difference(Point(3, 3).buffer(2))
+    pieces = list(split_geom(polygon, limit=16, pixel_size=1, origin=(-10, 10)))
+    assert sum(piece.area for piece in pieces) == pytest.approx(polygon.area, rel=1e-5)
+    for piece in pieces:
+        assert piece.area <= 16
+        assert polygon.buffer(1e-9).contains(piece)
+
+
+def test_group_parts():
+    islands = MultiPolygon([box(0, 0, 1, 1), box(2, 0, 3, 1), box(100, 0, 101, 1),
+                            box(100, 50, 101, 51)])
+    groups = group_parts(islands, min_gap=2)
+    assert sorted(g.bounds for g in groups) == [
+        (0, 0, 3, 1), (100, 0, 101, 1), (100, 50, 101, 51)]
+    assert sum(g.area for g in groups) == islands.area
+    # gaps narrower than min_gap are not split
+    assert len(group_parts(islands, min_gap=60)) == 2
+    # neither are small or dense enough groups
+    assert group_parts(islands, min_gap=2, min_area=1e6) == [islands]
+    assert group_parts(islands, min_gap=2, min_fill=0.0001) == [islands]
+    assert group_parts(box(0, 0, 1, 1), min_gap=2)[0].equals(box(0, 0, 1, 1))
+
+
 def test_no_use_split_geom():
     polygon_a = box(0, 0, 10, 10)
     geom_list_a = list(split_geom(polygon_a, limit=999999999, pixel_size=1, origin=(0, 10)))
     polygon_b =  Point(0,0).buffer(10)
     geom_list_b = list(split_geom(polygon_b, limit=999999999, pixel_size=1, origin=(-10, 10)))
     assert len(geom_list_a) == len(geom_list_b) == 1
+
+
+def test_hilbert_distance():
+    assert hilbert_distance([0, 0, 1, 1], [0, 1, 1, 0], bits=1).tolist() == [0, 1, 2, 3]
+    xs, ys = np.meshgrid(np.arange(8), np.arange(8))
+    d = hilbert_distance(xs.ravel(), ys.ravel(), bits=3)
+    assert sorted(d.tolist()) == list(range(64))
+    # consecutive cells along the curve are neighbours
+    order = np.argsort(d)
+    steps = np.abs(np.diff(xs.ravel()[order])) + np.abs(np.diff(ys.ravel()[order]))
+    assert (steps == 1).all()
+
+
+def test_zorder_distance():
+    assert zorder_distance([0, 1, 0, 1, 2], [0, 0, 1, 1, 0], bits=2).tolist() == [0, 1, 2, 3, 4]
+
+
+def test_spatial_sort():
+    features = [{'geometry': Point(x, y).__geo_interface__}
+                for x, y in [(10, 10), (0, 0), (10, 0), (0.5, 0.5)]]
+    perm = spatial_sort(features, 'hilbert')
+    assert sorted(perm.tolist()) == [0, 1, 2, 3]
+    # the two features near the origin end up next to each other
+    assert abs(perm.tolist().index(1) - perm.tolist().index(3)) == 1
+    with pytest.raises(ValueError):
+        spatial_sort(features, 'random')
+
+
+def test_gen_spatially_ordered():
+    features = [{'geometry': Point(x, x % 7).__geo_interface__, 'id': x}
+                for x in range(25)]
+    seen = []
+
+    def process(feats):
+        for feat in feats:
+            seen.append(feat['id'])
+            yield feat['id']
+
+    assert list(gen_spatially_ordered(process, features, buffer_size=10)) == list(range(25))
+    assert seen != list(range(25))
+    assert sorted(seen[:10]) == list(range(10))
@@ -8,8 +8,8 @@ import numpy as np
 import rasterio
 from rasterstats import zonal_stats, raster_stats
 from rasterstats.utils import VALID_STATS
-from rasterstats.io import read_featurecollection, read_features
-from shapely.geometry import Polygon
+from rasterstats.io import read_featurecollection, read_features, Raster
+from shapely.geometry import Polygon, MultiPolygon, shape
 from affine import Affine
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -137,6 +137,46 @@ def test_categorical_map():
     assert 'cat5' in stats[1]
 
 
+def test_categorical_integer_raster(tmpdir):
+    polygons = os.path.join(DATA, 'polygons.shp')
+    categorical_raster = os.path.join(DATA, 'slope_classes.tif')
+    integer_raster = str(tmpdir.join('slope_classes_uint8.tif'))
+    with rasterio.open(categorical_raster) as src:
+        profile = src.profile
+        classes = src.read(1)
+    profile.update(dtype='uint8', nodata=255)
+    with rasterio.open(integer_raster, 'w', **profile) as dst:
+        dst.write(np.where(classes < 0, 255, classes).astype('uint8'), 1)
+
+    catmap = {5: 'cat5'}
+    expected = zonal_stats(polygons, categorical_raster, categorical=True,
+                           category_map=catmap, stats='majority minority unique')
+    stats = zonal_stats(polygons, integer_raster, categorical=True,
+                        category_map=catmap, stats='majority minority unique')
+    assert stats == expected
+    assert sorted(k for k in stats[1] if type(k) is int) == [1, 2]
+
+
+def test_categorical_integer_ndarray():
+    # integer ndarrays keep their dtype, categories are ints, not floats
+    arr = np.array([[1, 1, 2],
+                    [3, 1, 2],
+                    [3, 3, 3]], dtype='int32')
+    affine = Affine(1, 0, 0, 0, -1, 3)
+    inside = Polygon([[0, 0], [0, 3], [3, 3], [3, 0]])
+    padded = Polygon([[-1, -1], [-1, 2], [2, 2], [2, -1]])
+    for polygon in (inside, padded):
+        stats = zonal_stats(polygon, arr, affine=affine, nodata=-1,
+                            categorical=True, stats='majority minority')
+        categories = [k for k in stats[0] if k not in ('majority', 'minority')]
+        assert categories
+        assert all(type(k) is int for k in categories)
+        # majority and minority remain floats
+        assert type(stats[0]['majority']) is float
+        assert type(stats[0]['minority']) is float
+    assert stats[0] == {1: 1, 3: 3, 'majority': 3.0, 'minority': 1.0}
+
+
 def test_specify_stats_list():
     polygons = os.path.join(DATA, 'polygons.shp')
     stats = zonal_stats(polygons, raster, stats=['min', 'max'])
@@ -211,6 +251,47 @@ def test_no_overlap():
         # no polygon should have any overlap
         assert res['count'] is 0
 
+
+def test_outside_raster_windows(monkeypatch):
+    windows = []
+    read = Raster.read
+    monkeypatch.setattr(Raster, 'read', lambda self, **kw: windows.append(
+        kw.get('window')) or read(self, **kw))
+
+    # disjoint features are not read, their pixels are nodata
+    polygons = os.path.join(DATA, 'polygons_no_overlap.shp')
+    stats = zonal_stats(polygons, raster, stats="count mean nodata")
+    assert windows == []
+    # zone_func takes the whole window
+    expected = zonal_stats(polygons, raster, stats="count mean nodata",
+                           zone_func=lambda zone: None)
+    for res, exp in zip(stats, expected):
+        assert res == {'count': 0, 'mean': None, 'nodata': exp['nodata']}
+        assert res['nodata'] > 0
+
+    # partially overlapping features only read the overlap
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    del windows[:]
+    stats = zonal_stats(polygons, raster, stats="count nodata")
+    assert len(windows) == len(stats)
+    for (row_start, row_stop), (col_start, col_stop) in windows:
+        assert 0 <= row_start < row_stop <= 78
+        assert 0 <= col_start < col_stop <= 84
+    expected = zonal_stats(polygons, raster, stats="count nodata",
+                           zone_func=lambda zone: None)
+    for res, exp in zip(stats, expected):
+        assert res['count'] == exp['count']
+        assert res['nodata'] == exp['nodata']
+
+    # just below the raster, its window still overlaps the last row
+    with Raster(raster) as rast:
+        left, top = rast.affine * (2, 78)
+        right, bottom = rast.affine * (41, 80)
+    below = Polygon([(left, bottom), (left, top), (right, top), (right, bottom)])
+    assert zonal_stats(below, raster, stats="count nodata") == \
+        [{'count': 0, 'nodata': 78.0}]
+
+
 def test_all_touched():
     polygons = os.path.join(DATA, 'polygons.shp')
     stats = zonal_stats(polygons, raster, all_touched=True)
@@ -278,7 +359,7 @@ def test_add_stats():
 
     stats = zonal_stats(polygons, raster, add_stats={'mymean': mymean})
     for i in range(len(stats)):
-        assert stats[i]['mean'] == stats[i]['mymean']
+        assert stats[i]['mean'] == pytest.approx(stats[i]['mymean'])
 
 
 def test_mini_raster():
@@ -313,6 +394,14 @@ def test_zone_func_good():
     assert stats[0]['min'] == 0
     assert stats[0]['mean'] == 0
 
+    # ndarray rasters are not modified
+    with rasterio.open(raster) as src:
+        arr = src.read(1)
+        stats = zonal_stats(polygons, arr, affine=src.transform,
+                            nodata=src.nodata, zone_func=example_zone_func)
+        assert stats[0]['max'] == 0
+        assert np.array_equal(arr, src.read(1))
+
 def test_zone_func_bad():
     not_a_func = 'jar jar binks'
     polygons = os.path.join(DATA, 'polygons.shp')
@@ -527,6 +616,7 @@ def test_nan_counts():
 # -----------------------------------------------------------------------------
 # percent cover and latitude correction tests
 
+
 def test_percent_cover_zonal_stats():
     polygon = Polygon([[0, 0], [0, 1.5], [1, 1.5], [1, 2], [2, 2], [2, 0]])
 
@@ -569,6 +659,60 @@ def test_percent_cover_zonal_stats():
         zonal_stats(polygon, arr, affine=affine, percent_cover_selection='one', percent_cover_scale=10)
 
 
+def test_percent_cover_edge():
+    polygons = os.path.join(DATA, 'polygons.shp')
+    kwargs = dict(stats='count sum mean', percent_cover_weighting=True,
+                  percent_cover_scale=20, all_touched=True)
+    edge = zonal_stats(polygons, raster, percent_cover_method='edge', **kwargs)
+    assert edge == zonal_stats(polygons, raster, **kwargs)
+
+
+def test_percent_cover_exact():
+    polygon = Polygon([[0, 0], [0, 1.5], [1, 1.5], [1, 2], [2, 2], [2, 0]])
+    arr = np.array([
+        [100, 1],
+        [100, 1]
+    ])
+    affine = Affine(1, 0, 0,
+                    0, -1, 2)
+    stats = zonal_stats(polygon, arr, affine=affine, stats='count sum mean',
+                        percent_cover_weighting=True,
+                        percent_cover_method='exact')
+    assert stats[0]['count'] == 3.5
+    assert stats[0]['sum'] == 152
+    assert round(stats[0]['mean'], 4) == round(152 / 3.5, 4)
+
+    stats = zonal_stats(polygon, arr, affine=affine, stats='count',
+                        percent_cover_selection=0.75,
+                        percent_cover_method='exact')
+    assert stats[0]['count'] == 3
+
+    # polygons have no use for a scale with exact coverage
+    with pytest.warns(UserWarning):
+        stats = zonal_stats(polygon, arr, affine=affine, stats='count',
+                            percent_cover_weighting=True,
+                            percent_cover_method='exact',
+                            percent_cover_scale=100)
+    assert stats[0]['count'] == 3.5
+
+    with pytest.raises(ValueError):
+        zonal_stats(polygon, arr, affine=affine, percent_cover_weighting=True,
+                    percent_cover_method='exactly')
+
+
+def test_percent_cover_exact_matches_supersample():
+    polygons = os.path.join(DATA, 'polygons.shp')
+    exact = zonal_stats(polygons, raster, stats='count sum mean',
+                        percent_cover_weighting=True,
+                        percent_cover_method='exact')
+    fine = zonal_stats(polygons, raster, stats='count sum mean',
+                       percent_cover_weighting=True, percent_cover_scale=100,
+                       all_touched=True)
+    for e, f in zip(exact, fine):
+        for stat in ('count', 'sum', 'mean'):
+            assert abs(e[stat] - f[stat]) < 0.005 * abs(f[stat])
+
+
 def test_latitude_correction():
     polygon = os.path.join(DATA, 'latitude_correction_polygon.shp')
     raster = os.path.join(DATA, 'latitude_correction_raster.tif')
@@ -589,11 +733,10 @@ def test_latitude_correction():
 
 def test_geom_split_invalid():
     polygons = os.path.join(DATA, 'polygons.shp')
-    for i in ['minority', 'majority', 'median', 'std', 'unique', 'percentile_50']:
-        with pytest.raises(Exception):
-            zonal_stats(polygons, raster, limit=50, stats=i)
     with pytest.raises(Exception):
         zonal_stats(polygons, raster, limit=50, raster_out=True)
+    with pytest.raises(Exception):
+        zonal_stats(polygons, raster, limit=50, add_stats={'mymean': np.mean})
     with pytest.raises(Exception):
         zonal_stats(polygons, raster, limit=50, zone_func='function')
 
@@ -618,6 +761,51 @@ def test_geom_split_main():
     stats3 = zonal_stats(polygons, raster, limit=50, stats=all_valid_limit_stats)
 
 
+def test_geom_split_all_stats():
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    all_stats = 'count min max mean sum std median majority minority unique ' \
+                'range nodata nan percentile_10 percentile_62.5'
+    stats1 = zonal_stats(polygons, raster, stats=all_stats)
+    stats2 = zonal_stats(polygons, raster, stats=all_stats, limit=50)
+    assert len(stats1) == len(stats2)
+    for s1, s2 in zip(stats1, stats2):
+        assert s1.keys() == s2.keys()
+        for key in s1:
+            assert s1[key] == pytest.approx(s2[key], rel=1e-6)
+
+
+def test_geom_split_latitude_correction():
+    polygons = os.path.join(DATA, 'polygons.shp')
+    for kwargs in [{}, {'percent_cover_weighting': True}]:
+        stats1 = zonal_stats(polygons, raster, stats='mean count',
+                             latitude_correction=True, **kwargs)
+        stats2 = zonal_stats(polygons, raster, stats='mean count', limit=50,
+                             latitude_correction=True, **kwargs)
+        for s1, s2 in zip(stats1, stats2):
+            assert s1.keys() == s2.keys()
+            assert s1['mean'] == pytest.approx(s2['mean'], rel=1e-6)
+            assert s1['count'] == pytest.approx(s2['count'])
+
+
+def test_stats_accumulator_merge():
+    from rasterstats.accumulators import StatsAccumulator
+    stats = ['count', 'sum', 'mean', 'std', 'median', 'majority',
+             'unique', 'percentile_90']
+    values = np.array([3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5], dtype='float32')
+    whole = StatsAccumulator(stats)
+    whole.update(values)
+    parts = [StatsAccumulator(stats) for _ in range(3)]
+    parts[0].update(values[:4])
+    parts[2].update(values[4:])
+    for part in parts[1:]:
+        parts[0].merge(part)
+    expected = {'count': 11, 'sum': 44.0, 'mean': 4.0, 'std': np.std(values),
+                'median': 4.0, 'majority': 5.0, 'unique': 7,
+                'percentile_90': np.percentile(values, 90)}
+    assert whole.result() == pytest.approx(expected)
+    assert parts[0].result() == pytest.approx(expected)
+
+
 def test_no_use_geom_split_categorical():
     polygons = os.path.join(DATA, 'polygons.shp')
     categorical_raster = os.path.join(DATA, 'slope_classes.tif')
@@ -653,6 +841,411 @@ def test_geom_split_percent_cover():
     assert round(stats1[0]['mean'], 2) == round(stats2[0]['mean'], 2) == 15.04
 
 
+def test_sparse_multipart_groups(monkeypatch):
+    islands = MultiPolygon([
+        Polygon([(244310, 1000800), (244400, 1000800), (244380, 1000700)]),
+        Polygon([(246300, 998900), (246420, 999000), (246300, 999010)])])
+    stats = 'count min max mean sum std median majority nodata'
+    kwargs = dict(stats=stats, percent_cover_weighting=True, all_touched=True)
+    whole = zonal_stats(islands, raster, **kwargs)
+    reads = []
+    read = Raster.read
+    monkeypatch.setattr('rasterstats.main.PART_GROUP_MIN_PIXELS', 0)
+    monkeypatch.setattr(Raster, 'read', lambda self, **kw: reads.append(kw) or read(self, **kw))
+    grouped = zonal_stats(islands, raster, **kwargs)
+    assert len(reads) == 2
+    assert grouped[0] == pytest.approx(whole[0])
+
+
+# -----------------------------------------------------------------------------
+# parallel execution
+
+def test_parallel_n_jobs():
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    stats = zonal_stats(polygons, raster, stats="*")
+    assert zonal_stats(polygons, raster, stats="*", n_jobs=2) == stats
+
+
+def test_parallel_executor():
+    from concurrent.futures import ThreadPoolExecutor
+    polygons = os.path.join(DATA, 'polygons.shp')
+    with rasterio.open(raster) as src:
+        arr = src.read(1)
+        affine = src.transform
+    stats = zonal_stats(polygons, arr, affine=affine, geojson_out=True)
+    with ThreadPoolExecutor(2) as executor:
+        stats2 = zonal_stats(polygons, arr, affine=affine, geojson_out=True,
+                             executor=executor)
+    # GeoJSON-like dicts either way, whatever fiona reads the features as
+    assert all(isinstance(feat, dict) for feat in stats + stats2)
+    assert stats == stats2
+
+
+def test_parallel_batches_keep_order():
+    from rasterstats.parallel import gen_parallel_zonal_stats
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    stats = zonal_stats(polygons, raster, stats="count sum")
+    stats2 = list(gen_parallel_zonal_stats(
+        read_features(polygons), (raster, None, None, 1, None),
+        {'stats': "count sum"}, n_jobs=3, batch_size=2))
+    assert stats == stats2
+
+
+def test_parallel_open_raster():
+    from rasterstats.io import Raster
+    polygons = os.path.join(DATA, 'polygons.shp')
+    with Raster(raster) as rast:
+        assert zonal_stats(polygons, rast) == zonal_stats(polygons, raster)
+        assert not rast.src.closed
+        with pytest.raises(ValueError):
+            zonal_stats(polygons, rast, n_jobs=2)
+
+
+# -----------------------------------------------------------------------------
+# raster access
+
+def test_block_cache():
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    stats = zonal_stats(polygons, raster, stats="*")
+    assert zonal_stats(polygons, raster, stats="*", cache_size=2 ** 20) == stats
+
+
+def test_spatial_order():
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    stats = zonal_stats(polygons, raster, stats="*", geojson_out=True)
+    assert all(isinstance(feat, dict) for feat in stats)
+    for order in ['hilbert', 'zorder']:
+        assert zonal_stats(polygons, raster, stats="*", geojson_out=True,
+                           order=order, cache_size=2 ** 20) == stats
+    assert zonal_stats(polygons, raster, stats="*", geojson_out=True,
+                       order='hilbert', n_jobs=2) == stats
+    with pytest.raises(ValueError):
+        zonal_stats(polygons, raster, order='random')
+
+
+# -----------------------------------------------------------------------------
+# engines
+
+def _assert_stats_approx(a, b):
+    # per feature windows sum in the raster's float32
+    assert a.keys() == b.keys()
+    for k in a:
+        assert a[k] == pytest.approx(b[k], rel=1e-6)
+
+
+def test_label_engine():
+    polygons = os.path.join(DATA, 'polygons.shp')
+    label_stats = 'count min max mean sum std range nodata nan'
+    for kwargs in [{}, {'all_touched': True}, {'nodata': 0}]:
+        expected = zonal_stats(polygons, raster, stats=label_stats, **kwargs)
+        stats = zonal_stats(polygons, raster, stats=label_stats,
+                            engine='label', **kwargs)
+        for s1, s2 in zip(stats, expected):
+            _assert_stats_approx(s1, s2)
+
+
+def test_label_engine_tiles():
+    from rasterstats.io import read_features, Raster
+    from rasterstats.engines import gen_label_zonal_stats
+    polygons = os.path.join(DATA, 'polygons.shp')
+    features = list(read_features(polygons))
+    expected = zonal_stats(polygons, raster, stats="count min max mean std")
+    with Raster(raster) as rast:
+        # features spread over many small tiles
+        stats = list(gen_label_zonal_stats(
+            features, rast, ['count', 'min', 'max', 'mean', 'std'], tile_size=7))
+    for s1, s2 in zip(stats, expected):
+        _assert_stats_approx(s1, s2)
+
+
+def test_label_engine_output():
+    polygons = os.path.join(DATA, 'polygons_no_overlap.shp')
+    stats = zonal_stats(polygons, raster, engine='label', stats='count mean',
+                        geojson_out=True, prefix='z_')
+    for feature in stats:
+        assert feature['properties']['z_count'] == 0
+        assert feature['properties']['z_mean'] is None
+
+    points = os.path.join(DATA, 'points.shp')
+    assert zonal_stats(points, raster, engine='label') == zonal_stats(points, raster)
+
+
+def test_label_engine_invalid():
+    polygons = os.path.join(DATA, 'polygons.shp')
+    with pytest.raises(ValueError):
+        zonal_stats(polygons, raster, engine='foo')
+    with pytest.raises(ValueError):
+        zonal_stats(polygons, raster, engine='label', stats='median')
+    with pytest.raises(ValueError):
+        zonal_stats(polygons, raster, engine='label', categorical=True)
+    with pytest.raises(ValueError):
+        zonal_stats(polygons, raster, engine='label', percent_cover_weighting=True)
+
+
+def test_sweep_engine():
+    # overlapping features, some partially outside of the raster
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    sweep_stats = 'count min max mean sum std range nodata nan'
+    for kwargs in [{}, {'all_touched': True}]:
+        expected = zonal_stats(polygons, raster, stats=sweep_stats, **kwargs)
+        stats = zonal_stats(polygons, raster, stats=sweep_stats,
+                            engine='sweep', **kwargs)
+        assert len(stats) == len(expected)
+        for s1, s2 in zip(stats, expected):
+            _assert_stats_approx(s1, s2)
+
+    polygons = os.path.join(DATA, 'polygons.shp')
+    for s1, s2 in zip(zonal_stats(polygons, raster, nodata=0, engine='sweep'),
+                      zonal_stats(polygons, raster, nodata=0)):
+        _assert_stats_approx(s1, s2)
+
+    points = os.path.join(DATA, 'points.shp')
+    assert zonal_stats(points, raster, engine='sweep') == zonal_stats(points, raster)
+    with pytest.raises(ValueError):
+        zonal_stats(polygons, raster, engine='sweep', raster_out=True)
+
+
+def test_sweep_engine_all_stats():
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    expected = zonal_stats(polygons, raster, stats='*')
+    stats = zonal_stats(polygons, raster, stats='*', engine='sweep')
+    for s1, s2 in zip(stats, expected):
+        _assert_stats_approx(s1, s2)
+
+    categorical_raster = os.path.join(DATA, 'slope_classes.tif')
+    catmap = {5.0: 'cat5'}
+    assert zonal_stats(polygons, categorical_raster, categorical=True,
+                       category_map=catmap, engine='sweep') == \
+        zonal_stats(polygons, categorical_raster, categorical=True,
+                    category_map=catmap)
+
+
+def test_sweep_engine_tiles():
+    from rasterstats.io import read_features, Raster
+    from rasterstats.engines import gen_sweep_zonal_stats
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    features = list(read_features(polygons))
+    # entirely outside of the raster
+    features.append({'type': 'Feature', 'properties': {},
+                     'geometry': Polygon([[0, 0], [0, 10], [10, 10], [10, 0]])
+                     .__geo_interface__})
+    expected = zonal_stats(features, raster, stats="count min max mean std")
+    with Raster(raster) as rast:
+        stats = list(gen_sweep_zonal_stats(
+            features, rast, ['count', 'min', 'max', 'mean', 'std'], tile_size=7))
+    assert len(stats) == len(expected)
+    for s1, s2 in zip(stats, expected):
+        _assert_stats_approx(s1, s2)
+
+
+def test_grid_engine():
+    from rasterstats.engines import gen_grid_zonal_stats, grid_window, GRID_STATS
+    with Raster(raster) as rast:
+        affine = rast.affine
+    cells = []
+    # a fishnet of 9x7 pixel cells, over the edges of the raster
+    for row in range(-7, 84, 7):
+        for col in range(-9, 90, 9):
+            (left, top), (right, bottom) = affine * (col, row), \
+                affine * (col + 9, row + 7)
+            cells.append(Polygon([(left, bottom), (left, top), (right, top),
+                                  (right, bottom)]))
+    assert grid_window(cells[0], affine) == ((-7, 0), (-9, 0))
+    # not aligned with the grid, nor rectangles
+    others = list(read_features(os.path.join(DATA, 'polygons.shp')))
+    assert grid_window(shape(others[0]['geometry']), affine) is None
+    features = others[:1] + cells + others[1:]
+
+    for all_touched in (False, True):
+        expected = zonal_stats(features, raster, stats=GRID_STATS,
+                               all_touched=all_touched)
+        stats = zonal_stats(features, raster, stats=GRID_STATS,
+                            all_touched=all_touched, engine='grid')
+        assert len(stats) == len(expected)
+        for s1, s2 in zip(stats, expected):
+            assert s1.keys() == s2.keys()
+            for k in s1:
+                # the squared deviations of the tables cancel out to ~1e-9
+                assert s1[k] == pytest.approx(s2[k], rel=1e-6, abs=1e-4)
+
+    with Raster(raster) as rast:
+        stats = list(gen_grid_zonal_stats(
+            [{'geometry': cell.__geo_interface__} for cell in cells], rast,
+            GRID_STATS, tile_size=16))
+    for s1, s2 in zip(stats, zonal_stats(cells, raster, stats=GRID_STATS)):
+        for k in s1:
+            assert s1[k] == pytest.approx(s2[k], rel=1e-6, abs=1e-4)
+
+    with pytest.raises(ValueError):
+        zonal_stats(cells, raster, stats='median', engine='grid')
+
+
+def test_grid_stats():
+    from rasterstats import grid_stats
+    from rasterstats.engines import GRID_STATS
+    with Raster(raster) as rast:
+        affine = rast.affine
+        height, width = rast.shape
+    arrays, grid_affine = grid_stats(raster, factor=(7, 9), stats=GRID_STATS,
+                                     tile_size=20)
+    assert grid_affine == affine * Affine.scale(9, 7)
+    rows, cols = -(-height // 7), -(-width // 9)
+    assert arrays['count'].shape == (rows, cols)
+
+    # the same as the zonal stats of the cells, partial cells at the edges
+    cells = []
+    for row in range(rows):
+        for col in range(cols):
+            (left, top), (right, bottom) = grid_affine * (col, row), \
+                grid_affine * (col + 1, row + 1)
+            cells.append(Polygon([(left, bottom), (left, top), (right, top),
+                                  (right, bottom)]))
+    expected = zonal_stats(cells, raster, stats=GRID_STATS)
+    for i, s in enumerate(expected):
+        for k in GRID_STATS:
+            value = arrays[k][i // cols, i % cols]
+            if s[k] is None:
+                assert np.isnan(value)
+            else:
+                assert value == pytest.approx(s[k], rel=1e-6, abs=1e-4)
+
+    same, _ = grid_stats(raster, cell_size=(9 * affine.a, 7 * -affine.e),
+                         stats='count mean')
+    assert sorted(same) == ['count', 'mean']
+    assert np.array_equal(same['count'], arrays['count'])
+
+    features = list(grid_stats(raster, factor=(7, 9), stats=GRID_STATS,
+                               geojson_out=True))
+    assert len(features) == len(expected)
+    for feat, cell, s in zip(features, cells, expected):
+        assert shape(feat['geometry']).equals(cell)
+        for k in GRID_STATS:
+            assert feat['properties'][k] == pytest.approx(s[k], rel=1e-6, abs=1e-4)
+
+    with pytest.raises(ValueError):
+        grid_stats(raster)
+    with pytest.raises(ValueError):
+        grid_stats(raster, factor=2, cell_size=affine.a)
+    with pytest.raises(ValueError):
+        grid_stats(raster, cell_size=1.5 * affine.a)
+    with pytest.raises(ValueError):
+        grid_stats(raster, factor=2, stats='median')
+
+
+# -----------------------------------------------------------------------------
+# partials
+
+def test_zonal_partials():
+    from rasterstats import zonal_partials, merge_partials, finalize
+    polygons = os.path.join(DATA, 'polygons_partial_overlap.shp')
+    features = list(read_features(polygons))
+    # entirely outside of the raster
+    features.append({'type': 'Feature', 'properties': {},
+                     'geometry': Polygon([[0, 0], [0, 10], [10, 10], [10, 0]])
+                     .__geo_interface__})
+    expected = zonal_stats(features, raster, stats='*')
+
+    # two "hosts" processing half of the tiles each, exchanging json
+    tiles = [(r, c) for r in range(8) for c in range(9)]
+    partials = []
+    for host_tiles in [tiles[::2], tiles[1::2]]:
+        partials.extend(json.loads(json.dumps(list(zonal_partials(
+            features, raster, stats='*', tiles=host_tiles, tile_size=10)))))
+    merged = json.loads(json.dumps(merge_partials(partials[::-1])))
+
+    assert len(merged) == len(expected)
+    for i, s2 in enumerate(expected):
+        _assert_stats_approx(finalize(merged[str(i)]), s2)
+
+
+def test_zonal_partials_categorical():
+    from rasterstats import zonal_partials, merge_partials, finalize
+    polygons = os.path.join(DATA, 'polygons.shp')
+    categorical_raster = os.path.join(DATA, 'slope_classes.tif')
+    catmap = {5.0: 'cat5'}
+    expected = zonal_stats(polygons, categorical_raster, categorical=True,
+                           category_map=catmap)
+    merged = merge_partials(zonal_partials(
+        polygons, categorical_raster, categorical=True, tile_size=16))
+    assert [finalize(merged[i], catmap) for i in range(2)] == expected
+
+    partials = list(zonal_partials(polygons, raster, stats='count'))
+    partials += list(zonal_partials(polygons, raster, stats='mean'))
+    with pytest.raises(ValueError):
+        merge_partials(partials)
+
+
+# -----------------------------------------------------------------------------
+# aggregate pyramid
+
+def test_pyramid(tmpdir, monkeypatch):
+    from rasterstats.pyramid import build_pyramid, PYRAMID_STATS
+    from shapely.geometry import Point
+    path = str(tmpdir.join('slope.pyramid.npz'))
+    pyramid = build_pyramid(raster, path=path, block_size=4, tile_size=16)
+    assert pyramid.levels[-1]['count'].shape == (1, 1)
+    with Raster(raster) as rast:
+        valid = rast.read(window=((0, 78), (0, 84)), masked=True).array.count()
+    assert pyramid.levels[-1]['count'][0, 0] == valid
+
+    features = list(read_features(
+        os.path.join(DATA, 'polygons_partial_overlap.shp')))
+    features.append(Point(245400, 999900).buffer(900))
+    reads = []
+    read = Raster.read
+    monkeypatch.setattr(Raster, 'read', lambda self, **kw: reads.append(
+        kw['window']) or read(self, **kw))
+    for all_touched in (False, True):
+        expected = zonal_stats(features, raster, stats=PYRAMID_STATS,
+                               all_touched=all_touched)
+        del reads[:]
+        stats = zonal_stats(features, raster, stats=PYRAMID_STATS,
+                            all_touched=all_touched, pyramid=path)
+        for s1, s2 in zip(stats, expected):
+            _assert_stats_approx(s1, s2)
+        # only the boundary of the large feature is read
+        read_pixels = sum((r1 - r0) * (c1 - c0) for (r0, r1), (c0, c1) in reads)
+        assert read_pixels < 78 * 84
+
+    with pytest.raises(ValueError):
+        zonal_stats(features, raster, stats='median', pyramid=pyramid)
+    with pytest.raises(ValueError):
+        zonal_stats(features, raster, pyramid=pyramid, engine='sweep')
+    with pytest.raises(ValueError):
+        zonal_stats(features, raster, pyramid=pyramid, nodata=0)
+
+
+def test_pyramid_boundary_clip(tmpdir, monkeypatch):
+    from rasterstats.pyramid import build_pyramid, PYRAMID_STATS
+    from rasterstats import pyramid as pyramid_module
+    from shapely.geometry import Point
+    path = str(tmpdir.join('slope.pyramid.npz'))
+    build_pyramid(raster, path=path, block_size=2, tile_size=16)
+    # an irregular polygon crossing many blocks, with a hole
+    star = Polygon([(245400 + r * np.cos(a), 999900 + r * np.sin(a))
+                    for a, r in zip(np.linspace(0, 2 * np.pi, 40, endpoint=False),
+                                    [1500, 700] * 20)])
+    star = star.difference(Point(245400, 999900).buffer(300))
+    with Raster(raster) as rast:
+        pixel = rast.affine.a
+    clipped = []
+    rasterize_geom = pyramid_module.rasterize_geom
+    monkeypatch.setattr(pyramid_module, 'rasterize_geom', lambda geom, **kw: (
+        clipped.append(geom) or rasterize_geom(geom, **kw)))
+    for all_touched in (False, True):
+        expected = zonal_stats(star, raster, stats=PYRAMID_STATS,
+                               all_touched=all_touched, engine='feature')
+        del clipped[:]
+        stats = zonal_stats(star, raster, stats=PYRAMID_STATS,
+                            all_touched=all_touched, pyramid=path)
+        _assert_stats_approx(stats[0], expected[0])
+        # each run of boundary blocks rasterizes its own part of the polygon
+        assert len(clipped) > 1
+        for part in clipped:
+            minx, miny, maxx, maxy = part.bounds
+            assert maxy - miny <= 4 * pixel + 1e-6
+
+
 # -----------------------------------------------------------------------------
 # optional tests
 